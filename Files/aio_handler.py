@@ -0,0 +1,484 @@
+import asyncio
+import contextlib
+import time
+import traceback
+from urllib.parse import urljoin
+import aiohttp
+import telepot.aio
+from utils import check_spam, check_for_curse_words, increment_violations, remember_mute, forget_mute, SAFE_BROWSING_API_KEY, \
+    chat_title_cache, member_status_cache, chat_admins_cache, remember_message, take_recent_messages
+from checks import get_timeout, extract_urls, safe_browsing_payload, \
+    is_spam_score, format_notice, log_mute, remember_member_status, on_failure, \
+    handle_chat_member_update, SAFE_BROWSING_API_URL, SPAM_NOTICE, CURSE_NOTICE, LINK_NOTICE, \
+    SPAM_TEXT_NOTICE, get_cached_url_verdict, apply_safe_browsing_result, apply_safe_browsing_error, \
+    safe_browsing_batch_window, safe_browsing_batch_size, is_shortened_url, chain_verdicts, resolved_url_cache, \
+    redirect_max_hops, redirect_time_budget, REDIRECT_STATUSES, error_url_ttl, text_score_cache, \
+    perspective_governor, PerspectiveUnavailable, message_priority, PRIORITY_MESSAGE, PRIORITY_RECHECK, \
+    perspective_message_deadline, perspective_recheck_deadline, prefilter_verdict, DUPLICATE_NOTICE
+from near_duplicates import near_duplicate_index
+from http_client import http_client, http_pool_hosts, http_pool_size, http_connect_timeout
+from outbound import OutboundBot, outbound_queue
+from webhook import serve_webhook
+import checks
+import handler
+from colorama import init, Fore, Style
+
+# Ініціалізація colorama
+init()
+
+# Асинхронний режим: оновлення обробляються як корутини, тож повільна відповідь Perspective
+# чи Safe Browsing в одному чаті не зупиняє модерацію решти чатів.
+# Гарячий шлях (перевірки повідомлень) повністю асинхронний; рідкісні багатокрокові сценарії
+# (команди, нові учасники, верифікація в особистих) виконуються синхронним кодом у пулі потоків.
+
+max_in_flight_updates = 500
+request_timeout = 5
+
+session = None
+outbound_bot = None  # OutboundBot поверх синхронного бота, створюється в run_bot
+pending_tasks = set()
+
+
+@contextlib.asynccontextmanager
+async def request(endpoint, method, url, **kwargs):
+    # Запит через спільну сесію з урахуванням у лічильниках затримок і помилок http_client
+    started = time.monotonic()
+    failed = True
+    try:
+        async with session.request(method, url, **kwargs) as response:
+            failed = response.status >= 400
+            yield response
+    finally:
+        http_client.record(endpoint, time.monotonic() - started, failed)
+
+
+async def get_chat_title(bot, chat_id):
+    title = chat_title_cache.get(chat_id)
+    if title is not None:
+        return title
+    try:
+        chat = await bot.getChat(chat_id)
+        title = chat.get('title', f"Чат {chat_id}")
+        chat_title_cache.set(chat_id, title)
+        return title
+    except Exception as e:
+        print(f"Помилка отримання назви чату: {e}")
+        return f"Чат {chat_id}"
+
+
+async def get_chat_admins(bot, chat_id):
+    admins = chat_admins_cache.get(chat_id)
+    if admins is None:
+        admins = {admin['user']['id']: admin for admin in await bot.getChatAdministrators(chat_id)}
+        chat_admins_cache.set(chat_id, admins)
+        for admin_id, admin in admins.items():
+            member_status_cache.set((chat_id, admin_id), admin)
+    return admins
+
+
+async def is_admin(bot, chat_id, user_id):
+    try:
+        return user_id in await get_chat_admins(bot, chat_id)
+    except telepot.exception.TelegramError as e:
+        print(f"{Fore.RED}Помилка при перевірці адміністратора:{Style.RESET_ALL} {e}")
+        return False
+
+
+async def is_user_muted(bot, chat_id, user_id):
+    try:
+        member = member_status_cache.get((chat_id, user_id))
+        if member is None:
+            member = await bot.getChatMember(chat_id, user_id)
+            member_status_cache.set((chat_id, user_id), member)
+        return member.get('status') == 'restricted' and not member.get('can_send_messages', True)
+    except Exception as e:
+        print(f"{Fore.RED}Помилка при перевірці статусу користувача:{Style.RESET_ALL} {e}")
+        return False
+
+
+async def restrict_member(bot, chat_id, user_id, until_date=None):
+    # Дії, що змінюють чат, ідуть спільною чергою вихідних дій з лімітами Telegram
+    result = outbound_bot.restrictChatMember(
+        chat_id, user_id,
+        until_date=until_date,
+        can_send_messages=False,
+        can_send_media_messages=False,
+        can_send_other_messages=False,
+        can_add_web_page_previews=False
+    )
+    remember_member_status(chat_id, user_id, 'restricted', False, until_date)
+    return on_failure(result, member_status_cache.invalidate, (chat_id, user_id))
+
+
+async def delete_message(bot, chat_id, message_id):
+    try:
+        outbound_bot.deleteMessage((chat_id, message_id))
+        print(f"{Fore.YELLOW}Повідомлення видалено:{Style.RESET_ALL} {message_id}")
+    except Exception as e:
+        print(f"{Fore.RED}Помилка видалення:{Style.RESET_ALL} {e}")
+
+
+async def delete_messages(bot, chat_id, message_ids):
+    try:
+        outbound_bot.deleteMessages(chat_id, message_ids)
+        print(f"{Fore.YELLOW}Повідомлення видалено:{Style.RESET_ALL} {', '.join(map(str, message_ids))}")
+    except Exception as e:
+        print(f"{Fore.RED}Помилка видалення:{Style.RESET_ALL} {e}")
+
+
+async def purge_user_messages(bot, chat_id, user_id, message_id):
+    await delete_messages(bot, chat_id, sorted(set(take_recent_messages(chat_id, user_id)) | {message_id}))
+
+
+async def resolve_redirect_chain(url):
+    if not is_shortened_url(url):
+        return [url]
+    cached = resolved_url_cache.get(url)
+    if cached is not None:
+        return cached
+    chain = [url]
+    deadline = time.monotonic() + redirect_time_budget
+    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+    try:
+        for _ in range(redirect_max_hops):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            timeout = aiohttp.ClientTimeout(total=remaining)
+            async with request('shortener', 'HEAD', chain[-1], headers=headers, allow_redirects=False, timeout=timeout) as response:
+                status, location = response.status, response.headers.get('Location')
+            if status in (405, 501):
+                async with request('shortener', 'GET', chain[-1], headers=headers, allow_redirects=False, timeout=timeout) as response:
+                    status, location = response.status, response.headers.get('Location')
+            if status not in REDIRECT_STATUSES or not location:
+                break
+            chain.append(urljoin(chain[-1], location))
+        print(f"{Fore.GREEN}URL розгорнуто:{Style.RESET_ALL} {' -> '.join(chain)}")
+        resolved_url_cache.set(url, chain)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"{Fore.RED}Помилка URL:{Style.RESET_ALL} {url} - {e}")
+        resolved_url_cache.set(url, chain, error_url_ttl)
+    return chain
+
+
+async def query_safe_browsing(canonical_urls):
+    print(f"{Fore.CYAN}Перевірка URL:{Style.RESET_ALL} {len(canonical_urls)} шт. одним запитом")
+    try:
+        api_url = f"{SAFE_BROWSING_API_URL}?key={SAFE_BROWSING_API_KEY}"
+        async with request('safe_browsing', 'POST', api_url, json=safe_browsing_payload(canonical_urls)) as response:
+            if response.status == 200:
+                return apply_safe_browsing_result(canonical_urls, await response.json())
+            print(f"{Fore.YELLOW}Помилка API:{Style.RESET_ALL} {response.status} - {await response.text()}")
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        print(f"{Fore.RED}Помилка перевірки:{Style.RESET_ALL} {', '.join(canonical_urls)} - {e}")
+    return apply_safe_browsing_error(canonical_urls)
+
+
+class AsyncSafeBrowsingBatcher:
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self.requests_sent = 0
+        self.urls_checked = 0
+        self._pending = {}  # {canonical_url: asyncio.Future}
+        self._flush_handle = None
+
+    def submit(self, canonical_url):
+        future = self._pending.get(canonical_url)
+        if future is None:
+            future = self._pending[canonical_url] = asyncio.get_running_loop().create_future()
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            pending_tasks.add(task)
+            task.add_done_callback(pending_tasks.discard)
+
+    async def _send(self, batch):
+        verdicts = {}
+        try:
+            verdicts = await query_safe_browsing(list(batch))
+        finally:
+            self.requests_sent += 1
+            self.urls_checked += len(batch)
+            for canonical_url, future in batch.items():
+                if not future.done():
+                    future.set_result(verdicts.get(canonical_url, True))
+
+
+safe_browsing_batcher = AsyncSafeBrowsingBatcher(safe_browsing_batch_window, safe_browsing_batch_size)
+
+
+async def check_urls(urls):
+    verdicts = []
+    for url in urls:
+        canonical_url, suspicious = get_cached_url_verdict(url)
+        if suspicious is None and checks.local_safe_browsing is not None:
+            hits = checks.local_safe_browsing.find_prefix_hits(canonical_url)
+            if hits:
+                suspicious = await asyncio.to_thread(checks.local_safe_browsing.resolve_prefix_hits, hits)
+            elif hits is not None:
+                suspicious = False
+        verdicts.append(suspicious if suspicious is not None else safe_browsing_batcher.submit(canonical_url))
+    return [await verdict if isinstance(verdict, asyncio.Future) else verdict for verdict in verdicts]
+
+
+async def get_text_scores(text, priority=PRIORITY_MESSAGE, deadline=perspective_message_deadline):
+    # Запити до Perspective ділять одну квоту з синхронним кодом (нові учасники), тож ідуть через спільну чергу
+    scores = text_score_cache.peek(text)
+    if scores is None and text_score_cache.persist:
+        scores = await asyncio.to_thread(text_score_cache.get, text)
+    if scores is not None:
+        return scores
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(perspective_governor.submit(text, priority, deadline)),
+                                      deadline + 1)
+    except (PerspectiveUnavailable, asyncio.TimeoutError) as e:
+        print(f"{Fore.YELLOW}Perspective API недоступне:{Style.RESET_ALL} '{text}' - {e}")
+        return None
+
+
+async def is_spam_text(text, priority=PRIORITY_MESSAGE):
+    if not text.strip():
+        return False
+    verdict = prefilter_verdict(text)
+    if verdict is not None:
+        return verdict
+    scores = await get_text_scores(text, priority)
+    if scores is None:
+        return None
+    spam_score, toxicity_score = scores
+    print(f"{Fore.CYAN}Perspective API:{Style.RESET_ALL} Текст: '{text}' | SPAM={spam_score:.2f} | TOXICITY={toxicity_score:.2f}")
+    return is_spam_score(spam_score, toxicity_score)
+
+
+async def mute_for_violation(bot, msg, chat_id, user_id, notice, event, details, purge=False, **notice_args):
+    timeout = get_timeout(increment_violations(user_id))
+    if await is_admin(bot, chat_id, user_id):
+        return
+    if await is_user_muted(bot, chat_id, user_id):
+        if purge:
+            await delete_message(bot, chat_id, msg['message_id'])
+        return
+    if purge:
+        await purge_user_messages(bot, chat_id, user_id, msg['message_id'])
+    until_date = int(time.time()) + timeout
+    hours = timeout // 3600
+    try:
+        restriction = await restrict_member(bot, chat_id, user_id, until_date=until_date)
+        remember_mute(user_id, chat_id, until_date)
+        on_failure(restriction, forget_mute, user_id)
+        chat_title = await get_chat_title(bot, chat_id)
+        outbound_bot.sendNotice(chat_id, format_notice(notice, msg, user_id, hours, chat_title, **notice_args),
+                                parse_mode='Markdown')
+        log_mute(event, msg, chat_id, chat_title, user_id, details, hours)
+    except Exception as e:
+        print(f"{Fore.RED}Помилка обмеження:{Style.RESET_ALL} {e}")
+
+
+async def handle_spam(bot, msg, chat_id, user_id):
+    if check_spam(chat_id, user_id):
+        await mute_for_violation(bot, msg, chat_id, user_id, SPAM_NOTICE, "Spam: User muted",
+                                 f"Message: {msg.get('text', '')}", purge=True)
+        return True
+    return False
+
+
+async def handle_curse_words(bot, msg, chat_id, user_id):
+    text = msg.get('text', '').lower()
+    if check_for_curse_words(text):
+        await delete_message(bot, chat_id, msg['message_id'])
+        await mute_for_violation(bot, msg, chat_id, user_id, CURSE_NOTICE, "Curse words: User muted", f"Message: {text}")
+        return True
+    return False
+
+
+async def handle_near_duplicates(bot, msg, chat_id, user_id):
+    text = msg.get('text', '')
+    if text.startswith('/'):
+        return False
+    copies = near_duplicate_index.check(chat_id, user_id, msg['message_id'], text)
+    if copies is None:
+        return False
+    print(f"{Fore.CYAN}Масова розсилка:{Style.RESET_ALL} '{text}' | копій у чаті: {len(copies)}")
+    await delete_messages(bot, chat_id, sorted(copies))
+    await mute_for_violation(bot, msg, chat_id, user_id, DUPLICATE_NOTICE, "Near-duplicate spam: User muted", f"Message: {text}",
+                             purge=True)
+    return True
+
+
+async def handle_suspicious_links(bot, msg, chat_id, user_id):
+    text = msg.get('text', '')
+    urls = extract_urls(text)
+    if not urls:
+        print(f"{Fore.CYAN}Аналіз:{Style.RESET_ALL} Текст: '{text}' | URL: Немає | Підозрілий: {Fore.GREEN}Ні{Style.RESET_ALL}")
+        return False
+    chains = await asyncio.gather(*(resolve_redirect_chain(url) for url in urls))
+    verdicts = chain_verdicts(chains, await check_urls([url for chain in chains for url in chain]))
+    for final_url, suspicious in zip([chain[-1] for chain in chains], verdicts):
+        print(f"{Fore.CYAN}Аналіз:{Style.RESET_ALL} Текст: '{text}' | URL: {final_url} | Підозрілий: {Fore.RED if suspicious else Fore.GREEN}{'Так' if suspicious else 'Ні'}{Style.RESET_ALL}")
+        if suspicious:
+            await mute_for_violation(bot, msg, chat_id, user_id, LINK_NOTICE, "Suspicious link: User muted",
+                                     f"Message: {text} - URL: {final_url}", purge=True, url=final_url)
+            return True
+    return False
+
+
+async def punish_spam_text(bot, msg, chat_id, user_id):
+    text = msg.get('text', '')
+    await mute_for_violation(bot, msg, chat_id, user_id, SPAM_TEXT_NOTICE, "Spam text: User muted", f"Message: {text}",
+                             purge=True)
+
+
+async def recheck_spam_text(bot, msg, chat_id, user_id):
+    text = msg.get('text', '')
+    print(f"{Fore.YELLOW}Перевірку відкладено:{Style.RESET_ALL} '{text}'")
+    try:
+        scores = await asyncio.wrap_future(perspective_governor.submit(text, PRIORITY_RECHECK, perspective_recheck_deadline))
+    except PerspectiveUnavailable as e:
+        print(f"{Fore.RED}Повідомлення лишилось неперевіреним:{Style.RESET_ALL} '{text}' - {e}")
+        return
+    if is_spam_score(*scores):
+        await punish_spam_text(bot, msg, chat_id, user_id)
+
+
+async def handle_spam_text(bot, msg, chat_id, user_id):
+    text = msg.get('text', '')
+    is_spam = await is_spam_text(text, message_priority(user_id))
+    if is_spam is None:
+        task = asyncio.ensure_future(recheck_spam_text(bot, msg, chat_id, user_id))
+        pending_tasks.add(task)
+        task.add_done_callback(pending_tasks.discard)
+        return False
+    print(
+        f"{Fore.CYAN}Аналіз тексту:{Style.RESET_ALL} '{text}' | Спам/Токсичність: {Fore.RED if is_spam else Fore.GREEN}{'Так' if is_spam else 'Ні'}{Style.RESET_ALL}")
+    if is_spam:
+        await punish_spam_text(bot, msg, chat_id, user_id)
+        return True
+    return False
+
+
+async def handle(bot, sync_bot, msg):
+    chat_type = msg['chat']['type']
+    if chat_type not in ['group', 'supergroup']:
+        return
+
+    chat_id = msg['chat']['id']
+    user_id = msg['from']['id']
+
+    handler.track_chat_state(msg)
+    handler.rules_broadcaster.touch(sync_bot, chat_id)
+
+    if 'new_chat_members' in msg:
+        await asyncio.to_thread(handler.handle_new_members, sync_bot, chat_id, msg['new_chat_members'])
+        return
+
+    remember_message(chat_id, user_id, msg['message_id'])
+
+    if await handle_spam(bot, msg, chat_id, user_id):
+        return
+
+    if await handle_curse_words(bot, msg, chat_id, user_id):
+        return
+
+    if await handle_near_duplicates(bot, msg, chat_id, user_id):
+        return
+
+    if await handle_suspicious_links(bot, msg, chat_id, user_id):
+        return
+
+    if await handle_spam_text(bot, msg, chat_id, user_id):
+        return
+
+    if msg.get('text', '').startswith('/'):
+        await asyncio.to_thread(handler.dispatch_command, sync_bot, msg, chat_id, user_id)
+
+
+async def handle_edited_message(bot, msg):
+    if msg['chat']['type'] not in ['group', 'supergroup'] or 'from' not in msg:
+        return
+
+    chat_id = msg['chat']['id']
+    user_id = msg['from']['id']
+
+    if await handle_curse_words(bot, msg, chat_id, user_id):
+        return
+
+    if await handle_suspicious_links(bot, msg, chat_id, user_id):
+        return
+
+    await handle_spam_text(bot, msg, chat_id, user_id)
+
+
+async def process_update(bot, sync_bot, update):
+    try:
+        if 'message' in update:
+            msg = update['message']
+            if msg['chat']['type'] == 'private':
+                await asyncio.to_thread(handler.handle_private_message, sync_bot, msg)
+            else:
+                await handle(bot, sync_bot, msg)
+        elif 'edited_message' in update:
+            await handle_edited_message(bot, update['edited_message'])
+        elif 'chat_member' in update:
+            handle_chat_member_update(update['chat_member'])
+        elif 'my_chat_member' in update:
+            handler.handle_bot_member_update(update['my_chat_member'])
+    except Exception:
+        traceback.print_exc()
+
+
+async def run_bot(token, sync_bot, webhook=False):
+    global session, outbound_bot
+    bot = telepot.aio.Bot(token)
+    sync_bot = outbound_bot = OutboundBot(sync_bot, outbound_queue)
+    outbound_queue.start()
+    connector = aiohttp.TCPConnector(limit=http_pool_hosts * http_pool_size, limit_per_host=http_pool_size)
+    session = aiohttp.ClientSession(connector=connector,
+                                    timeout=aiohttp.ClientTimeout(total=request_timeout, connect=http_connect_timeout))
+    slots = asyncio.Semaphore(max_in_flight_updates)
+    handler.start_restore_thread(sync_bot)
+    print(f"{Fore.GREEN}Асинхронний режим:{Style.RESET_ALL} до {max_in_flight_updates} оновлень одночасно")
+
+    async def report_stats():
+        while True:
+            await asyncio.sleep(handler.pool_stats_interval)
+            if pending_tasks:
+                print(f"{Fore.YELLOW}Оновлень в обробці:{Style.RESET_ALL} {len(pending_tasks)}/{max_in_flight_updates}")
+            await asyncio.to_thread(handler.report_stats)
+
+    async def submit(update):
+        await slots.acquire()
+        task = asyncio.ensure_future(process_update(bot, sync_bot, update))
+        pending_tasks.add(task)
+        task.add_done_callback(pending_tasks.discard)
+        task.add_done_callback(lambda _: slots.release())
+
+    stats_task = asyncio.ensure_future(report_stats())
+    offset = None
+    try:
+        if webhook:
+            await serve_webhook(sync_bot, submit, handler.allowed_updates)
+        while True:
+            try:
+                updates = await bot.getUpdates(offset=offset, timeout=handler.polling_timeout,
+                                               allowed_updates=handler.allowed_updates)
+            except Exception as e:
+                print(f"{Fore.RED}Помилка отримання оновлень:{Style.RESET_ALL} {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update['update_id'] + 1
+                await submit(update)
+    finally:
+        stats_task.cancel()
+        await session.close()
@@ -1,57 +1,270 @@
 import telepot
+import os
 import time
-import requests
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from email.utils import parsedate_to_datetime
 import re
-from urllib.parse import urlparse
-from utils import check_spam, get_violations, update_violations, get_username, SAFE_BROWSING_API_KEY, PERSPECTIVE_API_KEY, load_curse_words, check_for_curse_words, logging, muted_users, get_chat_title
+from urllib.parse import urlparse, urljoin
+from utils import check_spam, increment_violations, get_username, SAFE_BROWSING_API_KEY, PERSPECTIVE_API_KEY, check_for_curse_words, logging, remember_mute, forget_mute, get_chat_title, \
+    member_status_cache, chat_admins_cache, TTLCache, canonicalize_url, \
+    text_score_cache, text_hash, TokenBucket, get_violations, \
+    take_recent_messages
+from http_client import http_client, HttpError
+from near_duplicates import near_duplicate_index
+from safe_browsing_db import LocalSafeBrowsingDB, SAFE_BROWSING_API_BASE, SAFE_BROWSING_CLIENT, THREAT_TYPES, PLATFORM_TYPE, \
+    THREAT_ENTRY_TYPE
 from colorama import init, Fore, Style
 
 # Ініціалізація colorama
 init()
 
-spam_time_limit = 10
-spam_max_messages = 3
 timeout_stages = [3600, 21600, 43200]
+spam_score_threshold = 0.75
+toxicity_score_threshold = 0.65
 
-def resolve_shortened_url(url):
+SAFE_BROWSING_API_URL = f"{SAFE_BROWSING_API_BASE}/threatMatches:find"
+PERSPECTIVE_API_URL = "https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze"
+
+# Вердикти Safe Browsing за канонічним URL: безпечні, небезпечні та помилкові живуть різний час
+safe_url_ttl = 1800
+unsafe_url_ttl = 21600
+error_url_ttl = 60
+url_verdict_cache = TTLCache(safe_url_ttl, maxsize=50000)
+safe_browsing_batch_window = 0.02  # Скільки чекати на URL з інших повідомлень перед запитом, секунди
+safe_browsing_batch_size = 500  # Ліміт threatEntries в одному запиті threatMatches:find
+safe_browsing_verdict_timeout = 10  # Найдовше очікування вердикту пакетного запиту, секунди
+local_safe_browsing = None  # LocalSafeBrowsingDB, якщо увімкнено офлайн-режим
+
+# Розгортання скорочених посилань
+SHORTENER_HOSTS = frozenset({
+    'bit.ly', 'tinyurl.com', 'goo.gl', 't.co', 'ow.ly', 'is.gd', 'v.gd', 'buff.ly', 'cutt.ly', 'rebrand.ly',
+    't.ly', 'rb.gy', 'tiny.cc', 'shorturl.at', 'bl.ink', 'lnkd.in', 's.id', 'clck.ru', 'u.to', 'surl.li',
+    'tiny.one', 'shorte.st', 'adf.ly', 'bitly.com', 'qr.ae', 'tr.im', 'x.co'
+})
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+redirect_max_hops = 5
+redirect_time_budget = 3.0  # Загальний час на розгортання одного посилання, секунди
+resolved_url_ttl = 3600
+resolved_url_cache = TTLCache(resolved_url_ttl, maxsize=20000)  # {short_url: [url, ..., final_url]}
+
+# Квота Perspective: запити йдуть через чергу з пріоритетами, обмеженням QPS та кількості одночасних запитів
+perspective_qps = float(os.getenv('PERSPECTIVE_QPS', 1))
+perspective_concurrency = int(os.getenv('PERSPECTIVE_CONCURRENCY', 4))
+perspective_max_queue = 1000
+perspective_max_retries = 3
+perspective_retry_delay = 1.0  # Початкова пауза між повторами, якщо API не вказало Retry-After
+perspective_message_deadline = 5.0  # Скільки повідомлення може чекати на оцінку, секунди
+perspective_new_user_deadline = 15.0
+perspective_recheck_deadline = 600.0  # Для повторної перевірки повідомлень, що не дочекалися оцінки
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+PRIORITY_NEW_USER, PRIORITY_SUSPECT, PRIORITY_MESSAGE, PRIORITY_RECHECK = range(4)
+prefilter = None  # PrefilterModel, якщо увімкнено локальний попередній фільтр
+
+SPAM_NOTICE = "🔇 {user} отримав таймаут за спам на {hours} годин у '{chat_title}'!"
+CURSE_NOTICE = "🔇 {user} отримав таймаут на {hours} годин за використання ненормативної лексики!"
+LINK_NOTICE = "🔗 {user} отримав таймаут на {hours} годин у '{chat_title}' за підозріле посилання: {url}!"
+SPAM_TEXT_NOTICE = "📢 {user} отримав таймаут на {hours} годин за спам або шкідливий вміст!"
+DUPLICATE_NOTICE = "📢 {user} отримав таймаут на {hours} годин у '{chat_title}' за масову розсилку однакових повідомлень!"
+
+def get_timeout(previous_violations):
+    return timeout_stages[min(previous_violations, len(timeout_stages) - 1)]
+
+def is_shortened_url(url):
+    host = (urlparse(url).hostname or '').lower()
+    return host.removeprefix('www.') in SHORTENER_HOSTS
+
+def resolve_redirect_chain(url):
+    # Ланцюжок переспрямувань через HEAD-запити, без завантаження сторінок; розгортаються лише відомі скорочувачі
+    if not is_shortened_url(url):
+        return [url]
+    cached = resolved_url_cache.get(url)
+    if cached is not None:
+        return cached
+    chain = [url]
+    deadline = time.monotonic() + redirect_time_budget
+    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-        response = requests.get(url, headers=headers, allow_redirects=True, timeout=5)
-        final_url = response.url
-        print(f"{Fore.GREEN}URL розгорнуто:{Style.RESET_ALL} {url} -> {final_url}")
-        return final_url
-    except requests.RequestException as e:
+        for _ in range(redirect_max_hops):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            response = http_client.head('shortener', chain[-1], headers=headers, timeout=remaining)
+            if response.status_code in (405, 501):
+                # Деякі скорочувачі не підтримують HEAD: GET без читання тіла відповіді
+                response = http_client.get('shortener', chain[-1], headers=headers, timeout=remaining, read_body=False)
+            location = response.headers.get('Location')
+            if response.status_code not in REDIRECT_STATUSES or not location:
+                break
+            chain.append(urljoin(chain[-1], location))
+        print(f"{Fore.GREEN}URL розгорнуто:{Style.RESET_ALL} {' -> '.join(chain)}")
+        resolved_url_cache.set(url, chain)
+    except HttpError as e:
         print(f"{Fore.RED}Помилка URL:{Style.RESET_ALL} {url} - {e}")
-        return url
+        resolved_url_cache.set(url, chain, error_url_ttl)
+    return chain
 
-def is_suspicious_url(url):
-    print(f"{Fore.CYAN}Перевірка URL:{Style.RESET_ALL} {url}")
-    try:
-        api_url = f"https://safebrowsing.googleapis.com/v4/threatMatches:find?key={SAFE_BROWSING_API_KEY}"
-        payload = {
-            "client": {"clientId": "SpamBot", "clientVersion": "1.0.0"},
-            "threatInfo": {
-                "threatTypes": ["MALWARE", "SOCIAL_ENGINEERING", "UNWANTED_SOFTWARE", "POTENTIALLY_HARMFUL_APPLICATION"],
-                "platformTypes": ["ANY_PLATFORM"],
-                "threatEntryTypes": ["URL"],
-                "threatEntries": [{"url": url}]
-            }
+def resolve_shortened_url(url):
+    return resolve_redirect_chain(url)[-1]
+
+def chain_verdicts(chains, verdicts):
+    # Посилання підозріле, якщо підозрілий будь-який URL у його ланцюжку переспрямувань
+    result = []
+    position = 0
+    for chain in chains:
+        result.append(any(verdicts[position:position + len(chain)]))
+        position += len(chain)
+    return result
+
+def safe_browsing_payload(urls):
+    return {
+        "client": SAFE_BROWSING_CLIENT,
+        "threatInfo": {
+            "threatTypes": THREAT_TYPES,
+            "platformTypes": [PLATFORM_TYPE],
+            "threatEntryTypes": [THREAT_ENTRY_TYPE],
+            "threatEntries": [{"url": url} for url in urls]
         }
-        response = requests.post(api_url, json=payload, timeout=5)
-        if response.status_code == 200:
-            result = response.json()
-            if "matches" in result and len(result["matches"]) > 0:
-                print(f"{Fore.RED}Небезпечний URL:{Style.RESET_ALL} {url} - {result['matches']}")
-                return True
-            print(f"{Fore.GREEN}Безпечний URL:{Style.RESET_ALL} {url}")
-            return False
+    }
+
+def parse_duration(value):
+    # Safe Browsing повертає тривалості у форматі "300.5s"
+    try:
+        return float(str(value).rstrip('s'))
+    except ValueError:
+        return None
+
+def verdict_ttl(result, suspicious):
+    if suspicious:
+        durations = [parse_duration(match['cacheDuration']) for match in result.get('matches', []) if 'cacheDuration' in match]
+        durations = [duration for duration in durations if duration is not None]
+        return min(durations) if durations else unsafe_url_ttl
+    negative_duration = parse_duration(result.get('negativeCacheDuration', safe_url_ttl))
+    return min(safe_url_ttl, negative_duration) if negative_duration is not None else safe_url_ttl
+
+def get_cached_url_verdict(url):
+    canonical_url = canonicalize_url(url)
+    suspicious = url_verdict_cache.get(canonical_url)
+    if suspicious is not None:
+        print(f"{Fore.CYAN}URL з кешу:{Style.RESET_ALL} {url} | Підозрілий: {'Так' if suspicious else 'Ні'}")
+    return canonical_url, suspicious
+
+def apply_safe_browsing_result(canonical_urls, result):
+    matches = {}
+    for match in result.get("matches", []):
+        matches.setdefault(match.get("threat", {}).get("url"), []).append(match)
+    verdicts = {}
+    for canonical_url in canonical_urls:
+        url_matches = matches.get(canonical_url)
+        if url_matches:
+            print(f"{Fore.RED}Небезпечний URL:{Style.RESET_ALL} {canonical_url} - {url_matches}")
+            url_verdict_cache.set(canonical_url, True, verdict_ttl({"matches": url_matches}, True))
         else:
-            print(f"{Fore.YELLOW}Помилка API:{Style.RESET_ALL} {response.status_code} - {response.text}")
-            return True
-    except requests.RequestException as e:
-        print(f"{Fore.RED}Помилка перевірки:{Style.RESET_ALL} {url} - {e}")
+            print(f"{Fore.GREEN}Безпечний URL:{Style.RESET_ALL} {canonical_url}")
+            url_verdict_cache.set(canonical_url, False, verdict_ttl(result, False))
+        verdicts[canonical_url] = bool(url_matches)
+    return verdicts
+
+def apply_safe_browsing_error(canonical_urls):
+    for canonical_url in canonical_urls:
+        url_verdict_cache.set(canonical_url, True, error_url_ttl)
+    return dict.fromkeys(canonical_urls, True)
+
+def query_safe_browsing(canonical_urls):
+    print(f"{Fore.CYAN}Перевірка URL:{Style.RESET_ALL} {len(canonical_urls)} шт. одним запитом")
+    try:
+        api_url = f"{SAFE_BROWSING_API_URL}?key={SAFE_BROWSING_API_KEY}"
+        response = http_client.post('safe_browsing', api_url, json=safe_browsing_payload(canonical_urls))
+        if response.status_code == 200:
+            return apply_safe_browsing_result(canonical_urls, response.json())
+        print(f"{Fore.YELLOW}Помилка API:{Style.RESET_ALL} {response.status_code} - {response.text}")
+    except (HttpError, ValueError) as e:  # ValueError — тіло відповіді не є JSON
+        print(f"{Fore.RED}Помилка перевірки:{Style.RESET_ALL} {', '.join(canonical_urls)} - {e}")
+    return apply_safe_browsing_error(canonical_urls)
+
+# Збирає URL з одночасних повідомлень протягом кількох мілісекунд і перевіряє їх одним запитом,
+# після чого роздає вердикти всім потокам, що чекають
+class SafeBrowsingBatcher:
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self.requests_sent = 0
+        self.urls_checked = 0
+        self._pending = {}  # {canonical_url: Future}
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._thread = None
+
+    def submit(self, canonical_url):
+        with self._lock:
+            future = self._pending.get(canonical_url)
+            if future is None:
+                future = self._pending[canonical_url] = Future()
+                self._has_work.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return future
+
+    def _take_batch(self):
+        with self._has_work:
+            while not self._pending:
+                self._has_work.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._has_work.wait(remaining)
+            batch = dict(list(self._pending.items())[:self.max_batch])
+            for canonical_url in batch:
+                del self._pending[canonical_url]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            # Будь-яка помилка пакета завершує лише його Future: потік живе далі, інакше всі наступні check_urls чекали б вічно
+            try:
+                verdicts = query_safe_browsing(list(batch))
+            except Exception as e:
+                print(f"{Fore.RED}Помилка пакетної перевірки URL:{Style.RESET_ALL} {e}")
+                verdicts = apply_safe_browsing_error(list(batch))
+            self.requests_sent += 1
+            self.urls_checked += len(batch)
+            for canonical_url, future in batch.items():
+                future.set_result(verdicts.get(canonical_url, True))
+
+safe_browsing_batcher = SafeBrowsingBatcher(safe_browsing_batch_window, safe_browsing_batch_size)
+
+def enable_local_safe_browsing(data_dir):
+    global local_safe_browsing
+    local_safe_browsing = LocalSafeBrowsingDB(data_dir)
+    local_safe_browsing.start_sync()
+    return local_safe_browsing
+
+def check_urls(urls):
+    # Вердикти для всіх URL повідомлення: кеш, локальна база префіксів, а решта — спільним пакетним запитом
+    verdicts = []
+    for url in urls:
+        canonical_url, suspicious = get_cached_url_verdict(url)
+        if suspicious is None and local_safe_browsing is not None:
+            suspicious = local_safe_browsing.lookup(canonical_url)
+        verdicts.append(suspicious if suspicious is not None else safe_browsing_batcher.submit(canonical_url))
+    return [wait_url_verdict(verdict) if isinstance(verdict, Future) else verdict for verdict in verdicts]
+
+def wait_url_verdict(future):
+    try:
+        return future.result(safe_browsing_verdict_timeout)
+    except FutureTimeoutError:
+        print(f"{Fore.YELLOW}Вердикт Safe Browsing не надійшов за {safe_browsing_verdict_timeout} с{Style.RESET_ALL}")
         return True
 
+def is_suspicious_url(url):
+    return check_urls([url])[0]
+
 def extract_urls(text):
     url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
     urls = re.findall(url_pattern, text)
@@ -59,212 +272,522 @@ def extract_urls(text):
     potential_urls = re.findall(short_url_pattern, text)
     for potential_url in potential_urls:
         if not potential_url.startswith(('http://', 'https://')):
-            if any(domain in potential_url for domain in ['bit.ly', 'tinyurl.com', 'goo.gl']):
+            if potential_url.split('/', 1)[0].lower().removeprefix('www.') in SHORTENER_HOSTS:
                 urls.append(f"https://{potential_url}")
     return urls
 
-def is_spam_text(text):
-    if not text.strip():
-        return False
-    api_url = f"https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze?key={PERSPECTIVE_API_KEY}"
-    payload = {
+def perspective_payload(text):
+    return {
         "comment": {"text": text},
         "requestedAttributes": {"SPAM": {}, "TOXICITY": {}},
         "languages": ["en"],
     }
+
+def perspective_scores(result):
+    spam_score = result["attributeScores"]["SPAM"]["summaryScore"]["value"]
+    toxicity_score = result["attributeScores"]["TOXICITY"]["summaryScore"]["value"]
+    return spam_score, toxicity_score
+
+def is_spam_score(spam_score, toxicity_score):
+    return spam_score > spam_score_threshold or toxicity_score > toxicity_score_threshold
+
+class PerspectiveUnavailable(Exception):
+    pass
+
+def parse_retry_after(value):
+    if not value:
+        return None
     try:
-        response = requests.post(api_url, json=payload, timeout=5)
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+# Черга запитів до Perspective: спершу нові учасники та користувачі з порушеннями, потім решта повідомлень.
+# Запит, що не почався до свого дедлайну, завершується PerspectiveUnavailable; 429/5xx повторюються
+# з паузою з Retry-After, під час якої черга не надсилає нічого. Однаковий текст у черзі оцінюється один раз
+class PerspectiveGovernor:
+    def __init__(self, qps, concurrency, max_queue, max_retries):
+        self.bucket = TokenBucket(qps, max(1.0, qps))
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.blocked_until = 0.0
+        self.requests_sent = 0
+        self.throttled = 0
+        self.expired = 0
+        self.dequeued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._queue = []  # [(priority, deadline, seq, enqueued_at, attempt, text, key)]; прострочені лишаються до виймання
+        self._deadlines = []  # [(deadline, seq, key)] — купа строків, щоб не переглядати всю чергу
+        self._queued = set()  # seq живих записів у _queue
+        self._seq = itertools.count()
+        self._pending = {}  # {text_hash: Future}
+        self._entries = {}  # {text_hash: кількість записів у черзі та в роботі}
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._threads = []
+
+    def submit(self, text, priority, timeout):
+        key = text_hash(text)
+        now = time.monotonic()
+        with self._lock:
+            if not self._threads:
+                for _ in range(self.concurrency):
+                    thread = threading.Thread(target=self._run, daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+            future = self._pending.get(key)
+            if future is None:
+                future = Future()
+                # Майбутнє спільне для всіх, хто чекає на цей текст: скасування одним не повинне зачепити інших
+                future.set_running_or_notify_cancel()
+                if len(self._queued) >= self.max_queue:
+                    future.set_exception(PerspectiveUnavailable("черга переповнена"))
+                    return future
+                self._pending[key] = future
+            self._entries[key] = self._entries.get(key, 0) + 1
+            self._push_locked((priority, now + timeout, next(self._seq), now, 0, text, key))
+            self._has_work.notify()
+        return future
+
+    def _release_locked(self, key):
+        # Запис для тексту знято з черги; якщо він був останнім, майбутнє більше ніхто не завершить
+        self._entries[key] -= 1
+        if self._entries[key]:
+            return None
+        del self._entries[key]
+        return self._pending.pop(key, None)
+
+    def _push_locked(self, entry):
+        self._queued.add(entry[2])
+        heapq.heappush(self._queue, entry)
+        heapq.heappush(self._deadlines, (entry[1], entry[2], entry[6]))
+
+    def _expire_locked(self, now):
+        # Прострочені записи знімаються з купи строків за O(log n); у черзі пріоритетів вони стають
+        # порожніми місцями, які пропускаються під час виймання
+        abandoned = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, seq, key = heapq.heappop(self._deadlines)
+            if seq not in self._queued:
+                continue
+            self._queued.discard(seq)
+            self.expired += 1
+            future = self._release_locked(key)
+            if future is not None:
+                abandoned.append(future)
+        # Черга з переважно прострочених записів перебудовується, щоб не росла без меж
+        if len(self._queue) > 2 * len(self._queued) + 64:
+            self._queue = [entry for entry in self._queue if entry[2] in self._queued]
+            heapq.heapify(self._queue)
+        while self._queue and self._queue[0][2] not in self._queued:
+            heapq.heappop(self._queue)
+        return abandoned
+
+    def _take(self):
+        with self._has_work:
+            while True:
+                now = time.monotonic()
+                abandoned = self._expire_locked(now)
+                if abandoned:
+                    return None, abandoned
+                if not self._queue:
+                    self._has_work.wait()
+                    continue
+                if self.blocked_until > now:
+                    self._has_work.wait(self.blocked_until - now)
+                    continue
+                wait = self.bucket.try_acquire()
+                if wait:
+                    self._has_work.wait(wait)
+                    continue
+                entry = heapq.heappop(self._queue)
+                self._queued.discard(entry[2])
+                if self._pending.get(entry[6]) is None:
+                    # Текст уже оцінено за іншим записом
+                    self.bucket.refund()
+                    self._release_locked(entry[6])
+                    continue
+                if not entry[4]:
+                    wait = now - entry[3]
+                    self.dequeued += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+                return entry, []
+
+    def _finish(self, key, scores=None, error=None):
+        with self._lock:
+            if error is not None and self._entries[key] > 1:
+                # Цей текст ще чекає в черзі за іншим записом (наприклад, повторна перевірка) — спробує він
+                self._entries[key] -= 1
+                return
+            future = self._pending.pop(key, None)
+            self._release_locked(key)
+        if future is not None:
+            if error is None:
+                future.set_result(scores)
+            else:
+                future.set_exception(error)
+
+    def _retry(self, entry, delay, error):
+        priority, deadline, seq, enqueued_at, attempt, text, key = entry
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            if attempt < self.max_retries and time.monotonic() + delay < deadline:
+                self._push_locked((priority, deadline, seq, enqueued_at, attempt + 1, text, key))
+                self._has_work.notify_all()
+                return
+        self._finish(key, error=error)
+
+    def _request(self, entry):
+        priority, deadline, seq, enqueued_at, attempt, text, key = entry
+        api_url = f"{PERSPECTIVE_API_URL}?key={PERSPECTIVE_API_KEY}"
+        self.requests_sent += 1
+        try:
+            response = http_client.post('perspective', api_url, json=perspective_payload(text),
+                                        timeout=max(deadline - time.monotonic(), 1.0))
+        except HttpError as e:
+            print(f"{Fore.RED}Помилка перевірки тексту:{Style.RESET_ALL} '{text}' - {e}")
+            self._retry(entry, perspective_retry_delay * 2 ** attempt, PerspectiveUnavailable(str(e)))
+            return
         if response.status_code == 200:
-            result = response.json()
-            spam_score = result["attributeScores"]["SPAM"]["summaryScore"]["value"]
-            toxicity_score = result["attributeScores"]["TOXICITY"]["summaryScore"]["value"]
-            print(f"{Fore.CYAN}Perspective API:{Style.RESET_ALL} Текст: '{text}' | SPAM={spam_score:.2f} | TOXICITY={toxicity_score:.2f}")
-            return spam_score > 0.75 or toxicity_score > 0.65
-        else:
-            print(f"{Fore.YELLOW}Помилка Perspective API:{Style.RESET_ALL} {response.status_code} - {response.text}")
-            return False
-    except requests.RequestException as e:
-        print(f"{Fore.RED}Помилка перевірки тексту:{Style.RESET_ALL} '{text}' - {e}")
+            try:
+                scores = perspective_scores(response.json())
+            except (ValueError, KeyError) as e:
+                self._finish(key, error=PerspectiveUnavailable(f"некоректна відповідь: {e}"))
+                return
+            text_score_cache.set(text, *scores)
+            self._finish(key, scores)
+            return
+        print(f"{Fore.YELLOW}Помилка Perspective API:{Style.RESET_ALL} {response.status_code} - {response.text}")
+        error = PerspectiveUnavailable(f"{response.status_code}")
+        if response.status_code not in RETRYABLE_STATUSES:
+            self._finish(key, error=error)
+            return
+        if response.status_code == 429:
+            self.throttled += 1
+        delay = parse_retry_after(response.headers.get('Retry-After'))
+        self._retry(entry, perspective_retry_delay * 2 ** attempt if delay is None else delay, error)
+
+    def _run(self):
+        while True:
+            entry, abandoned = self._take()
+            for future in abandoned:
+                future.set_exception(PerspectiveUnavailable("минув дедлайн у черзі"))
+            if entry is not None:
+                try:
+                    self._request(entry)
+                except Exception as e:
+                    self._finish(entry[6], error=PerspectiveUnavailable(str(e)))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': len(self._queued),
+                'requests': self.requests_sent,
+                'throttled': self.throttled,
+                'expired': self.expired,
+                'avg_wait': self.total_wait / self.dequeued if self.dequeued else 0.0,
+                'max_wait': self.max_wait
+            }
+
+perspective_governor = PerspectiveGovernor(perspective_qps, perspective_concurrency, perspective_max_queue,
+                                           perspective_max_retries)
+
+def enable_prefilter(model_path):
+    # NumPy потрібен лише з увімкненим фільтром, тож імпорт тут
+    global prefilter
+    from prefilter import PrefilterModel
+    prefilter = PrefilterModel.load(model_path)
+    print(f"{Fore.GREEN}Локальний фільтр:{Style.RESET_ALL} {model_path} | невизначена смуга [{prefilter.low:.2f}, {prefilter.high:.2f})")
+    return prefilter
+
+def message_priority(user_id):
+    # Користувачі з порушеннями — низька репутація, їхні повідомлення оцінюються першими
+    return PRIORITY_SUSPECT if get_violations(user_id) else PRIORITY_MESSAGE
+
+def get_text_scores(text, priority=PRIORITY_MESSAGE, deadline=perspective_message_deadline):
+    # Оцінки Perspective для тексту; однаковий (після нормалізації) текст не надсилається вдруге.
+    # None — якщо оцінку не вдалося отримати до дедлайну
+    scores = text_score_cache.get(text)
+    if scores is not None:
+        return scores
+    try:
+        return perspective_governor.submit(text, priority, deadline).result(deadline + 1)
+    except (PerspectiveUnavailable, FutureTimeoutError) as e:
+        print(f"{Fore.YELLOW}Perspective API недоступне:{Style.RESET_ALL} '{text}' - {e}")
+        return None
+
+def get_text_scores_batch(texts, priority=PRIORITY_MESSAGE, deadline=perspective_message_deadline):
+    # Усі тексти стають у чергу одразу й чекають спільного дедлайну: {text: (spam, toxicity) | None}
+    scores = {text: text_score_cache.get(text) for text in set(texts)}
+    futures = {text: perspective_governor.submit(text, priority, deadline) for text, cached in scores.items() if cached is None}
+    expires_at = time.monotonic() + deadline + 1
+    for text, future in futures.items():
+        try:
+            scores[text] = future.result(max(expires_at - time.monotonic(), 0))
+        except (PerspectiveUnavailable, FutureTimeoutError):
+            pass
+    return scores
+
+def prefilter_verdict(text):
+    # Впевнений вердикт локальної моделі або None, якщо текст треба віддати Perspective
+    if prefilter is None:
+        return None
+    verdict = prefilter.verdict(text)
+    if verdict is not None:
+        print(f"{Fore.CYAN}Локальний фільтр:{Style.RESET_ALL} Текст: '{text}' | {'спам' if verdict else 'чисте'}")
+    return verdict
+
+def is_spam_text(text, priority=PRIORITY_MESSAGE):
+    # True/False — вердикт; None — оцінки немає (квота, помилки API)
+    if not text.strip():
         return False
+    verdict = prefilter_verdict(text)
+    if verdict is not None:
+        return verdict
+    scores = get_text_scores(text, priority)
+    if scores is None:
+        return None
+    spam_score, toxicity_score = scores
+    print(f"{Fore.CYAN}Perspective API:{Style.RESET_ALL} Текст: '{text}' | SPAM={spam_score:.2f} | TOXICITY={toxicity_score:.2f}")
+    return is_spam_score(spam_score, toxicity_score)
+
+def delete_message(bot, chat_id, message_id):
+    try:
+        bot.deleteMessage((chat_id, message_id))
+        print(f"{Fore.YELLOW}Повідомлення видалено:{Style.RESET_ALL} {message_id}")
+    except Exception as e:
+        print(f"{Fore.RED}Помилка видалення:{Style.RESET_ALL} {e}")
+
+def delete_messages(bot, chat_id, message_ids):
+    try:
+        bot.deleteMessages(chat_id, message_ids)
+        print(f"{Fore.YELLOW}Повідомлення видалено:{Style.RESET_ALL} {', '.join(map(str, message_ids))}")
+    except Exception as e:
+        print(f"{Fore.RED}Помилка видалення:{Style.RESET_ALL} {e}")
+
+def purge_user_messages(bot, chat_id, user_id, message_id):
+    # Разом із порушенням зникають недавні повідомлення порушника в цьому чаті — одним запитом
+    delete_messages(bot, chat_id, sorted(set(take_recent_messages(chat_id, user_id)) | {message_id}))
+
+def format_notice(notice, msg, user_id, hours, chat_title, **notice_args):
+    user = f"[{get_username(msg)}](tg://user?id={user_id})"
+    return notice.format(user=user, hours=hours, chat_title=chat_title, **notice_args)
+
+def log_mute(event, msg, chat_id, chat_title, user_id, details, hours):
+    logging.info(
+        event,
+        extra={
+            'chat_id': chat_id,
+            'chat_title': chat_title,
+            'user_id': user_id,
+            'username': get_username(msg),
+            'details': f"{details} - Timeout: {hours} hours"
+        }
+    )
+
+def mute_for_violation(bot, msg, chat_id, user_id, notice, event, details, purge=False, **notice_args):
+    # Спільний шлях покарання: ескалація таймауту, мут, оголошення в чаті та запис у лог.
+    # purge — разом із мутом видалити недавні повідомлення порушника; адміністраторів це не торкається,
+    # а в уже заглушеного користувача зникає лише нове повідомлення
+    timeout = get_timeout(increment_violations(user_id))
+    if is_admin(bot, chat_id, user_id):
+        return
+    if is_user_muted(bot, chat_id, user_id):
+        if purge:
+            delete_message(bot, chat_id, msg['message_id'])
+        return
+    if purge:
+        purge_user_messages(bot, chat_id, user_id, msg['message_id'])
+    until_date = int(time.time()) + timeout
+    hours = timeout // 3600
+    try:
+        restriction = restrict_member(bot, chat_id, user_id, until_date=until_date)
+        remember_mute(user_id, chat_id, until_date)
+        on_failure(restriction, forget_mute, user_id)
+        chat_title = get_chat_title(bot, chat_id)
+        bot.sendNotice(chat_id, format_notice(notice, msg, user_id, hours, chat_title, **notice_args),
+                       parse_mode='Markdown')
+        log_mute(event, msg, chat_id, chat_title, user_id, details, hours)
+    except Exception as e:
+        print(f"{Fore.RED}Помилка обмеження:{Style.RESET_ALL} {e}")
 
 def handle_suspicious_links(bot, msg, chat_id, user_id):
-    chat_title = get_chat_title(bot, chat_id)
     text = msg.get('text', '')
     urls = extract_urls(text)
     if urls:
-        for url in urls:
-            final_url = resolve_shortened_url(url)
-            suspicious = is_suspicious_url(final_url)
+        chains = [resolve_redirect_chain(url) for url in urls]
+        verdicts = chain_verdicts(chains, check_urls([url for chain in chains for url in chain]))
+        for final_url, suspicious in zip([chain[-1] for chain in chains], verdicts):
             print(f"{Fore.CYAN}Аналіз:{Style.RESET_ALL} Текст: '{text}' | URL: {final_url} | Підозрілий: {Fore.RED if suspicious else Fore.GREEN}{'Так' if suspicious else 'Ні'}{Style.RESET_ALL}")
             if suspicious:
-                try:
-                    bot.deleteMessage((chat_id, msg['message_id']))
-                    print(f"{Fore.YELLOW}Повідомлення видалено:{Style.RESET_ALL} {msg['message_id']}")
-                except Exception as e:
-                    print(f"{Fore.RED}Помилка видалення:{Style.RESET_ALL} {e}")
-
-                violations = get_violations(user_id)
-                update_violations(user_id)
-                timeout = timeout_stages[violations] if violations < len(timeout_stages) else timeout_stages[-1]
-
-                if not is_admin(bot, chat_id, user_id) and not is_user_muted(bot, chat_id, user_id):
-                    try:
-                        bot.restrictChatMember(
-                            chat_id, user_id,
-                            until_date=int(time.time()) + timeout,
-                            can_send_messages=False,
-                            can_send_media_messages=False,
-                            can_send_other_messages=False,
-                            can_add_web_page_previews=False
-                        )
-                        muted_users[user_id] = {'chat_id': chat_id, 'until_date': int(time.time()) + timeout}
-                        bot.sendMessage(chat_id,
-                                        f"🔗 [{get_username(msg)}](tg://user?id={user_id}) отримав таймаут на {timeout // 3600} годин у '{chat_title}' за підозріле посилання: {final_url}!",
-                                        parse_mode='Markdown')
-                        logging.info(
-                            "Suspicious link: User muted",
-                            extra={
-                                'chat_id': chat_id,
-                                'chat_title': chat_title,
-                                'user_id': user_id,
-                                'username': get_username(msg),
-                                'details': f"Message: {text} - URL: {final_url} - Timeout: {timeout // 3600} hours"
-                            }
-                        )
-                    except Exception as e:
-                        print(f"{Fore.RED}Помилка обмеження:{Style.RESET_ALL} {e}")
+                mute_for_violation(bot, msg, chat_id, user_id, LINK_NOTICE, "Suspicious link: User muted",
+                                   f"Message: {text} - URL: {final_url}", purge=True, url=final_url)
                 return True
     else:
         print(f"{Fore.CYAN}Аналіз:{Style.RESET_ALL} Текст: '{text}' | URL: Немає | Підозрілий: {Fore.GREEN}Ні{Style.RESET_ALL}")
     return False
 
 
+def punish_spam_text(bot, msg, chat_id, user_id):
+    text = msg.get('text', '')
+    mute_for_violation(bot, msg, chat_id, user_id, SPAM_TEXT_NOTICE, "Spam text: User muted", f"Message: {text}",
+                       purge=True)
+
+def recheck_spam_text(bot, msg, chat_id, user_id):
+    # Оцінка не встигла до дедлайну: повідомлення не вважається чистим, а стає в кінець черги й
+    # видаляється заднім числом, якщо Perspective визнає його спамом
+    text = msg.get('text', '')
+    print(f"{Fore.YELLOW}Перевірку відкладено:{Style.RESET_ALL} '{text}'")
+
+    def on_scores(future):
+        if future.exception() is not None:
+            print(f"{Fore.RED}Повідомлення лишилось неперевіреним:{Style.RESET_ALL} '{text}' - {future.exception()}")
+            return
+        if is_spam_score(*future.result()):
+            punish_spam_text(bot, msg, chat_id, user_id)
+
+    perspective_governor.submit(text, PRIORITY_RECHECK, perspective_recheck_deadline).add_done_callback(on_scores)
+
 def handle_spam_text(bot, msg, chat_id, user_id):
-    chat_title = get_chat_title(bot, chat_id)
     text = msg.get('text', '')
-    is_spam = is_spam_text(text)
+    is_spam = is_spam_text(text, message_priority(user_id))
+    if is_spam is None:
+        recheck_spam_text(bot, msg, chat_id, user_id)
+        return False
     print(
         f"{Fore.CYAN}Аналіз тексту:{Style.RESET_ALL} '{text}' | Спам/Токсичність: {Fore.RED if is_spam else Fore.GREEN}{'Так' if is_spam else 'Ні'}{Style.RESET_ALL}")
 
     if is_spam:
-        try:
-            bot.deleteMessage((chat_id, msg['message_id']))
-            print(f"{Fore.YELLOW}Повідомлення видалено:{Style.RESET_ALL} {msg['message_id']}")
-        except Exception as e:
-            print(f"{Fore.RED}Помилка видалення:{Style.RESET_ALL} {e}")
-
-        violations = get_violations(user_id)
-        update_violations(user_id)
-        timeout = timeout_stages[violations] if violations < len(timeout_stages) else timeout_stages[-1]
-
-        if not is_admin(bot, chat_id, user_id) and not is_user_muted(bot, chat_id, user_id):
-            try:
-                bot.restrictChatMember(
-                    chat_id, user_id,
-                    until_date=int(time.time()) + timeout,
-                    can_send_messages=False,
-                    can_send_media_messages=False,
-                    can_send_other_messages=False,
-                    can_add_web_page_previews=False
-                )
-                muted_users[user_id] = {'chat_id': chat_id, 'until_date': int(time.time()) + timeout}
-                bot.sendMessage(chat_id,
-                                f"📢 [{get_username(msg)}](tg://user?id={user_id}) отримав таймаут на {timeout // 3600} годин за спам або шкідливий вміст!",
-                                parse_mode='Markdown')
-                logging.info(
-                    "Spam text: User muted",
-                    extra={
-                        'chat_id': chat_id,
-                        'chat_title': chat_title,
-                        'user_id': user_id,
-                        'username': get_username(msg),
-                        'details': f"Message: {text} - Timeout: {timeout // 3600} hours"
-                    }
-                )
-            except Exception as e:
-                print(f"{Fore.RED}Помилка обмеження:{Style.RESET_ALL} {e}")
+        punish_spam_text(bot, msg, chat_id, user_id)
         return True
     return False
 
 
 def handle_spam(bot, msg, chat_id, user_id):
-    chat_title = get_chat_title(bot, chat_id)
     text = msg.get('text', '')
-    if check_spam(user_id, spam_time_limit, spam_max_messages):
-        bot.deleteMessage((chat_id, msg['message_id']))
-        violations = get_violations(user_id)
-        update_violations(user_id)
-        timeout = timeout_stages[violations] if violations < len(timeout_stages) else timeout_stages[-1]
-
-        if not is_admin(bot, chat_id, user_id) and not is_user_muted(bot, chat_id, user_id):
-            bot.restrictChatMember(
-                chat_id, user_id,
-                until_date=int(time.time()) + timeout,
-                can_send_messages=False,
-                can_send_media_messages=False,
-                can_send_other_messages=False,
-                can_add_web_page_previews=False
-            )
-            muted_users[user_id] = {'chat_id': chat_id, 'until_date': int(time.time()) + timeout}
-            bot.sendMessage(chat_id,
-                            f"🔇 [{get_username(msg)}](tg://user?id={user_id}) отримав таймаут за спам на {timeout // 3600} годин у '{chat_title}'!",
-                            parse_mode='Markdown')
-            logging.info(
-                "Spam: User muted",
-                extra={
-                    'chat_id': chat_id,
-                    'chat_title': chat_title,
-                    'user_id': user_id,
-                    'username': get_username(msg),
-                    'details': f"Message: {text} - Timeout: {timeout // 3600} hours"
-                }
-            )
+    if check_spam(chat_id, user_id):
+        mute_for_violation(bot, msg, chat_id, user_id, SPAM_NOTICE, "Spam: User muted", f"Message: {text}", purge=True)
         return True
     return False
 
 
 def handle_curse_words(bot, msg, chat_id, user_id):
-    chat_title = get_chat_title(bot, chat_id)
-    curse_words = load_curse_words("curse_words.json")
     text = msg.get('text', '').lower()
 
-    if check_for_curse_words(text, curse_words):
-        bot.deleteMessage((chat_id, msg['message_id']))
-        violations = get_violations(user_id)
-        update_violations(user_id)
-        timeout = timeout_stages[violations] if violations < len(timeout_stages) else timeout_stages[-1]
-
-        if not is_admin(bot, chat_id, user_id) and not is_user_muted(bot, chat_id, user_id):
-            bot.restrictChatMember(
-                chat_id, user_id,
-                until_date=int(time.time()) + timeout,
-                can_send_messages=False,
-                can_send_media_messages=False,
-                can_send_other_messages=False,
-                can_add_web_page_previews=False
-            )
-            muted_users[user_id] = {'chat_id': chat_id, 'until_date': int(time.time()) + timeout}
-            bot.sendMessage(chat_id,
-                            f"🔇 [{get_username(msg)}](tg://user?id={user_id}) отримав таймаут на {timeout // 3600} годин за використання ненормативної лексики!",
-                            parse_mode='Markdown')
-            logging.info(
-                "Curse words: User muted",
-                extra={
-                    'chat_id': chat_id,
-                    'chat_title': chat_title,
-                    'user_id': user_id,
-                    'username': get_username(msg),
-                    'details': f"Message: {text} - Timeout: {timeout // 3600} hours"
-                }
-            )
+    if check_for_curse_words(text):
+        delete_message(bot, chat_id, msg['message_id'])
+        mute_for_violation(bot, msg, chat_id, user_id, CURSE_NOTICE, "Curse words: User muted", f"Message: {text}")
         return True
     return False
 
 
+def handle_near_duplicates(bot, msg, chat_id, user_id):
+    # Майже однаковий текст від кількох різних акаунтів — скоординована розсилка; разом із повідомленням
+    # видаляються й попередні копії в цьому чаті
+    text = msg.get('text', '')
+    if text.startswith('/'):
+        return False
+    copies = near_duplicate_index.check(chat_id, user_id, msg['message_id'], text)
+    if copies is None:
+        return False
+    print(f"{Fore.CYAN}Масова розсилка:{Style.RESET_ALL} '{text}' | копій у чаті: {len(copies)}")
+    # Копії розсилки зникають завжди, а історія самого відправника — лише разом із мутом
+    delete_messages(bot, chat_id, sorted(copies))
+    mute_for_violation(bot, msg, chat_id, user_id, DUPLICATE_NOTICE, "Near-duplicate spam: User muted", f"Message: {text}",
+                       purge=True)
+    return True
+
+
+def get_chat_admins(bot, chat_id):
+    # Один getChatAdministrators на чат замість getChatMember для кожної перевірки
+    admins = chat_admins_cache.get(chat_id)
+    if admins is None:
+        admins = {admin['user']['id']: admin for admin in bot.getChatAdministrators(chat_id)}
+        chat_admins_cache.set(chat_id, admins)
+        for admin_id, admin in admins.items():
+            member_status_cache.set((chat_id, admin_id), admin)
+    return admins
+
+
+def get_chat_member(bot, chat_id, user_id):
+    member = member_status_cache.get((chat_id, user_id))
+    if member is None:
+        member = bot.getChatMember(chat_id, user_id)
+        member_status_cache.set((chat_id, user_id), member)
+    return member
+
+
+def remember_member_status(chat_id, user_id, status, can_send_messages, until_date=None):
+    member_status_cache.set((chat_id, user_id), {
+        'user': {'id': user_id, 'is_bot': False},
+        'status': status,
+        'can_send_messages': can_send_messages,
+        'until_date': until_date or 0
+    })
+
+
+def handle_chat_member_update(update):
+    # chat_member / my_chat_member містять актуальний статус, тож записуємо його замість повторного запиту
+    chat_id = update['chat']['id']
+    new_member = update['new_chat_member']
+    user_id = new_member['user']['id']
+    member_status_cache.set((chat_id, user_id), new_member)
+    old_status = update.get('old_chat_member', {}).get('status')
+    if {old_status, new_member.get('status')} & {'administrator', 'creator'}:
+        chat_admins_cache.invalidate(chat_id)
+
+
+def on_failure(result, callback, *args):
+    # Дії з черги повертають Future, що не кидає винятків в обробнику: стан, записаний наперед,
+    # скасовується, якщо Telegram відхилив дію
+    if isinstance(result, Future):
+        def check(future):
+            if future.exception() is not None:
+                callback(*args)
+        result.add_done_callback(check)
+    return result
+
+
+def restrict_member(bot, chat_id, user_id, until_date=None):
+    result = bot.restrictChatMember(
+        chat_id, user_id,
+        until_date=until_date,
+        can_send_messages=False,
+        can_send_media_messages=False,
+        can_send_other_messages=False,
+        can_add_web_page_previews=False
+    )
+    remember_member_status(chat_id, user_id, 'restricted', False, until_date)
+    return on_failure(result, member_status_cache.invalidate, (chat_id, user_id))
+
+
+def lift_restrictions(bot, chat_id, user_id):
+    bot.restrictChatMember(
+        chat_id, user_id,
+        can_send_messages=True,
+        can_send_media_messages=True,
+        can_send_other_messages=True,
+        can_add_web_page_previews=True
+    )
+    remember_member_status(chat_id, user_id, 'member', True)
+
+
+def kick_member(bot, chat_id, user_id):
+    result = bot.kickChatMember(chat_id, user_id)
+    remember_member_status(chat_id, user_id, 'kicked', False)
+    return on_failure(result, member_status_cache.invalidate, (chat_id, user_id))
+
+
 def is_admin(bot, chat_id, user_id):
     try:
-        member = bot.getChatMember(chat_id, user_id)
-        return member['status'] in ['administrator', 'creator']
+        return user_id in get_chat_admins(bot, chat_id)
     except telepot.exception.TelegramError as e:
         print(f"{Fore.RED}Помилка при перевірці адміністратора:{Style.RESET_ALL} {e}")
         return False
@@ -272,7 +795,7 @@ def is_admin(bot, chat_id, user_id):
 
 def is_user_muted(bot, chat_id, user_id):
     try:
-        member = bot.getChatMember(chat_id, user_id)
+        member = get_chat_member(bot, chat_id, user_id)
         return member.get('status') == 'restricted' and not member.get('can_send_messages', True)
     except Exception as e:
         print(f"{Fore.RED}Помилка при перевірці статусу користувача:{Style.RESET_ALL} {e}")
@@ -1,8 +1,13 @@
 import telepot
-from utils import get_violations, update_violations, reset_violations, decrement_violations, get_username, \
-    add_curse_word, load_curse_words, can_report, logging, user_last_reports, muted_users, get_chat_title
-from checks import is_admin, timeout_stages, is_user_muted
+from utils import increment_violations, reset_violations, decrement_violations, get_username, \
+    add_curse_word, get_curse_matcher, can_report, logging, user_last_reports, muted_users, remember_mute, forget_mute, \
+    get_chat_title, flood_detector
+from checks import is_admin, get_timeout, is_user_muted, get_chat_admins, get_chat_member, restrict_member, \
+    lift_restrictions, kick_member, on_failure
 import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+ban_result_timeout = 10  # Скільки /ban чекає на відповідь Telegram, перш ніж звільнити потік, секунди
 
 
 def handle_ban_command(bot, msg, chat_id, user_id):
@@ -21,13 +26,10 @@ def handle_ban_command(bot, msg, chat_id, user_id):
                 return
 
             user_to_ban_username = get_username(reply_message)
-            try:
-                bot.kickChatMember(chat_id, user_to_ban_id)
-                bot.sendMessage(chat_id, f"🚫 [{user_to_ban_username}](tg://user?id={user_to_ban_id}) був забанений!",
-                                parse_mode='Markdown')
+
+            def banned():
                 reset_violations(user_to_ban_id)
-                if user_to_ban_id in muted_users:
-                    del muted_users[user_to_ban_id]  # Видаляємо з muted_users при банні
+                forget_mute(user_to_ban_id)  # Видаляємо з muted_users при банні
                 logging.info(
                     "Ban: User banned",
                     extra={
@@ -38,6 +40,21 @@ def handle_ban_command(bot, msg, chat_id, user_id):
                         'details': f"Message: {reply_message.get('text', 'N/A')}"
                     }
                 )
+
+            ban = kick_member(bot, chat_id, user_to_ban_id)
+            try:
+                ban.result(ban_result_timeout)  # Чекаємо, щоб повідомити про брак прав
+                bot.sendMessage(chat_id, f"🚫 [{user_to_ban_username}](tg://user?id={user_to_ban_id}) був забанений!",
+                                parse_mode='Markdown')
+                banned()
+            except FutureTimeoutError:
+                # Чат призупинено через ліміт Telegram: бан лишається в черзі, облік — коли він виконається
+                def on_done(future):
+                    if future.exception() is None:
+                        banned()
+                ban.add_done_callback(on_done)
+                bot.sendMessage(chat_id, "⏳ Telegram тимчасово обмежив запити, бан буде виконано найближчим часом.",
+                                reply_to_message_id=msg['message_id'])
             except Exception as e:
                 print(f"Error banning user: {e}")
                 bot.sendMessage(chat_id, "У мене немає прав на бан цього користувача.",
@@ -66,23 +83,15 @@ def handle_mute_command(bot, msg, chat_id, user_id):
                 return
 
             user_to_mute_username = get_username(reply_message)
-            restrict_info = bot.getChatMember(chat_id, user_to_mute_id)
+            restrict_info = get_chat_member(bot, chat_id, user_to_mute_id)
 
             if restrict_info['status'] in ['member', 'administrator', 'creator']:
-                violations = get_violations(user_to_mute_id)
-                update_violations(user_to_mute_id)
-                timeout = timeout_stages[violations] if violations < len(timeout_stages) else timeout_stages[-1]
-
-                bot.restrictChatMember(
-                    chat_id, user_to_mute_id,
-                    until_date=int(time.time()) + timeout,
-                    can_send_messages=False,
-                    can_send_media_messages=False,
-                    can_send_other_messages=False,
-                    can_add_web_page_previews=False
-                )
-                muted_users[user_to_mute_id] = {'chat_id': chat_id,
-                                                'until_date': int(time.time()) + timeout}  # Додаємо до muted_users
+                timeout = get_timeout(increment_violations(user_to_mute_id))
+
+                until_date = int(time.time()) + timeout
+                restriction = restrict_member(bot, chat_id, user_to_mute_id, until_date=until_date)
+                remember_mute(user_to_mute_id, chat_id, until_date)  # Додаємо до muted_users
+                on_failure(restriction, forget_mute, user_to_mute_id)
                 bot.sendMessage(chat_id,
                                 f"🔇 [{user_to_mute_username}](tg://user?id={user_to_mute_id}) отримав таймаут на {timeout // 3600} годин!",
                                 parse_mode='Markdown')
@@ -124,24 +133,15 @@ def handle_unmute_command(bot, msg, chat_id, user_id):
                 return
 
             user_to_unmute_username = get_username(reply_message)
-            restrict_info = bot.getChatMember(chat_id, user_to_unmute_id)
+            restrict_info = get_chat_member(bot, chat_id, user_to_unmute_id)
 
             if restrict_info['status'] not in ['member', 'administrator', 'creator']:
-                bot.restrictChatMember(
-                    chat_id, user_to_unmute_id,
-                    can_send_messages=True,
-                    can_send_media_messages=True,
-                    can_send_other_messages=True,
-                    can_add_web_page_previews=True
-                )
-                if user_to_unmute_id in muted_users:
-                    del muted_users[user_to_unmute_id]  # Видаляємо з muted_users при розмуті
+                lift_restrictions(bot, chat_id, user_to_unmute_id)
+                forget_mute(user_to_unmute_id)  # Видаляємо з muted_users при розмуті
                 bot.sendMessage(chat_id,
                                 f"✅ [{user_to_unmute_username}](tg://user?id={user_to_unmute_id}) більше не має обмежень!",
                                 parse_mode='Markdown')
-                violations = get_violations(user_to_unmute_id)
-                if violations > 0:
-                    decrement_violations(user_to_unmute_id)
+                decrement_violations(user_to_unmute_id)
                 logging.info(
                     "Unmute: User unmuted",
                     extra={
@@ -171,9 +171,7 @@ def handle_add_curse_word_command(bot, msg, chat_id, user_id):
             return
 
         word = parts[1].strip()
-        curse_words = load_curse_words("curse_words.json")
-
-        if word.lower() in curse_words:
+        if word in get_curse_matcher():
             bot.sendMessage(chat_id, f"Слово '{word}' вже є в списку лайливих слів.",
                             reply_to_message_id=msg['message_id'])
             return
@@ -195,6 +193,42 @@ def handle_add_curse_word_command(bot, msg, chat_id, user_id):
         bot.sendMessage(chat_id, f"❌ Ви не є адміністратором чату '{chat_title}'.", reply_to_message_id=msg['message_id'])
 
 
+def handle_flood_limit_command(bot, msg, chat_id, user_id):
+    chat_title = get_chat_title(bot, chat_id)
+    if is_admin(bot, chat_id, user_id):
+        parts = msg.get('text', '').split()
+        if len(parts) == 1:
+            seconds, messages = flood_detector.get_limits(chat_id)
+            bot.sendMessage(chat_id, f"Поточний ліміт: {messages} повідомлень за {seconds} секунд.\n"
+                                     f"Змінити: /flood_limit <повідомлень> <секунд>", reply_to_message_id=msg['message_id'])
+            return
+        try:
+            messages, seconds = int(parts[1]), int(parts[2])
+            if messages < 1 or seconds < 1:
+                raise ValueError
+        except (IndexError, ValueError):
+            bot.sendMessage(chat_id, "Використання: /flood_limit <повідомлень> <секунд>, обидва числа більші за нуль.",
+                            reply_to_message_id=msg['message_id'])
+            return
+
+        flood_detector.set_limits(chat_id, seconds, messages)
+        bot.sendMessage(chat_id, f"✅ Новий ліміт флуду для '{chat_title}': {messages} повідомлень за {seconds} секунд.",
+                        reply_to_message_id=msg['message_id'])
+        logging.info(
+            "Flood limit changed",
+            extra={
+                'chat_id': chat_id,
+                'chat_title': chat_title,
+                'user_id': user_id,
+                'username': get_username(msg),
+                'details': f"Messages: {messages}, Seconds: {seconds}"
+            }
+        )
+    else:
+        bot.deleteMessage((chat_id, msg['message_id']))
+        bot.sendMessage(chat_id, f"❌ Ви не є адміністратором чату '{chat_title}'.", reply_to_message_id=msg['message_id'])
+
+
 def handle_report_command(bot, msg, chat_id, user_id):
     chat_title = get_chat_title(bot, chat_id)
     if 'reply_to_message' in msg:
@@ -204,10 +238,10 @@ def handle_report_command(bot, msg, chat_id, user_id):
         reported_message_id = reply_message['message_id']
 
         if can_report(user_id):
-            admins = bot.getChatAdministrators(chat_id)
+            admins = get_chat_admins(bot, chat_id).values()
             for admin in admins:
                 admin_id = admin['user']['id']
-                if not bot.getChatMember(chat_id, admin_id)['user']['is_bot']:
+                if not admin['user']['is_bot']:
                     bot.forwardMessage(admin_id, chat_id, reported_message_id)
             bot.sendMessage(chat_id,
                             f"✅ Репорт від [{get_username(msg)}](tg://user?id={user_id}) надіслано адміністраторам чату '{chat_title}'. Повідомлення від [{reported_username}](tg://user?id={reported_user_id}) розглядається.",
@@ -245,7 +279,7 @@ def handle_appeal_command(bot, msg, chat_id, user_id):
 
     # Обмеження на частоту звернень (раз на 10 хвилин)
     current_time = time.time()
-    if user_id in user_last_reports and (current_time - user_last_reports[user_id] < 600):
+    if current_time - user_last_reports.get(user_id, 0) < 600:
         bot.sendMessage(chat_id or user_id, "❌ Ви можете подавати апеляцію не частіше ніж раз на 10 хвилин.",
                         parse_mode='Markdown', reply_to_message_id=msg['message_id'] if chat_id else None)
         return
@@ -259,10 +293,10 @@ def handle_appeal_command(bot, msg, chat_id, user_id):
             return
 
         # Надсилаємо апеляцію адміністраторам
-        admins = bot.getChatAdministrators(chat_id)
+        admins = get_chat_admins(bot, chat_id).values()
         for admin in admins:
             admin_id = admin['user']['id']
-            if not bot.getChatMember(chat_id, admin_id)['user']['is_bot']:
+            if not admin['user']['is_bot']:
                 try:
                     bot.sendMessage(admin_id, f"{appeal_message} (Чат: {chat_title})", parse_mode='Markdown')
                 except Exception as e:
@@ -284,13 +318,14 @@ def handle_appeal_command(bot, msg, chat_id, user_id):
             }
         )
     else:  # Якщо команда з приватного чату
-        muted_chat_id = muted_users.get(user_id, {}).get('chat_id')
+        muted = muted_users.get(user_id)
+        muted_chat_id = muted.chat_id if muted else None
         if muted_chat_id and is_user_muted(bot, muted_chat_id, user_id):
             chat_title = get_chat_title(bot, muted_chat_id)
-            admins = bot.getChatAdministrators(muted_chat_id)
+            admins = get_chat_admins(bot, muted_chat_id).values()
             for admin in admins:
                 admin_id = admin['user']['id']
-                if not bot.getChatMember(muted_chat_id, admin_id)['user']['is_bot']:
+                if not admin['user']['is_bot']:
                     try:
                         bot.sendMessage(admin_id, f"{appeal_message} (Чат: {chat_title})", parse_mode='Markdown')
                     except Exception as e:
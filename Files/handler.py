@@ -1,84 +1,176 @@
+import os
 import time
 import threading
-import requests
-from utils import load_curse_words, check_for_curse_words, get_username, logging, PERSPECTIVE_API_KEY, get_chat_title
-from commands import handle_ban_command, handle_mute_command, handle_unmute_command, handle_add_curse_word_command, handle_report_command, handle_appeal_command
-from checks import handle_spam, handle_curse_words, is_admin, is_user_muted, handle_suspicious_links, handle_spam_text
+import zlib
+import traceback
+from collections import deque
+from utils import check_for_curse_words, get_username, logging, get_chat_title, remember_chat_title, invalidate_chat_title, state_journal, restore_mutes, \
+    remember_message, member_status_cache, KeyedWorkerPool
+from commands import handle_ban_command, handle_mute_command, handle_unmute_command, handle_add_curse_word_command, handle_report_command, handle_appeal_command, \
+    handle_flood_limit_command
+from checks import handle_spam, handle_curse_words, handle_near_duplicates, is_admin, is_user_muted, handle_suspicious_links, handle_spam_text, \
+    restrict_member, lift_restrictions, kick_member, handle_chat_member_update, get_text_scores, get_text_scores_batch, is_spam_score, \
+    text_score_cache, perspective_governor, PRIORITY_NEW_USER, perspective_new_user_deadline
+from http_client import http_client
+import checks
+from state_store import state_store, PendingVerification
+from scheduler import scheduler
+from outbound import OutboundBot, outbound_queue
 from colorama import init, Fore, Style
 
 # Ініціалізація colorama
 init()
 
+RULES_FILE = "chat_rules.txt"
+RULES_DIR = "chat_rules"  # Власні правила чату: chat_rules/<chat_id>.txt, інакше спільний chat_rules.txt
 rules_interval = 600
-rules_thread_started = False
-new_user_restrictions = {}
+polling_timeout = 20
+worker_threads = 8
+max_pending_updates = 1000
+pool_stats_interval = 60
+worker_pool = KeyedWorkerPool(worker_threads, max_pending_updates)
+# chat_member не надсилається Telegram без явного запиту, а потрібен для інвалідації кешу статусів
+allowed_updates = ['message', 'edited_message', 'chat_member', 'my_chat_member']
+verification_timeout = 300  # Скільки новий учасник має, щоб написати 'Я не бот', секунди
+# Без TTL: перевірка закінчується лише кіком або підтвердженням, навіть якщо бот довго був вимкнений
+new_user_restrictions = state_store.create_map('new_user_restrictions', ttl=None, maxsize=None)
+state_journal.track(new_user_restrictions, PendingVerification)
+raid_join_window = 60  # Вікно підрахунку приєднань, секунди
+raid_join_threshold = 10  # Стільки приєднань за вікно вмикає режим рейду
+raid_exit_threshold = 3  # Менше стількох приєднань за вікно — рейд закінчився
+raid_batch_interval = 5.0  # Як часто обробляти накопичених учасників під час рейду, секунди
+group_commands = [
+    ('/ban', handle_ban_command),
+    ('/mute', handle_mute_command),
+    ('/unmute', handle_unmute_command),
+    ('/add_curse_word', handle_add_curse_word_command),
+    ('/flood_limit', handle_flood_limit_command),
+    ('/report', handle_report_command),
+    ('/appeal', handle_appeal_command),
+]
 
-def send_chat_rules(bot, chat_id):
-    while True:
+class RulesCache:
+    # Текст правил перечитується з диска лише після зміни mtime файлу
+    def __init__(self, default_path, chats_dir):
+        self.default_path = default_path
+        self.chats_dir = chats_dir
+        self._texts = {}  # {шлях: (mtime, текст)}
+        self._lock = threading.Lock()
+
+    def _read(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._texts.get(path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        with self._lock:
+            self._texts[path] = (mtime, text)
+        return text
+
+    def get(self, chat_id):
+        try:
+            return self._read(os.path.join(self.chats_dir, f"{chat_id}.txt"))
+        except FileNotFoundError:
+            return self._read(self.default_path)
+
+class ChatRulesState:
+    __slots__ = ('last_activity', 'last_post')
+
+    def __init__(self):
+        self.last_activity = 0.0
+        self.last_post = 0.0
+
+# Правила для всіх чатів розсилаються зі спільного планувальника, без окремого потоку на чат.
+# Кожен чат має свій зсув усередині інтервалу (від id чату), тож сотні чатів не надсилають правила
+# одночасно, а чат, у якому ніхто не писав після попередніх правил, пропускається.
+class RulesBroadcaster:
+    def __init__(self, rules, interval):
+        self.rules = rules
+        self.interval = interval
+        self.sent = 0
+        self.skipped = 0
+        self._chats = {}  # {chat_id: ChatRulesState}
+        self._lock = threading.Lock()
+
+    def _first_post_at(self, chat_id, now):
+        offset = zlib.crc32(str(chat_id).encode()) % int(self.interval * 1000) / 1000
+        return now + offset
+
+    def touch(self, bot, chat_id):
+        now = time.time()
+        with self._lock:
+            state = self._chats.get(chat_id)
+            if state is None:
+                state = self._chats[chat_id] = ChatRulesState()
+                scheduler.schedule(('rules', chat_id), self._first_post_at(chat_id, now), self._post, bot, chat_id)
+            state.last_activity = now
+
+    def forget(self, chat_id):
+        with self._lock:
+            self._chats.pop(chat_id, None)
+        scheduler.cancel(('rules', chat_id))
+
+    def _post(self, bot, chat_id):
+        with self._lock:
+            state = self._chats.get(chat_id)
+            if state is None:
+                return
+            active = state.last_activity > state.last_post
+            state.last_post = time.time()
+        scheduler.schedule(('rules', chat_id), time.time() + self.interval, self._post, bot, chat_id)
+        if not active:
+            self.skipped += 1
+            return
         try:
-            with open('chat_rules.txt', 'r', encoding='utf-8') as f:
-                rules = f.read()
-            bot.sendMessage(chat_id, rules)
+            bot.sendMessage(chat_id, self.rules.get(chat_id))
+            self.sent += 1
         except Exception as e:
             print(f"{Fore.RED}Помилка при надсиланні правил:{Style.RESET_ALL} {e}")
-        time.sleep(rules_interval)
 
-def start_rules_thread(bot, chat_id):
-    global rules_thread_started
-    if not rules_thread_started:
-        rules_thread_started = True
-        rules_thread = threading.Thread(target=send_chat_rules, args=(bot, chat_id))
-        rules_thread.daemon = True
-        rules_thread.start()
+    def stats(self):
+        with self._lock:
+            return {'chats': len(self._chats), 'sent': self.sent, 'skipped': self.skipped}
+
+rules_broadcaster = RulesBroadcaster(RulesCache(RULES_FILE, RULES_DIR), rules_interval)
+
+def new_user_name(new_user):
+    return f"{new_user.get('first_name', '')} {new_user.get('username', '')}".strip()
 
 def handle_new_user(bot, chat_id, new_user):
     chat_title = get_chat_title(bot, chat_id)
-    username = new_user.get('username', '')
-    first_name = new_user.get('first_name', '')
-    full_name = f"{first_name} {username}".strip()
+    full_name = new_user_name(new_user)
 
     # Перевірка через Perspective API
-    api_url = f"https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze?key={PERSPECTIVE_API_KEY}"
-    payload = {
-        "comment": {"text": full_name},
-        "requestedAttributes": {"TOXICITY": {}, "SPAM": {}},
-        "languages": ["en"],
-    }
-
-    try:
-        response = requests.post(api_url, json=payload, timeout=5)
-        if response.status_code == 200:
-            result = response.json()
-            toxicity_score = result["attributeScores"]["TOXICITY"]["summaryScore"]["value"]
-            spam_score = result["attributeScores"]["SPAM"]["summaryScore"]["value"]
-
-            print(
-                f"{Fore.CYAN}Перевірка імені нового користувача:{Style.RESET_ALL} '{full_name}' | TOXICITY={toxicity_score:.2f} | SPAM={spam_score:.2f}")
-
-            if toxicity_score > 0.65 or spam_score > 0.75:
-                bot.kickChatMember(chat_id, new_user['id'])
-                bot.sendMessage(chat_id,
-                                f"🚫 Користувач [{full_name}](tg://user?id={new_user['id']}) був забанений через підозріле ім'я!",
-                                parse_mode='Markdown')
-                logging.info(
-                    "New user banned: Suspicious username",
-                    extra={
-                        'chat_id': chat_id,
-                        'chat_title': chat_title,
-                        'user_id': new_user['id'],
-                        'username': full_name,
-                        'details': f"TOXICITY={toxicity_score:.2f}, SPAM={spam_score:.2f}"
-                    }
-                )
-                return
-    except requests.RequestException as e:
-        print(f"{Fore.RED}Помилка перевірки імені через API:{Style.RESET_ALL} {e}")
+    scores = get_text_scores(full_name, PRIORITY_NEW_USER, perspective_new_user_deadline) if full_name else None
+    if scores is not None:
+        spam_score, toxicity_score = scores
+
+        print(
+            f"{Fore.CYAN}Перевірка імені нового користувача:{Style.RESET_ALL} '{full_name}' | TOXICITY={toxicity_score:.2f} | SPAM={spam_score:.2f}")
+
+        if is_spam_score(spam_score, toxicity_score):
+            kick_member(bot, chat_id, new_user['id'])
+            bot.sendMessage(chat_id,
+                            f"🚫 Користувач [{full_name}](tg://user?id={new_user['id']}) був забанений через підозріле ім'я!",
+                            parse_mode='Markdown')
+            logging.info(
+                "New user banned: Suspicious username",
+                extra={
+                    'chat_id': chat_id,
+                    'chat_title': chat_title,
+                    'user_id': new_user['id'],
+                    'username': full_name,
+                    'details': f"TOXICITY={toxicity_score:.2f}, SPAM={spam_score:.2f}"
+                }
+            )
+            return
 
     # Існуюча перевірка на лайливі слова
-    curse_words = load_curse_words("curse_words.json")
-    if check_for_curse_words(full_name.lower(), curse_words):
+    if check_for_curse_words(full_name):
         try:
-            bot.kickChatMember(chat_id, new_user['id'])
+            kick_member(bot, chat_id, new_user['id'])
             bot.sendMessage(chat_id,
                             f"🚫 Користувач [{full_name}](tg://user?id={new_user['id']}) був забанений за використання ненормативної лексики у нікнеймі!",
                             parse_mode='Markdown')
@@ -101,14 +193,8 @@ def handle_new_user(bot, chat_id, new_user):
                         f"🛡️ [{full_name}](tg://user?id={new_user['id']}), ви можете зняти обмеження, написавши боту 'Я не бот' в особисті повідомлення протягом 5 хвилин, інакше вас буде забанено.",
                         parse_mode='Markdown')
 
-        bot.restrictChatMember(
-            chat_id, new_user['id'],
-            can_send_messages=False,
-            can_send_media_messages=False,
-            can_send_other_messages=False,
-            can_add_web_page_previews=False
-        )
-        new_user_restrictions[new_user['id']] = {'chat_id': chat_id, 'time': time.time()}
+        restrict_member(bot, chat_id, new_user['id'])
+        await_verification(bot, chat_id, new_user['id'])
         logging.info(
             "New user restricted",
             extra={
@@ -120,6 +206,168 @@ def handle_new_user(bot, chat_id, new_user):
             }
         )
 
+class ChatRaid:
+    __slots__ = ('started_at', 'pending', 'banned', 'restricted')
+
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self.pending = []
+        self.banned = 0
+        self.restricted = 0
+
+# Захист від рейдів: коли за raid_join_window приєднується raid_join_threshold учасників, нові учасники
+# накопичуються й обробляються пакетами — імена оцінюються разом, обмеження накладаються за один прохід,
+# а замість привітання й інструкції для кожного в чат надходить одне спільне повідомлення.
+# Рейд завершується сам, щойно темп приєднань падає нижче raid_exit_threshold.
+class JoinRaidGuard:
+    def __init__(self, window, threshold, exit_threshold, batch_interval):
+        self.window = window
+        self.threshold = threshold
+        self.exit_threshold = exit_threshold
+        self.batch_interval = batch_interval
+        self._joins = {}  # {chat_id: deque міток часу приєднань}
+        self._raids = {}  # {chat_id: ChatRaid}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _recent_joins(self, chat_id, now):
+        joins = self._joins.get(chat_id)
+        if joins is None:
+            return 0
+        while joins and now - joins[0] > self.window:
+            joins.popleft()
+        if not joins:
+            del self._joins[chat_id]
+            return 0
+        return len(joins)
+
+    def on_join(self, bot, chat_id, new_users):
+        # True — учасників забрано в пакет рейду, інакше їх слід обробити звичайним шляхом
+        now = time.monotonic()
+        with self._lock:
+            self._joins.setdefault(chat_id, deque()).extend([now] * len(new_users))
+            raid = self._raids.get(chat_id)
+            if raid is None:
+                if self._recent_joins(chat_id, now) < self.threshold:
+                    return False
+                raid = self._raids[chat_id] = ChatRaid(now)
+                started = True
+            else:
+                started = False
+            raid.pending.extend(new_users)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, args=(bot,), daemon=True)
+                self._thread.start()
+        if started:
+            self._announce_start(bot, chat_id)
+        return True
+
+    def _announce_start(self, bot, chat_id):
+        chat_title = get_chat_title(bot, chat_id)
+        print(f"{Fore.RED}Рейд:{Style.RESET_ALL} '{chat_title}' — {self.threshold}+ приєднань за {self.window} с")
+        bot.sendMessage(chat_id,
+                        f"🚨 У '{chat_title}' масово приєднуються нові учасники. Увімкнено захист від рейду: нових учасників "
+                        f"обмежено, щоб писати, напишіть боту 'Я не бот' в особисті повідомлення протягом "
+                        f"{verification_timeout // 60} хвилин, інакше вас буде забанено.")
+        logging.info(
+            "Join raid started",
+            extra={
+                'chat_id': chat_id,
+                'chat_title': chat_title,
+                'user_id': 'N/A',
+                'username': 'N/A',
+                'details': f"Joins: {self.threshold}+ in {self.window} s"
+            }
+        )
+
+    def _process_batch(self, bot, chat_id, raid, new_users):
+        chat_title = get_chat_title(bot, chat_id)
+        names = {new_user['id']: new_user_name(new_user) for new_user in new_users}
+        scores = get_text_scores_batch([name for name in names.values() if name], PRIORITY_NEW_USER,
+                                       perspective_new_user_deadline)
+        for user_id, name in names.items():
+            name_scores = scores.get(name)
+            try:
+                if check_for_curse_words(name) or (name_scores is not None and is_spam_score(*name_scores)):
+                    kick_member(bot, chat_id, user_id)
+                    raid.banned += 1
+                    logging.info(
+                        "New user banned: Suspicious username during raid",
+                        extra={
+                            'chat_id': chat_id,
+                            'chat_title': chat_title,
+                            'user_id': user_id,
+                            'username': name,
+                            'details': "Banned" if name_scores is None else
+                                       f"TOXICITY={name_scores[1]:.2f}, SPAM={name_scores[0]:.2f}"
+                        }
+                    )
+                else:
+                    restrict_member(bot, chat_id, user_id)
+                    await_verification(bot, chat_id, user_id)
+                    raid.restricted += 1
+            except Exception as e:
+                print(f"{Fore.RED}Помилка обробки учасника рейду:{Style.RESET_ALL} {name} з ID {user_id} - {e}")
+        print(f"{Fore.YELLOW}Рейд у '{chat_title}':{Style.RESET_ALL} оброблено {len(new_users)} | "
+              f"забанено {raid.banned} | обмежено {raid.restricted}")
+
+    def _finish(self, bot, chat_id, raid):
+        chat_title = get_chat_title(bot, chat_id)
+        duration = int(time.monotonic() - raid.started_at)
+        bot.sendMessage(chat_id,
+                        f"✅ Рейд у '{chat_title}' завершився. Забанено за підозрілі імена: {raid.banned}, "
+                        f"очікують перевірки 'Я не бот': {raid.restricted}.")
+        logging.info(
+            "Join raid ended",
+            extra={
+                'chat_id': chat_id,
+                'chat_title': chat_title,
+                'user_id': 'N/A',
+                'username': 'N/A',
+                'details': f"Duration: {duration} s, Banned: {raid.banned}, Restricted: {raid.restricted}"
+            }
+        )
+
+    def _run(self, bot):
+        while True:
+            time.sleep(self.batch_interval)
+            now = time.monotonic()
+            with self._lock:
+                batches = []
+                finished = []
+                for chat_id, raid in list(self._raids.items()):
+                    if raid.pending:
+                        batches.append((chat_id, raid, raid.pending))
+                        raid.pending = []
+                    elif self._recent_joins(chat_id, now) < self.exit_threshold:
+                        finished.append((chat_id, self._raids.pop(chat_id)))
+            for chat_id, raid, new_users in batches:
+                try:
+                    self._process_batch(bot, chat_id, raid, new_users)
+                except Exception:
+                    traceback.print_exc()
+            for chat_id, raid in finished:
+                try:
+                    self._finish(bot, chat_id, raid)
+                except Exception:
+                    traceback.print_exc()
+
+raid_guard = JoinRaidGuard(raid_join_window, raid_join_threshold, raid_exit_threshold, raid_batch_interval)
+
+def handle_new_members(bot, chat_id, new_users):
+    if raid_guard.on_join(bot, chat_id, new_users):
+        return
+    for new_user in new_users:
+        handle_new_user(bot, chat_id, new_user)
+
+def track_chat_state(msg):
+    chat_id = msg['chat']['id']
+    if 'new_chat_title' in msg:
+        invalidate_chat_title(chat_id)
+    remember_chat_title(msg['chat'])
+    if 'left_chat_member' in msg:
+        member_status_cache.invalidate((chat_id, msg['left_chat_member']['id']))
+
 def handle(bot, msg):
     chat_type = msg['chat']['type']
     if chat_type not in ['group', 'supergroup']:
@@ -128,55 +376,71 @@ def handle(bot, msg):
     chat_id = msg['chat']['id']
     user_id = msg['from']['id']
 
-    start_rules_thread(bot, chat_id)
+    track_chat_state(msg)
+
+    rules_broadcaster.touch(bot, chat_id)
 
     if 'new_chat_members' in msg:
-        for new_user in msg['new_chat_members']:
-            handle_new_user(bot, chat_id, new_user)
+        handle_new_members(bot, chat_id, msg['new_chat_members'])
         return
 
+    remember_message(chat_id, user_id, msg['message_id'])
+
     if handle_spam(bot, msg, chat_id, user_id):
         return
 
     if handle_curse_words(bot, msg, chat_id, user_id):
         return
 
+    if handle_near_duplicates(bot, msg, chat_id, user_id):
+        return
+
     if handle_suspicious_links(bot, msg, chat_id, user_id):
         return
 
     if handle_spam_text(bot, msg, chat_id, user_id):
         return
 
+    dispatch_command(bot, msg, chat_id, user_id)
+
+def handle_edited_message(bot, msg):
+    # Спам, дописаний редагуванням, перевіряється лише за вмістом: редагування не рахуються як нові
+    # повідомлення для флуду й дублікатів, а команди з них не виконуються
+    if msg['chat']['type'] not in ['group', 'supergroup'] or 'from' not in msg:
+        return
+
+    chat_id = msg['chat']['id']
+    user_id = msg['from']['id']
+
+    if handle_curse_words(bot, msg, chat_id, user_id):
+        return
+
+    if handle_suspicious_links(bot, msg, chat_id, user_id):
+        return
+
+    handle_spam_text(bot, msg, chat_id, user_id)
+
+def dispatch_command(bot, msg, chat_id, user_id):
     text = msg.get('text', '').lower()
-    if text.startswith('/ban'):
-        handle_ban_command(bot, msg, chat_id, user_id)
-    elif text.startswith('/mute'):
-        handle_mute_command(bot, msg, chat_id, user_id)
-    elif text.startswith('/unmute'):
-        handle_unmute_command(bot, msg, chat_id, user_id)
-    elif text.startswith('/add_curse_word'):
-        handle_add_curse_word_command(bot, msg, chat_id, user_id)
-    elif text.startswith('/report'):
-        handle_report_command(bot, msg, chat_id, user_id)
-    elif text.startswith('/appeal'):  # Додано обробку команди /appeal
-        handle_appeal_command(bot, msg, chat_id, user_id)
+    for prefix, command_handler in group_commands:
+        if text.startswith(prefix):
+            command_handler(bot, msg, chat_id, user_id)
+            return True
+    return False
 
 def handle_private_message(bot, msg):
     user_id = msg['from']['id']
     text = msg.get('text', '').lower()
 
     if text == 'я не бот':
-        bot.sendMessage(user_id, "✅ Ви успішно пройшли перевірку. Обмеження знято.")
-        if user_id in new_user_restrictions:
-            group_chat_id = new_user_restrictions[user_id]['chat_id']
+        restriction = new_user_restrictions.get(user_id)
+        if restriction is None:
+            bot.sendMessage(user_id, "ℹ️ Для вас немає незавершеної перевірки, обмежень від бота не знайдено.")
+        else:
+            bot.sendMessage(user_id, "✅ Ви успішно пройшли перевірку. Обмеження знято.")
+            group_chat_id = restriction.chat_id
             chat_title = get_chat_title(bot, group_chat_id)
-            bot.restrictChatMember(
-                group_chat_id, user_id,
-                can_send_messages=True,
-                can_send_media_messages=True,
-                can_send_other_messages=True,
-                can_add_web_page_previews=True
-            )
+            lift_restrictions(bot, group_chat_id, user_id)
             logging.info(
                 "User verified",
                 extra={
@@ -187,45 +451,148 @@ def handle_private_message(bot, msg):
                     'details': "Restrictions lifted"
                 }
             )
-            del new_user_restrictions[user_id]
+            new_user_restrictions.pop(user_id)
+            scheduler.cancel(('verify', user_id))
     elif text.startswith('/appeal'):  # Додано обробку /appeal у приватних повідомленнях
         handle_appeal_command(bot, msg, None, user_id)
 
-def check_new_user_restrictions(bot):
-    while True:
-        current_time = time.time()
-        for user_id, restriction in list(new_user_restrictions.items()):
-            if current_time - restriction['time'] > 300:
-                chat_id = restriction['chat_id']
-                chat_title = get_chat_title(bot, chat_id)
-                bot.kickChatMember(chat_id, user_id)
-                bot.sendMessage(chat_id,
-                                f"🚫 Користувач з ID [{user_id}](tg://user?id={user_id}) був забанений у '{chat_title}' за невиконання перевірки 'Я не бот'.",
-                                parse_mode='Markdown')
-                logging.info(
-                    "New user banned: Verification timeout",
-                    extra={
-                        'chat_id': chat_id,
-                        'chat_title': chat_title,
-                        'user_id': user_id,
-                        'username': 'Unknown',
-                        'details': "Banned"
-                    }
-                )
-                del new_user_restrictions[user_id]
-        time.sleep(30)
+def await_verification(bot, chat_id, user_id):
+    restricted_at = time.time()
+    new_user_restrictions[user_id] = PendingVerification(chat_id, restricted_at)
+    scheduler.schedule(('verify', user_id), restricted_at + verification_timeout, expire_verification, bot, user_id)
+
+def expire_verification(bot, user_id):
+    restriction = new_user_restrictions.pop(user_id)
+    if restriction is None:
+        return
+    chat_id = restriction.chat_id
+    chat_title = get_chat_title(bot, chat_id)
+    kick_member(bot, chat_id, user_id)
+    bot.sendMessage(chat_id,
+                    f"🚫 Користувач з ID [{user_id}](tg://user?id={user_id}) був забанений у '{chat_title}' за невиконання перевірки 'Я не бот'.",
+                    parse_mode='Markdown')
+    logging.info(
+        "New user banned: Verification timeout",
+        extra={
+            'chat_id': chat_id,
+            'chat_title': chat_title,
+            'user_id': user_id,
+            'username': 'Unknown',
+            'details': "Banned"
+        }
+    )
+
+def restore_moderation_state(bot):
+    # Після перезапуску: мути й незавершені перевірки з диска, прострочені перевірки спрацьовують одразу
+    started = time.monotonic()
+    restored = state_journal.load()
+    restore_mutes()
+    for user_id, restriction in new_user_restrictions.items():
+        scheduler.schedule(('verify', user_id), restriction.restricted_at + verification_timeout,
+                           expire_verification, bot, user_id)
+    print(f"{Fore.GREEN}Стан модерації відновлено:{Style.RESET_ALL} записів {restored} за {time.monotonic() - started:.2f} с")
+
+def start_restore_thread(bot):
+    restore_thread = threading.Thread(target=restore_moderation_state, args=(bot,))
+    restore_thread.daemon = True
+    restore_thread.start()
 
 def message_loop(msg):
+    # Повідомлення одного чату лишаються впорядкованими, а флуд в одній групі не затримує інші
+    worker_pool.submit(msg['chat']['id'], process_message, msg)
+
+def process_message(msg):
     chat_type = msg['chat']['type']
     if chat_type == 'private':
         handle_private_message(bot, msg)
     else:
         handle(bot, msg)
 
-def start_bot(bot_instance):
+def handle_bot_member_update(update):
+    handle_chat_member_update(update)
+    # Бота видалили з чату — правила туди більше не надсилаються
+    if update['new_chat_member'].get('status') in ('left', 'kicked'):
+        rules_broadcaster.forget(update['chat']['id'])
+
+def process_update(update):
+    if 'message' in update:
+        message_loop(update['message'])
+    elif 'edited_message' in update:
+        msg = update['edited_message']
+        worker_pool.submit(msg['chat']['id'], handle_edited_message, bot, msg)
+    elif 'chat_member' in update:
+        handle_chat_member_update(update['chat_member'])
+    elif 'my_chat_member' in update:
+        handle_bot_member_update(update['my_chat_member'])
+
+def poll_updates(bot):
+    # Власний цикл getUpdates: telepot.message_loop не вміє розбирати chat_member оновлення
+    offset = None
+    while True:
+        try:
+            updates = bot.getUpdates(offset=offset, timeout=polling_timeout, allowed_updates=allowed_updates)
+        except Exception as e:
+            print(f"{Fore.RED}Помилка отримання оновлень:{Style.RESET_ALL} {e}")
+            time.sleep(1)
+            continue
+        for update in updates:
+            offset = update['update_id'] + 1
+            try:
+                process_update(update)
+            except Exception:
+                traceback.print_exc()
+
+def report_pool_stats():
+    while True:
+        time.sleep(pool_stats_interval)
+        stats = worker_pool.stats()
+        if stats['pending']:
+            lagging = ", ".join(f"{chat_id}: {lag:.1f} с" for chat_id, lag in stats['lagging_chats'])
+            print(f"{Fore.YELLOW}Черга оновлень:{Style.RESET_ALL} {stats['pending']} | "
+                  f"Зайнято потоків: {stats['busy']}/{stats['workers']} | Відставання: {lagging}")
+        report_stats()
+
+def report_stats():
+    # Спільна для звичайного й асинхронного режимів частина періодичного звіту
+    http_client.report()
+    score_stats = text_score_cache.stats()
+    print(f"{Fore.CYAN}Кеш оцінок тексту:{Style.RESET_ALL} записів {score_stats['size']} | "
+          f"влучань {score_stats['hit_rate']:.0%} | з диска {score_stats['stored_hits']}")
+    store_stats = state_store.stats()
+    maps = ", ".join(f"{name} {entry['entries']}" for name, entry in store_stats['maps'].items())
+    print(f"{Fore.CYAN}Стан у пам'яті:{Style.RESET_ALL} {store_stats['bytes'] // 1024} КБ з {store_stats['budget'] // 1024} КБ | {maps}")
+    governor_stats = perspective_governor.stats()
+    print(f"{Fore.CYAN}Черга Perspective:{Style.RESET_ALL} {governor_stats['queued']} | запитів {governor_stats['requests']} | "
+          f"429: {governor_stats['throttled']} | прострочено {governor_stats['expired']} | "
+          f"очікування {governor_stats['avg_wait'] * 1000:.0f}/{governor_stats['max_wait'] * 1000:.0f} мс (серед./макс.)")
+    rules_stats = rules_broadcaster.stats()
+    print(f"{Fore.CYAN}Правила:{Style.RESET_ALL} чатів {rules_stats['chats']} | надіслано {rules_stats['sent']} | "
+          f"пропущено без активності {rules_stats['skipped']}")
+    outbound_stats = outbound_queue.stats()
+    print(f"{Fore.CYAN}Вихідні дії:{Style.RESET_ALL} у черзі {outbound_stats['queued']} | виконано {outbound_stats['sent']} | "
+          f"помилок {outbound_stats['failed']} | 429: {outbound_stats['throttled']} | відкинуто {outbound_stats['dropped']} | "
+          f"об'єднано {outbound_stats['coalesced']} | очікування {outbound_stats['avg_wait'] * 1000:.0f}/"
+          f"{outbound_stats['max_wait'] * 1000:.0f} мс (серед./макс.)")
+    scheduler_stats = scheduler.stats()
+    print(f"{Fore.CYAN}Відкладені події:{Style.RESET_ALL} {scheduler_stats['scheduled']} | "
+          f"спрацювало {scheduler_stats['fired']} | скасовано {scheduler_stats['cancelled']}")
+    if checks.local_safe_browsing is not None:
+        safe_browsing_stats = checks.local_safe_browsing.stats()
+        print(f"{Fore.CYAN}Локальна база Safe Browsing:{Style.RESET_ALL} {'готова' if safe_browsing_stats['ready'] else 'синхронізується'} | "
+              f"префіксів {safe_browsing_stats['prefixes']} | перевірок {safe_browsing_stats['lookups']} | "
+              f"без запиту {safe_browsing_stats['local_rate']:.0%}")
+
+def start_bot(bot_instance, polling=True):
+    # polling=False — оновлення надходять через вебхук (webhook.py) і передаються в process_update
     global bot
-    bot = bot_instance
-    bot.message_loop(message_loop)
-    restrictions_thread = threading.Thread(target=check_new_user_restrictions, args=(bot,))
-    restrictions_thread.daemon = True
-    restrictions_thread.start()
\ No newline at end of file
+    bot = OutboundBot(bot_instance, outbound_queue)
+    outbound_queue.start()
+    worker_pool.start()
+    stats_thread = threading.Thread(target=report_pool_stats)
+    stats_thread.daemon = True
+    stats_thread.start()
+    if polling:
+        polling_thread = threading.Thread(target=poll_updates, args=(bot,))
+        polling_thread.daemon = True
+        polling_thread.start()
+    start_restore_thread(bot)
\ No newline at end of file
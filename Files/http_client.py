@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from colorama import init, Fore, Style
+
+try:
+    import httpx
+    import h2  # noqa: F401 — потрібен httpx для HTTP/2
+except ImportError:
+    httpx = None
+
+TRANSPORT_ERRORS = (requests.RequestException, httpx.HTTPError) if httpx else (requests.RequestException,)
+
+# Ініціалізація colorama
+init()
+
+# Спільний HTTP-клієнт для всіх зовнішніх запитів (Perspective, Safe Browsing, скорочувачі посилань).
+# З'єднання з кожним хостом тримаються відкритими й повторно використовуються, тож TCP+TLS-рукостискання
+# з googleapis.com відбувається один раз, а не на кожне повідомлення.
+# Якщо встановлено httpx з h2 — запити йдуть через HTTP/2, інакше через пул з'єднань requests.
+
+http_pool_hosts = int(os.getenv('HTTP_POOL_HOSTS', 10))  # Скільки хостів тримати в пулі одночасно
+http_pool_size = int(os.getenv('HTTP_POOL_SIZE', 16))  # Максимум з'єднань до одного хоста
+http_connect_timeout = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3))
+http_read_timeout = float(os.getenv('HTTP_READ_TIMEOUT', 5))
+http2_enabled = os.getenv('HTTP2_ENABLED', '1') != '0'
+
+
+class HttpError(Exception):
+    pass
+
+
+class EndpointStats:
+    __slots__ = ('requests', 'errors', 'total_latency', 'max_latency')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+
+class HttpClient:
+    def __init__(self, pool_hosts=http_pool_hosts, pool_size=http_pool_size,
+                 connect_timeout=http_connect_timeout, read_timeout=http_read_timeout, http2=http2_enabled):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.http2 = bool(http2 and httpx)
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        if self.http2:
+            limits = httpx.Limits(max_connections=pool_hosts * pool_size, max_keepalive_connections=pool_hosts * pool_size)
+            self.client = httpx.Client(http2=True, limits=limits)
+        else:
+            # pool_block=True: при вичерпанні пулу запит чекає на вільне з'єднання, а не відкриває нове
+            adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, pool_block=True)
+            self.client = requests.Session()
+            self.client.mount('https://', adapter)
+            self.client.mount('http://', adapter)
+
+    def _timeout(self, timeout):
+        read_timeout = self.read_timeout if timeout is None else timeout
+        connect_timeout = min(self.connect_timeout, read_timeout)
+        if self.http2:
+            return httpx.Timeout(read_timeout, connect=connect_timeout)
+        return connect_timeout, read_timeout
+
+    def request(self, endpoint, method, url, json=None, headers=None, timeout=None, read_body=True):
+        started = time.monotonic()
+        failed = True
+        try:
+            if self.http2:
+                request = self.client.build_request(method, url, json=json, headers=headers, timeout=self._timeout(timeout))
+                response = self.client.send(request, stream=not read_body)
+            else:
+                response = self.client.request(method, url, json=json, headers=headers, timeout=self._timeout(timeout),
+                                               allow_redirects=False, stream=not read_body)
+            if not read_body:
+                response.close()
+            failed = response.status_code >= 400
+            return response
+        except TRANSPORT_ERRORS as e:
+            raise HttpError(f"{type(e).__name__}: {e}") from e
+        finally:
+            self.record(endpoint, time.monotonic() - started, failed)
+
+    def get(self, endpoint, url, **kwargs):
+        return self.request(endpoint, 'GET', url, **kwargs)
+
+    def head(self, endpoint, url, **kwargs):
+        return self.request(endpoint, 'HEAD', url, read_body=False, **kwargs)
+
+    def post(self, endpoint, url, **kwargs):
+        return self.request(endpoint, 'POST', url, **kwargs)
+
+    def record(self, endpoint, latency, failed=False):
+        # Також викликається асинхронним режимом, який ходить у мережу через власну сесію aiohttp
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.requests += 1
+            stats.errors += failed
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+
+    def stats(self):
+        with self.lock:
+            return {
+                endpoint: {
+                    'requests': stats.requests,
+                    'errors': stats.errors,
+                    'avg_latency': stats.total_latency / stats.requests if stats.requests else 0.0,
+                    'max_latency': stats.max_latency
+                }
+                for endpoint, stats in self.endpoints.items()
+            }
+
+    def report(self):
+        for endpoint, stats in sorted(self.stats().items()):
+            print(f"{Fore.CYAN}HTTP {endpoint}:{Style.RESET_ALL} запитів {stats['requests']} | помилок {stats['errors']} | "
+                  f"середня затримка {stats['avg_latency'] * 1000:.0f} мс | максимальна {stats['max_latency'] * 1000:.0f} мс")
+
+    def close(self):
+        self.client.close()
+
+
+http_client = HttpClient()
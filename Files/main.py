@@ -1,15 +1,29 @@
 import time
+import argparse
 import telepot
 import signal
 import sys
 from dotenv import load_dotenv
 import os
-from handler import start_bot
+from handler import start_bot, process_update, allowed_updates
+from utils import flush_state, forget_scored_texts
+from checks import enable_local_safe_browsing, enable_prefilter
 from colorama import init, Fore, Style
 
 # Ініціалізація colorama
 init()
 
+parser = argparse.ArgumentParser(description="Anti Spam Bot Telegram")
+parser.add_argument('--async', dest='async_mode', action='store_true',
+                    help="обробляти оновлення як корутини (telepot.aio + aiohttp)")
+parser.add_argument('--safe-browsing-db', metavar='DIR',
+                    help="перевіряти посилання за локальною копією списків Safe Browsing у вказаному каталозі")
+parser.add_argument('--webhook', action='store_true',
+                    help="отримувати оновлення через вебхук (WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_PORT у .env) замість getUpdates")
+parser.add_argument('--prefilter', metavar='MODEL',
+                    help="відсіювати явно чисті й явно спамні тексти локальною моделлю (див. prefilter.py) до запиту Perspective")
+args = parser.parse_args()
+
 load_dotenv()
 API_TOKEN = os.getenv('TOKEN')
 SAFE_BROWSING_API_KEY = os.getenv('SAFE_BROWSING_API_KEY')
@@ -19,15 +33,40 @@ if not API_TOKEN or not SAFE_BROWSING_API_KEY:
     sys.exit(1)
 
 bot = telepot.Bot(API_TOKEN)
+forget_scored_texts()
 
 print(f"{Fore.GREEN}Бот працює...{Style.RESET_ALL}")
 
 def graceful_exit(signal, frame):
     print(f"{Fore.YELLOW}Завершення роботи бота...{Style.RESET_ALL}")
+    flush_state()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, graceful_exit)
-start_bot(bot)
 
-while True:
-    time.sleep(10)
\ No newline at end of file
+if args.safe_browsing_db:
+    enable_local_safe_browsing(args.safe_browsing_db)
+
+if args.prefilter:
+    enable_prefilter(args.prefilter)
+
+if args.async_mode:
+    # telepot.aio працює лише зі старим async-timeout 3.x, а aiohttp до Python 3.11 вимагає 4.x
+    if sys.version_info < (3, 11):
+        print(f"{Fore.RED}Режим --async потребує Python 3.11 або новіше.{Style.RESET_ALL}")
+        sys.exit(1)
+    import asyncio
+    from aio_handler import run_bot
+    # telepot.aio створює свої HTTP-сесії на циклі подій, отриманому під час імпорту,
+    # тому запускаємо саме його, а не новий цикл через asyncio.run
+    asyncio.get_event_loop().run_until_complete(run_bot(API_TOKEN, bot, webhook=args.webhook))
+elif args.webhook:
+    import asyncio
+    from webhook import serve_webhook, sync_submitter
+    start_bot(bot, polling=False)
+    asyncio.get_event_loop().run_until_complete(serve_webhook(bot, sync_submitter(process_update), allowed_updates))
+else:
+    start_bot(bot)
+
+    while True:
+        time.sleep(10)
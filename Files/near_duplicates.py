@@ -0,0 +1,115 @@
+import hashlib
+import struct
+import threading
+import time
+from collections import deque
+from utils import tokenize, normalize_text
+
+# Індекс недавніх повідомлень для пошуку майже однакових копій від різних акаунтів (MinHash-LSH).
+# Текст — це множина слів і пар слів; його MinHash-підпис із 32 значень зберігає схожість Жаккара:
+# частка однакових позицій у двох підписах наближає частку спільних ознак. Підпис ділиться на 8 смуг
+# по 4 значення, і кандидатами вважаються лише записи, з якими збігається хоча б одна смуга, тож
+# пошук переглядає кілька кошиків, а не всі недавні повідомлення.
+
+near_duplicate_window = 600  # Скільки пам'ятати повідомлення, секунди
+near_duplicate_similarity = 0.6  # Мінімальна оцінка схожості Жаккара між копіями
+near_duplicate_chat_users = 3  # Скільки різних користувачів мають надіслати копію в один чат
+near_duplicate_global_users = 5  # ...або в будь-які чати разом
+near_duplicate_min_tokens = 5  # Короткі фрази ("привіт всім") повторюються природно
+near_duplicate_bucket_scan = 200  # Скільки останніх записів кошика переглядати
+
+MINHASH_PERMUTATIONS = 32
+MINHASH_BANDS = 8
+_rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+_digest = struct.Struct('<16I')  # 64-байтовий blake2b — 16 незалежних 32-бітних хешів
+
+
+def _feature_hashes(feature):
+    # 32 хеші ознаки з двох дайджестів з різним person замість 32 окремих перестановок
+    data = feature.encode('utf-8')
+    return (_digest.unpack(hashlib.blake2b(data, person=b'minhash0').digest())
+            + _digest.unpack(hashlib.blake2b(data, person=b'minhash1').digest()))
+
+
+def minhash(tokens):
+    features = set(tokens) | {f"{first} {second}" for first, second in zip(tokens, tokens[1:])}
+    return tuple(map(min, zip(*map(_feature_hashes, features))))
+
+
+def similarity(first, second):
+    return sum(1 for x, y in zip(first, second) if x == y) / MINHASH_PERMUTATIONS
+
+
+class PostedText:
+    __slots__ = ('posted_at', 'signature', 'chat_id', 'user_id', 'message_id')
+
+    def __init__(self, posted_at, signature, chat_id, user_id, message_id):
+        self.posted_at = posted_at
+        self.signature = signature
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.message_id = message_id
+
+
+class NearDuplicateIndex:
+    def __init__(self, window, min_similarity, chat_users, global_users, min_tokens):
+        self.window = window
+        self.min_similarity = min_similarity
+        self.chat_users = chat_users
+        self.global_users = global_users
+        self.min_tokens = min_tokens
+        self.flagged = 0
+        self._records = deque()  # Усі записи в порядку надходження
+        self._buckets = {}  # {(смуга, значення): deque записів у порядку надходження}
+        self._lock = threading.Lock()
+
+    def _bands(self, signature):
+        return [(band, signature[band * _rows:(band + 1) * _rows]) for band in range(MINHASH_BANDS)]
+
+    def _evict(self, now):
+        # Записи і в загальній черзі, і в кожному кошику впорядковані за часом, тож старі знімаються з початку
+        while self._records and now - self._records[0].posted_at > self.window:
+            record = self._records.popleft()
+            for band_key in self._bands(record.signature):
+                bucket = self._buckets[band_key]
+                bucket.popleft()
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def check(self, chat_id, user_id, message_id, text):
+        # Додає повідомлення до індексу. Повертає id попередніх копій у цьому чаті, якщо текст розсилають
+        # щонайменше chat_users (у чаті) або global_users (загалом) різних користувачів, інакше None
+        tokens = tokenize(normalize_text(text))
+        if len(tokens) < self.min_tokens:
+            return None
+        signature = minhash(tokens)
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            copies = {}
+            band_keys = self._bands(signature)
+            for band_key in band_keys:
+                bucket = self._buckets.get(band_key, ())
+                for index in range(len(bucket) - 1, max(len(bucket) - near_duplicate_bucket_scan, 0) - 1, -1):
+                    record = bucket[index]
+                    if id(record) not in copies and similarity(record.signature, signature) >= self.min_similarity:
+                        copies[id(record)] = record
+            record = PostedText(now, signature, chat_id, user_id, message_id)
+            self._records.append(record)
+            for band_key in band_keys:
+                self._buckets.setdefault(band_key, deque()).append(record)
+
+        global_users = {copy.user_id for copy in copies.values()} | {user_id}
+        chat_copies = [copy for copy in copies.values() if copy.chat_id == chat_id]
+        chat_users = {copy.user_id for copy in chat_copies} | {user_id}
+        if len(chat_users) < self.chat_users and len(global_users) < self.global_users:
+            return None
+        self.flagged += 1
+        return [copy.message_id for copy in chat_copies if copy.message_id != message_id]
+
+    def __len__(self):
+        return len(self._records)
+
+
+near_duplicate_index = NearDuplicateIndex(near_duplicate_window, near_duplicate_similarity, near_duplicate_chat_users,
+                                          near_duplicate_global_users, near_duplicate_min_tokens)
@@ -0,0 +1,322 @@
+import heapq
+import json
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+import telepot
+from utils import TokenBucket, TTLCache
+from scheduler import scheduler
+from colorama import init, Fore, Style
+
+# Ініціалізація colorama
+init()
+
+# Черга вихідних дій Telegram. Видалення й обмеження йдуть попереду оголошень, а надсилання тримається
+# в лімітах Telegram: ~30 повідомлень на секунду для всього бота, ~20 на хвилину в одну групу, ~1 на
+# секунду в особистий чат. На 429 дія повторюється після retry_after, а чат на цей час призупиняється.
+# Обробники не чекають на мережу: кожна дія повертає Future, на який можна почекати, якщо потрібен результат.
+
+outbound_global_rate = 30  # Дій на секунду для всього бота
+outbound_group_rate = 20 / 60  # Повідомлень на секунду в одну групу
+outbound_group_burst = 5  # Скільки повідомлень група може отримати поспіль до настання ліміту
+outbound_private_rate = 1  # Повідомлень на секунду в особистий чат
+outbound_workers = 4  # Скільки дій виконується одночасно (у різних чатах)
+outbound_max_retries = 3
+outbound_max_queue = 5000  # Понад це оголошення відкидаються, модераційні дії — ні
+notice_coalesce_interval = 10.0  # Повідомлення про таймаути в одному чаті частіше цього об'єднуються, секунди
+delete_batch_size = 100  # Максимум id в одному виклику deleteMessages (ліміт Bot API)
+
+PRIORITY_MODERATION, PRIORITY_REPLY, PRIORITY_ANNOUNCEMENT = range(3)
+MODERATION_METHODS = frozenset({'deleteMessage', 'deleteMessages', 'restrictChatMember', 'kickChatMember', 'unbanChatMember'})
+MESSAGE_METHODS = frozenset({'sendMessage', 'forwardMessage'})
+QUEUED_METHODS = MODERATION_METHODS | MESSAGE_METHODS
+
+
+class OutboundQueueFull(Exception):
+    pass
+
+
+class OutboundAction:
+    __slots__ = ('priority', 'seq', 'call', 'method', 'args', 'kwargs', 'chat_id', 'future', 'attempts', 'enqueued_at')
+
+    def __init__(self, priority, seq, call, method, args, kwargs, chat_id):
+        self.priority = priority
+        self.seq = seq
+        self.call = call
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.chat_id = chat_id
+        self.future = Future()
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class NoticeBatch:
+    __slots__ = ('last_sent', 'texts', 'kwargs')
+
+    def __init__(self):
+        self.last_sent = 0.0
+        self.texts = []
+        self.kwargs = {}
+
+
+def action_chat_id(method, args, kwargs):
+    if method == 'deleteMessage':
+        return args[0][0]
+    return args[0] if args else kwargs.get('chat_id')
+
+
+def action_priority(method, chat_id, kwargs):
+    if method in MODERATION_METHODS:
+        return PRIORITY_MODERATION
+    # Відповіді на команди та особисті повідомлення важливіші за оголошення в групах
+    if method == 'forwardMessage' or 'reply_to_message_id' in kwargs or chat_id > 0:
+        return PRIORITY_REPLY
+    return PRIORITY_ANNOUNCEMENT
+
+
+def parse_telegram_retry_after(error):
+    if isinstance(error, telepot.exception.TelegramError) and error.error_code == 429:
+        parameters = error.json.get('parameters', {}) if isinstance(error.json, dict) else {}
+        return float(parameters.get('retry_after', 1))
+    return None
+
+
+class OutboundQueue:
+    def __init__(self, global_rate, group_rate, group_burst, private_rate, workers, max_retries, max_queue):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = TTLCache(600, maxsize=100000)  # {chat_id: TokenBucket} лише для повідомлень
+        self._heap = []  # Готові до виконання дії
+        self._delayed = []  # (not_before, seq, дія) — чекають на ліміт чату або retry_after
+        self._paused_chats = {}  # {chat_id: monotonic-час, до якого Telegram просив не надсилати}
+        self._busy_chats = set()  # Чати, дія яких зараз виконується: порядок дій у чаті зберігається
+        self._parked = {}  # {chat_id: [дії]} — відкладені, поки виконується попередня дія цього чату
+        self._notices = {}  # {chat_id: NoticeBatch}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def submit(self, call, method, args, kwargs):
+        chat_id = action_chat_id(method, args, kwargs)
+        action = OutboundAction(action_priority(method, chat_id, kwargs), next(self._counter), call, method,
+                                args, kwargs, chat_id)
+        with self._condition:
+            if action.priority == PRIORITY_ANNOUNCEMENT and self._queued() >= self.max_queue:
+                self.dropped += 1
+                action.future.set_exception(OutboundQueueFull(f"черга вихідних дій переповнена ({self.max_queue})"))
+                return action.future
+            heapq.heappush(self._heap, action)
+            self._condition.notify()
+        return action.future
+
+    def _queued(self):
+        return len(self._heap) + len(self._delayed) + sum(map(len, self._parked.values()))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id > 0:
+                bucket = TokenBucket(self.private_rate, 1)
+            else:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    def _delay(self, action, not_before):
+        heapq.heappush(self._delayed, (not_before, action.seq, action))
+
+    def _take(self):
+        # Під замком: найважливіша дія, для якої є токени і чат не зайнятий та не призупинений
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                heapq.heappush(self._heap, heapq.heappop(self._delayed)[2])
+            chosen = None
+            while self._heap:
+                action = heapq.heappop(self._heap)
+                if action.chat_id in self._busy_chats:
+                    self._parked.setdefault(action.chat_id, []).append(action)
+                    continue
+                paused_until = self._paused_chats.get(action.chat_id)
+                if paused_until is not None:
+                    if paused_until > now:
+                        self._delay(action, paused_until)
+                        continue
+                    del self._paused_chats[action.chat_id]
+                chat_bucket = self._chat_bucket(action.chat_id) if action.method in MESSAGE_METHODS else None
+                wait = chat_bucket.try_acquire() if chat_bucket else 0.0
+                if wait:
+                    self._delay(action, now + wait)
+                    continue
+                chosen = action
+                break
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            if chosen is not None:
+                wait = self._global_bucket.try_acquire()
+                if not wait:
+                    self._busy_chats.add(chosen.chat_id)
+                    return chosen
+                if chat_bucket:
+                    chat_bucket.refund()
+                heapq.heappush(self._heap, chosen)
+                timeout = wait if timeout is None else min(timeout, wait)
+            self._condition.wait(timeout)
+
+    def _execute(self, action):
+        waited = time.monotonic() - action.enqueued_at
+        try:
+            result = action.call(*action.args, **action.kwargs)
+        except Exception as e:
+            retry_after = parse_telegram_retry_after(e)
+            with self._condition:
+                if retry_after is not None:
+                    self.throttled += 1
+                    self._paused_chats[action.chat_id] = time.monotonic() + retry_after
+                    action.attempts += 1
+                    if action.attempts <= self.max_retries:
+                        self._delay(action, time.monotonic() + retry_after)
+                        return
+                self.failed += 1
+            print(f"{Fore.RED}Помилка {action.method} у чаті {action.chat_id}:{Style.RESET_ALL} {e}")
+            action.future.set_exception(e)
+        else:
+            with self._condition:
+                self.sent += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            action.future.set_result(result)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                action = self._take()
+            try:
+                self._execute(action)
+            finally:
+                with self._condition:
+                    self._busy_chats.discard(action.chat_id)
+                    for parked in self._parked.pop(action.chat_id, ()):
+                        heapq.heappush(self._heap, parked)
+                    self._condition.notify_all()
+
+    def start(self):
+        with self._condition:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def send_notice(self, call, chat_id, text, **kwargs):
+        # Перше повідомлення надсилається одразу, наступні протягом інтервалу збираються в одне
+        with self._condition:
+            now = time.time()
+            if len(self._notices) > self.max_queue:
+                # Чати, де інтервал об'єднання минув, можна забути без втрат
+                self._notices = {key: batch for key, batch in self._notices.items()
+                                 if batch.texts or now - batch.last_sent < notice_coalesce_interval}
+            batch = self._notices.get(chat_id)
+            if batch is None:
+                batch = self._notices[chat_id] = NoticeBatch()
+            if not batch.texts and now - batch.last_sent >= notice_coalesce_interval:
+                batch.last_sent = now
+                send_now = True
+            else:
+                if not batch.texts:
+                    scheduler.schedule(('notice', chat_id), batch.last_sent + notice_coalesce_interval,
+                                       self._flush_notices, call, chat_id)
+                batch.texts.append(text)
+                batch.kwargs = kwargs
+                self.coalesced += 1
+                send_now = False
+        if send_now:
+            return self.submit(call, 'sendMessage', (chat_id, text), kwargs)
+        return None
+
+    def _flush_notices(self, call, chat_id):
+        with self._condition:
+            batch = self._notices.get(chat_id)
+            if batch is None or not batch.texts:
+                return
+            texts, batch.texts = batch.texts, []
+            batch.last_sent = time.time()
+        self.submit(call, 'sendMessage', (chat_id, "\n\n".join(texts)), batch.kwargs)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'queued': self._queued(),
+                'sent': self.sent,
+                'failed': self.failed,
+                'throttled': self.throttled,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'avg_wait': self.total_wait / self.sent if self.sent else 0.0,
+                'max_wait': self.max_wait
+            }
+
+
+class OutboundBot:
+    # Обгортка telepot.Bot: дії з QUEUED_METHODS ідуть через чергу й повертають Future, решта викликається напряму
+    def __init__(self, bot, queue):
+        self.bot = bot
+        self.queue = queue
+        self.bulk_delete = True  # Вимикається, якщо Bot API не знає deleteMessages
+
+    def __getattr__(self, name):
+        attribute = getattr(self.bot, name)
+        if name not in QUEUED_METHODS:
+            return attribute
+
+        def queued(*args, **kwargs):
+            return self.queue.submit(attribute, name, args, kwargs)
+        return queued
+
+    def deleteMessages(self, chat_id, message_ids):
+        # Пакетне видалення одним запитом на кожні delete_batch_size повідомлень
+        return [self.queue.submit(self._delete_batch, 'deleteMessages', (chat_id, message_ids[start:start + delete_batch_size]), {})
+                for start in range(0, len(message_ids), delete_batch_size)]
+
+    def _delete_batch(self, chat_id, message_ids):
+        if len(message_ids) == 1 or not self.bulk_delete:
+            for message_id in message_ids[1:]:
+                self.queue.submit(self.bot.deleteMessage, 'deleteMessage', ((chat_id, message_id),), {})
+            return self.bot.deleteMessage((chat_id, message_ids[0]))
+        try:
+            # telepot не знає deleteMessages, тож запит іде напряму; список передається як JSON
+            return self.bot._api_request('deleteMessages', {'chat_id': chat_id, 'message_ids': json.dumps(message_ids)})
+        except telepot.exception.TelegramError as e:
+            if e.error_code == 429:
+                raise
+            if e.error_code == 404:
+                self.bulk_delete = False
+            # Старий Bot API або помилка пакета: видаляємо по одному, темп тримає та сама черга
+            print(f"{Fore.YELLOW}deleteMessages недоступний у чаті {chat_id}:{Style.RESET_ALL} {e}; видалення по одному")
+            for message_id in message_ids:
+                self.queue.submit(self.bot.deleteMessage, 'deleteMessage', ((chat_id, message_id),), {})
+            return False
+
+    def sendNotice(self, chat_id, text, **kwargs):
+        # Оголошення про таймаут: кілька за інтервал в одному чаті стають одним повідомленням
+        return self.queue.send_notice(self.bot.sendMessage, chat_id, text, **kwargs)
+
+
+outbound_queue = OutboundQueue(outbound_global_rate, outbound_group_rate, outbound_group_burst, outbound_private_rate,
+                               outbound_workers, outbound_max_retries, outbound_max_queue)
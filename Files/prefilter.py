@@ -0,0 +1,224 @@
+import argparse
+import json
+import math
+import random
+import re
+import sqlite3
+import time
+import zlib
+import numpy as np
+from utils import normalize_text, DB_FILE
+from colorama import init, Fore, Style
+
+# Ініціалізація colorama
+init()
+
+# Локальний попередній фільтр перед Perspective: наївний Баєс на хешованих символьних n-грамах.
+# Модель — два масиви NumPy (ваги ознак і межі невизначеної смуги), оцінка повідомлення займає
+# десятки мікросекунд. Perspective викликається лише для текстів, у яких модель не впевнена.
+#
+# Навчання офлайн на історії модерації самого бота:
+#   python prefilter.py export corpus.jsonl             — корпус з violations.db і bot_logs.log
+#   python prefilter.py train corpus.jsonl              — навчання, вибір порогів, запис prefilter.npz
+#   python prefilter.py evaluate corpus.jsonl           — скільки запитів зекономлено і якою ціною
+
+PREFILTER_MODEL_FILE = "prefilter.npz"
+LOG_FILE = "bot_logs.log"
+
+prefilter_buckets = 1 << 18
+prefilter_ngram_sizes = (3, 4, 5)
+prefilter_alpha = 1.0  # Згладжування Лапласа
+prefilter_target_precision = 0.99  # Мінімальна точність локального вердикту «спам»
+prefilter_max_missed = 0.01  # Частка спаму, яку дозволено відпустити як «чисте» без Perspective
+prefilter_validation_share = 0.2
+
+# Події з bot_logs.log, після яких повідомлення вважається порушенням (флуд не рахується: текст може бути звичайним)
+SPAM_EVENTS = ("Spam text: User muted", "Suspicious link: User muted", "Curse words: User muted",
+               "Mute: User muted", "Ban: User banned")
+UNMUTE_EVENT = "Unmute: User unmuted"
+LOG_LINE = re.compile(r"\| User: (?P<user_id>-?\d+) \(.*?\) \| (?P<event>.+?) \| Details: Message: (?P<text>.*?)"
+                      r"(?: - URL: .*?)?(?: - Timeout: \d+ hours)?$")
+
+
+def text_features(text, buckets=prefilter_buckets):
+    # Унікальні індекси n-грам: стабільний crc32 замість hash(), який відрізняється між запусками Python
+    text = f" {normalize_text(text)} "
+    features = {zlib.crc32(text[i:i + size].encode('utf-8')) % buckets
+                for size in prefilter_ngram_sizes for i in range(len(text) - size + 1)}
+    return np.fromiter(features, dtype=np.int64, count=len(features))
+
+
+class PrefilterModel:
+    def __init__(self, weights, bias, low, high):
+        self.weights = weights
+        self.bias = bias
+        self.low = low
+        self.high = high
+
+    @classmethod
+    def load(cls, path=PREFILTER_MODEL_FILE):
+        with np.load(path) as data:
+            return cls(data['weights'], float(data['bias']), float(data['low']), float(data['high']))
+
+    def save(self, path=PREFILTER_MODEL_FILE):
+        with open(path, 'wb') as file:
+            np.savez(file, weights=self.weights, bias=self.bias, low=self.low, high=self.high)
+
+    def score(self, text):
+        # Логарифм відношення шансів «спам / не спам»
+        return self.bias + float(self.weights[text_features(text, len(self.weights))].sum())
+
+    def verdict(self, text):
+        # False — точно чисте, True — точно спам, None — невпевнено, потрібна оцінка Perspective
+        score = self.score(text)
+        if score < self.low:
+            return False
+        if score >= self.high:
+            return True
+        return None
+
+
+def fit(samples, buckets=prefilter_buckets, alpha=prefilter_alpha):
+    counts = np.zeros((2, buckets), dtype=np.float64)
+    totals = [0, 0]
+    for text, label in samples:
+        counts[label, text_features(text, buckets)] += 1
+        totals[label] += 1
+    if not all(totals):
+        raise ValueError("для навчання потрібні приклади обох класів")
+    log_probs = np.log(counts + alpha) - np.log(counts.sum(axis=1, keepdims=True) + alpha * buckets)
+    weights = (log_probs[1] - log_probs[0]).astype(np.float32)
+    return PrefilterModel(weights, math.log(totals[1] / totals[0]), -math.inf, math.inf)
+
+
+def choose_thresholds(scores, labels, target_precision=prefilter_target_precision, max_missed=prefilter_max_missed):
+    # low: нижче нього лежить не більше max_missed усього спаму; high: вище нього точність не менша за target_precision
+    order = np.argsort(scores)
+    scores, labels = scores[order], labels[order]
+    spam_total = labels.sum()
+    missed = np.cumsum(labels)  # Спам серед перших i+1 оцінок
+    allowed = np.nonzero(missed <= max_missed * spam_total)[0]
+    low = scores[allowed[-1] + 1] if len(allowed) and allowed[-1] + 1 < len(scores) else -math.inf
+    spam_above = spam_total - np.concatenate(([0], missed[:-1]))
+    precision = spam_above / (len(scores) - np.arange(len(scores)))
+    # Поріг має тримати точність для будь-якої вищої межі, тож беремо мінімум по суфіксу
+    reliable = np.nonzero(np.minimum.accumulate(precision[::-1])[::-1] >= target_precision)[0]
+    high = scores[reliable[0]] if len(reliable) else math.inf
+    return float(low), max(float(high), float(low))
+
+
+def evaluate(model, samples):
+    started = time.perf_counter()
+    verdicts = [model.verdict(text) for text, _ in samples]
+    elapsed = time.perf_counter() - started
+    local = [(verdict, label) for verdict, (_, label) in zip(verdicts, samples) if verdict is not None]
+    spam_total = sum(label for _, label in samples)
+    # Perspective вважається еталоном: похибка конвеєра виникає лише з локальних вердиктів
+    false_spam = sum(1 for verdict, label in local if verdict and not label)
+    true_spam = sum(1 for verdict, label in local if verdict and label) + \
+        sum(label for verdict, (_, label) in zip(verdicts, samples) if verdict is None)
+    missed = sum(1 for verdict, label in local if not verdict and label)
+    return {
+        'samples': len(samples),
+        'remote_reduction': len(local) / len(samples) if samples else 0.0,
+        'local_clean': sum(1 for verdict, _ in local if not verdict),
+        'local_spam': sum(1 for verdict, _ in local if verdict),
+        'precision': true_spam / (true_spam + false_spam) if true_spam + false_spam else 1.0,
+        'missed_spam': missed / spam_total if spam_total else 0.0,
+        'us_per_message': elapsed / len(samples) * 1e6 if samples else 0.0
+    }
+
+
+def load_corpus(path):
+    with open(path, encoding='utf-8') as file:
+        return [(sample['text'], int(sample['label'])) for sample in map(json.loads, file) if sample['text'].strip()]
+
+
+def export_corpus(path, db_file=DB_FILE, log_file=LOG_FILE):
+    from checks import is_spam_score
+    samples = {}
+    # Тексти, які вже оцінила Perspective: мітка — вердикт за поточними порогами бота
+    with sqlite3.connect(db_file) as conn:
+        for text, spam_score, toxicity_score in conn.execute(
+                "SELECT text, spam, toxicity FROM text_scores WHERE text IS NOT NULL"):
+            samples[normalize_text(text)] = (text, int(is_spam_score(spam_score, toxicity_score)))
+        confirmed = {user_id for user_id, count in conn.execute("SELECT user_id, count FROM violations") if count > 0}
+
+    # Порушення з логу. Автоматичний мут, який адміністратор зняв, а лічильник порушень обнулився, —
+    # хибне спрацювання: такий текст іде в корпус як чистий
+    flagged = []
+    unmuted = set()
+    released = set()
+    try:
+        with open(log_file, encoding='utf-8', errors='replace') as file:
+            for line in file:
+                match = LOG_LINE.search(line.rstrip('\n'))
+                if not match or match['text'] in ('', 'N/A'):
+                    continue
+                if match['event'] == UNMUTE_EVENT:
+                    unmuted.add(int(match['user_id']))
+                    released.add(normalize_text(match['text']))
+                    samples[normalize_text(match['text'])] = (match['text'], 0)
+                elif match['event'] in SPAM_EVENTS:
+                    flagged.append((int(match['user_id']), match['event'], match['text']))
+    except FileNotFoundError:
+        print(f"{Fore.YELLOW}Лог не знайдено:{Style.RESET_ALL} {log_file}")
+    for user_id, event, text in flagged:
+        reverted = user_id in unmuted and user_id not in confirmed and not event.startswith("Ban")
+        if not reverted and normalize_text(text) not in released:
+            samples[normalize_text(text)] = (text, 1)
+
+    with open(path, 'w', encoding='utf-8') as file:
+        for text, label in samples.values():
+            file.write(json.dumps({'text': text, 'label': label}, ensure_ascii=False) + '\n')
+    spam = sum(label for _, label in samples.values())
+    print(f"{Fore.GREEN}Корпус збережено:{Style.RESET_ALL} {path} | прикладів {len(samples)} | спаму {spam}")
+
+
+def train(corpus_path, model_path=PREFILTER_MODEL_FILE):
+    samples = load_corpus(corpus_path)
+    random.Random(0).shuffle(samples)
+    split = int(len(samples) * (1 - prefilter_validation_share))
+    model = fit(samples[:split])
+    validation = samples[split:]
+    scores = np.array([model.score(text) for text, _ in validation])
+    labels = np.array([label for _, label in validation])
+    if labels.any():
+        model.low, model.high = choose_thresholds(scores, labels)
+    model.save(model_path)
+    print(f"{Fore.GREEN}Модель збережено:{Style.RESET_ALL} {model_path} | навчання {split} | перевірка {len(validation)} | "
+          f"невизначена смуга [{model.low:.2f}, {model.high:.2f})")
+    print_report(evaluate(model, validation))
+
+
+def print_report(report):
+    print(f"{Fore.CYAN}Прикладів:{Style.RESET_ALL} {report['samples']}")
+    print(f"{Fore.CYAN}Без запиту до Perspective:{Style.RESET_ALL} {report['remote_reduction']:.1%} "
+          f"(чистих {report['local_clean']}, спаму {report['local_spam']})")
+    print(f"{Fore.CYAN}Точність вердикту «спам»:{Style.RESET_ALL} {report['precision']:.2%} "
+          f"(втрата {1 - report['precision']:.2%})")
+    print(f"{Fore.CYAN}Пропущено спаму:{Style.RESET_ALL} {report['missed_spam']:.2%}")
+    print(f"{Fore.CYAN}Час оцінки:{Style.RESET_ALL} {report['us_per_message']:.1f} мкс на повідомлення")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Локальний попередній фільтр спаму")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help="зібрати розмічений корпус з violations.db і bot_logs.log")
+    export_parser.add_argument('corpus')
+    export_parser.add_argument('--db', default=DB_FILE)
+    export_parser.add_argument('--log', default=LOG_FILE)
+    train_parser = commands.add_parser('train', help="навчити модель на корпусі JSONL ({\"text\", \"label\"})")
+    train_parser.add_argument('corpus')
+    train_parser.add_argument('--model', default=PREFILTER_MODEL_FILE)
+    evaluate_parser = commands.add_parser('evaluate', help="оцінити модель на розміченому корпусі")
+    evaluate_parser.add_argument('corpus')
+    evaluate_parser.add_argument('--model', default=PREFILTER_MODEL_FILE)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_corpus(args.corpus, args.db, args.log)
+    elif args.command == 'train':
+        train(args.corpus, args.model)
+    else:
+        print_report(evaluate(PrefilterModel.load(args.model), load_corpus(args.corpus)))
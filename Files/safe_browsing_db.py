@@ -0,0 +1,326 @@
+import base64
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from utils import SAFE_BROWSING_API_KEY, TTLCache
+from http_client import http_client, HttpError
+from colorama import init, Fore, Style
+
+# Ініціалізація colorama
+init()
+
+# Локальна копія списків хеш-префіксів Safe Browsing v4 (Update API).
+# Більшість посилань перевіряється без мережі: бінарний пошук у відсортованому файлі, відображеному в пам'ять.
+# Запит fullHashes:find надсилається лише тоді, коли префікс хешу URL знайдено у списку.
+
+SAFE_BROWSING_API_BASE = os.getenv('SAFE_BROWSING_API_BASE', "https://safebrowsing.googleapis.com/v4")
+SAFE_BROWSING_CLIENT = {"clientId": "SpamBot", "clientVersion": "1.0.0"}
+THREAT_TYPES = ["MALWARE", "SOCIAL_ENGINEERING", "UNWANTED_SOFTWARE", "POTENTIALLY_HARMFUL_APPLICATION"]
+PLATFORM_TYPE = "ANY_PLATFORM"
+THREAT_ENTRY_TYPE = "URL"
+
+sync_interval = 1800
+sync_retry_interval = 60
+full_hash_ttl = 300
+max_database_entries = 0  # 0 — без обмеження з боку клієнта
+
+PREFIX_FILE_MAGIC = b'SBP1'
+_header = struct.Struct('<4sI')
+_group = struct.Struct('<B3xIQ')  # розмір префікса, кількість, зсув блоку
+
+
+def _duration(value, default):
+    try:
+        return float(str(value).rstrip('s'))
+    except (TypeError, ValueError):
+        return default
+
+
+def url_expressions(canonical_url):
+    # Комбінації суфіксів хоста та префіксів шляху за специфікацією Safe Browsing (до 5 x 6 виразів)
+    rest = canonical_url.split('://', 1)[-1]
+    host, _, path_query = rest.partition('/')
+    path, has_query, query = ('/' + path_query).partition('?')
+
+    hosts = [host]
+    if not re.fullmatch(r'\d+\.\d+\.\d+\.\d+', host):
+        parts = host.split('.')
+        for count in range(min(5, len(parts) - 1), 1, -1):
+            suffix = '.'.join(parts[-count:])
+            if suffix != host:
+                hosts.append(suffix)
+        hosts = hosts[:5]
+
+    paths = [path + '?' + query] if has_query else []
+    paths.append(path)
+    prefix = '/'
+    prefixes = [prefix]
+    for component in path.split('/')[1:-1][:3]:
+        prefix += component + '/'
+        prefixes.append(prefix)
+    for prefix in prefixes:
+        if prefix not in paths:
+            paths.append(prefix)
+
+    return [host + path for host in hosts for path in paths[:6]]
+
+
+def url_full_hashes(canonical_url):
+    return [hashlib.sha256(expression.encode('latin-1')).digest() for expression in url_expressions(canonical_url)]
+
+
+class PrefixFile:
+    # Формат: заголовок, таблиця груп (по одній на довжину префікса), далі відсортовані блоки префіксів
+    def __init__(self, path):
+        self.path = path
+        # mmap тримає власний дескриптор, тож файл закривається одразу, а відображення живе, доки на нього є посилання
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, group_count = _header.unpack_from(self._mmap, 0)
+        if magic != PREFIX_FILE_MAGIC:
+            raise ValueError(f"Невідомий формат файлу {path}")
+        self.groups = [_group.unpack_from(self._mmap, _header.size + i * _group.size) for i in range(group_count)]
+        self.count = sum(count for _, count, _ in self.groups)
+
+    @staticmethod
+    def write(path, prefixes):
+        groups = {}
+        for prefix in prefixes:
+            groups.setdefault(len(prefix), []).append(prefix)
+        offset = _header.size + len(groups) * _group.size
+        table, blocks = [], []
+        for size in sorted(groups):
+            block = b''.join(sorted(groups[size]))
+            table.append(_group.pack(size, len(groups[size]), offset))
+            blocks.append(block)
+            offset += len(block)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(_header.pack(PREFIX_FILE_MAGIC, len(groups)))
+            file.writelines(table)
+            file.writelines(blocks)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    def find_prefix(self, full_hash):
+        data = self._mmap
+        for size, count, offset in self.groups:
+            key = full_hash[:size]
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                start = offset + middle * size
+                value = data[start:start + size]
+                if value < key:
+                    low = middle + 1
+                elif value > key:
+                    high = middle
+                else:
+                    return key
+        return None
+
+    def prefixes(self):
+        data = self._mmap
+        result = []
+        for size, count, offset in self.groups:
+            result.extend(data[offset + i * size:offset + (i + 1) * size] for i in range(count))
+        result.sort()
+        return result
+
+
+class LocalSafeBrowsingDB:
+    def __init__(self, data_dir, api_key=SAFE_BROWSING_API_KEY, api_base=SAFE_BROWSING_API_BASE):
+        self.data_dir = data_dir
+        self.api_key = api_key
+        self.api_base = api_base.rstrip('/')
+        self.states = dict.fromkeys(THREAT_TYPES, "")
+        self.lists = {}  # {threat_type: PrefixFile}
+        self.full_hash_cache = TTLCache(full_hash_ttl, maxsize=100000)  # {full_hash: True} для підтверджених загроз
+        self.negative_cache = TTLCache(full_hash_ttl, maxsize=100000)  # {prefix: True}, якщо повних збігів немає
+        self.prefix_hits = 0
+        self.lookups = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        os.makedirs(data_dir, exist_ok=True)
+        self._load()
+
+    @property
+    def ready(self):
+        return len(self.lists) == len(THREAT_TYPES)
+
+    def _state_path(self):
+        return os.path.join(self.data_dir, "state.json")
+
+    def _list_path(self, threat_type):
+        return os.path.join(self.data_dir, f"{threat_type.lower()}.bin")
+
+    def _load(self):
+        try:
+            with open(self._state_path(), 'r', encoding='utf-8') as file:
+                states = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        for threat_type in THREAT_TYPES:
+            if not states.get(threat_type) or not os.path.exists(self._list_path(threat_type)):
+                continue
+            try:
+                self.lists[threat_type] = PrefixFile(self._list_path(threat_type))
+                self.states[threat_type] = states[threat_type]
+            except (OSError, ValueError, struct.error) as e:
+                print(f"{Fore.RED}Помилка читання локальної бази Safe Browsing:{Style.RESET_ALL} {e}")
+
+    def _save_states(self):
+        temp_path = self._state_path() + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.states, file)
+        os.replace(temp_path, self._state_path())
+
+    def _post(self, method, payload):
+        response = http_client.post(f"safe_browsing_{method.split(':')[0]}", f"{self.api_base}/{method}?key={self.api_key}",
+                                    json=payload, timeout=30)
+        if response.status_code != 200:
+            raise HttpError(f"{response.status_code} - {response.text}")
+        try:
+            return response.json()
+        except ValueError as e:
+            raise HttpError(f"некоректна відповідь {method}: {e}") from e
+
+    def sync(self):
+        payload = {
+            "client": SAFE_BROWSING_CLIENT,
+            "listUpdateRequests": [{
+                "threatType": threat_type,
+                "platformType": PLATFORM_TYPE,
+                "threatEntryType": THREAT_ENTRY_TYPE,
+                "state": self.states[threat_type],
+                "constraints": {"maxDatabaseEntries": max_database_entries, "supportedCompressions": ["RAW"]}
+            } for threat_type in THREAT_TYPES]
+        }
+        result = self._post("threatListUpdates:fetch", payload)
+        for list_update in result.get("listUpdateResponses", []):
+            if list_update.get("threatType") in self.states:
+                self._apply_update(list_update)
+        self._save_states()
+        return _duration(result.get("minimumWaitDuration"), 0)
+
+    def _apply_update(self, list_update):
+        threat_type = list_update["threatType"]
+        current = self.lists.get(threat_type)
+        if list_update.get("responseType") == "FULL_UPDATE" or current is None:
+            prefixes = []
+        else:
+            prefixes = current.prefixes()
+
+        removed = set()
+        for removal in list_update.get("removals", []):
+            removed.update(removal.get("rawIndices", {}).get("indices", []))
+        if removed:
+            prefixes = [prefix for index, prefix in enumerate(prefixes) if index not in removed]
+
+        for addition in list_update.get("additions", []):
+            raw_hashes = addition.get("rawHashes", {})
+            size = raw_hashes.get("prefixSize", 4)
+            data = base64.b64decode(raw_hashes.get("rawHashes", ""))
+            prefixes.extend(data[i:i + size] for i in range(0, len(data), size))
+        prefixes.sort()
+
+        expected = list_update.get("checksum", {}).get("sha256")
+        if expected and hashlib.sha256(b''.join(prefixes)).digest() != base64.b64decode(expected):
+            # Розбіжність контрольної суми: наступна синхронізація запросить повне оновлення
+            print(f"{Fore.YELLOW}Контрольна сума списку {threat_type} не збігається, потрібне повне оновлення.{Style.RESET_ALL}")
+            self.states[threat_type] = ""
+            return
+
+        PrefixFile.write(self._list_path(threat_type), prefixes)
+        with self._lock:
+            self.lists[threat_type] = PrefixFile(self._list_path(threat_type))
+            self.states[threat_type] = list_update.get("newClientState", "")
+        # Старий файл не закривається явно: find_prefix_hits читає списки без замка, і пошук, що ще тримає
+        # старий PrefixFile, дочитає його; відображення звільниться, коли зникне останнє посилання
+        print(f"{Fore.GREEN}Список {threat_type} оновлено:{Style.RESET_ALL} {len(prefixes)} префіксів")
+
+    def find_prefix_hits(self, canonical_url):
+        # Суто локальна частина перевірки: None — база ще не готова, [] — URL чистий
+        if not self.ready:
+            return None
+        self.lookups += 1
+        hits = []
+        for full_hash in url_full_hashes(canonical_url):
+            for threat_type, prefix_file in self.lists.items():
+                prefix = prefix_file.find_prefix(full_hash)
+                if prefix is not None:
+                    hits.append((full_hash, prefix, threat_type))
+        if hits:
+            self.prefix_hits += 1
+        return hits
+
+    def resolve_prefix_hits(self, hits):
+        # Підтвердження збігу префікса повним хешем; None — не вдалося отримати відповідь
+        unresolved = {}
+        for full_hash, prefix, threat_type in hits:
+            if self.full_hash_cache.get(full_hash):
+                return True
+            if not self.negative_cache.get(prefix):
+                unresolved.setdefault(prefix, set()).add(threat_type)
+        if not unresolved:
+            return False
+
+        threat_types = sorted(set().union(*unresolved.values()))
+        payload = {
+            "client": SAFE_BROWSING_CLIENT,
+            "clientStates": [self.states[threat_type] for threat_type in threat_types],
+            "threatInfo": {
+                "threatTypes": threat_types,
+                "platformTypes": [PLATFORM_TYPE],
+                "threatEntryTypes": [THREAT_ENTRY_TYPE],
+                "threatEntries": [{"hash": base64.b64encode(prefix).decode()} for prefix in unresolved]
+            }
+        }
+        try:
+            result = self._post("fullHashes:find", payload)
+        except (HttpError, ValueError) as e:
+            print(f"{Fore.RED}Помилка запиту fullHashes:find:{Style.RESET_ALL} {e}")
+            return None
+
+        for match in result.get("matches", []):
+            full_hash = base64.b64decode(match["threat"]["hash"])
+            self.full_hash_cache.set(full_hash, True, _duration(match.get("cacheDuration"), full_hash_ttl))
+        negative_ttl = _duration(result.get("negativeCacheDuration"), full_hash_ttl)
+        for prefix in unresolved:
+            self.negative_cache.set(prefix, True, negative_ttl)
+        return any(self.full_hash_cache.get(full_hash) for full_hash, _, _ in hits)
+
+    def lookup(self, canonical_url):
+        hits = self.find_prefix_hits(canonical_url)
+        if not hits:
+            return None if hits is None else False
+        return self.resolve_prefix_hits(hits)
+
+    def stats(self):
+        return {
+            'ready': self.ready,
+            'prefixes': sum(prefix_file.count for prefix_file in self.lists.values()),
+            'lookups': self.lookups,
+            'prefix_hits': self.prefix_hits,
+            'local_rate': 1 - self.prefix_hits / self.lookups if self.lookups else 0.0
+        }
+
+    def _run_sync(self):
+        while True:
+            try:
+                wait = max(self.sync(), sync_interval)
+            except (HttpError, ValueError, KeyError, OSError) as e:
+                print(f"{Fore.RED}Помилка синхронізації Safe Browsing:{Style.RESET_ALL} {e}")
+                wait = sync_retry_interval
+            time.sleep(wait)
+
+    def start_sync(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run_sync, daemon=True)
+            self._thread.start()
@@ -0,0 +1,101 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+# Єдиний планувальник відкладених подій (кік за непройдену перевірку, закінчення мута).
+# Події лежать у мінімальній купі за часом спрацювання, а потік спить рівно до найближчої з них,
+# тож додавання, скасування й спрацювання коштують O(log n) замість періодичного перегляду всіх записів.
+# Час подій — Unix-час (time.time()), як і until_date у Telegram.
+
+
+class Timer:
+    __slots__ = ('when', 'seq', 'callback', 'args')
+
+    def __init__(self, when, seq, callback, args):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+
+
+class Scheduler:
+    def __init__(self):
+        self.fired = 0
+        self.cancelled = 0
+        self._heap = []  # (when, seq, key); скасовані записи лишаються в купі до спрацювання або ущільнення
+        self._timers = {}  # {key: Timer} — лише живі події
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, key, when, callback, *args):
+        # Подія з тим самим ключем замінює попередню
+        with self._condition:
+            timer = Timer(when, next(self._counter), callback, args)
+            self._timers[key] = timer
+            heapq.heappush(self._heap, (when, timer.seq, key))
+            if self._heap[0][1] == timer.seq:
+                self._condition.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def cancel(self, key):
+        with self._condition:
+            if self._timers.pop(key, None) is None:
+                return False
+            self.cancelled += 1
+            # Купа з переважно скасованих записів перебудовується, щоб не росла без меж
+            if len(self._heap) > 2 * len(self._timers) + 64:
+                self._heap = [(timer.when, timer.seq, key) for key, timer in self._timers.items()]
+                heapq.heapify(self._heap)
+            return True
+
+    def __contains__(self, key):
+        with self._condition:
+            return key in self._timers
+
+    def __len__(self):
+        return len(self._timers)
+
+    def _next_due(self):
+        # Під замком: повертає (key, timer) події, що настала, або чекає на неї
+        while True:
+            if not self._heap:
+                self._condition.wait()
+                continue
+            when, seq, key = self._heap[0]
+            timer = self._timers.get(key)
+            if timer is None or timer.seq != seq:
+                heapq.heappop(self._heap)
+                continue
+            delay = when - time.time()
+            if delay > 0:
+                self._condition.wait(delay)
+                continue
+            heapq.heappop(self._heap)
+            del self._timers[key]
+            return key, timer
+
+    def _run(self):
+        while True:
+            with self._condition:
+                key, timer = self._next_due()
+                self.fired += 1
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'scheduled': len(self._timers),
+                'fired': self.fired,
+                'cancelled': self.cancelled
+            }
+
+
+scheduler = Scheduler()
@@ -0,0 +1,226 @@
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# Стан бота в пам'яті (мути, верифікація, останні повідомлення, звернення) живе в обмежених мапах:
+# кожен запис має час життя, кожна мапа — ліміт записів, а всі разом — спільний бюджет пам'яті.
+# Коли бюджет вичерпано, найдавніше використані записи найбільшої мапи витісняються першими.
+# Мапи з maxsize=None (стан модерації: мути, незавершені перевірки) не витісняються ніколи —
+# їхні записи зникають лише за TTL або коли їх прибирає сам бот. Мапи з ttl=None не мають строку життя.
+
+state_memory_budget = int(os.getenv('STATE_MEMORY_BUDGET', 64 * 1024 * 1024))  # Байтів на всі мапи разом
+state_sweep_interval = 60  # Як часто прибирати прострочені записи, секунди
+ENTRY_OVERHEAD = 120  # Приблизна ціна запису OrderedDict разом з обгорткою, байтів
+
+
+class MutedUser:
+    __slots__ = ('chat_id', 'until_date')
+
+    def __init__(self, chat_id, until_date):
+        self.chat_id = chat_id
+        self.until_date = until_date
+
+
+class PendingVerification:
+    __slots__ = ('chat_id', 'restricted_at')
+
+    def __init__(self, chat_id, restricted_at):
+        self.chat_id = chat_id
+        self.restricted_at = restricted_at
+
+
+class _Entry:
+    __slots__ = ('value', 'expires_at', 'size')
+
+    def __init__(self, value, expires_at, size):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+
+
+def estimate_size(value):
+    if hasattr(value, '__slots__'):
+        return sys.getsizeof(value) + sum(sys.getsizeof(getattr(value, slot)) for slot in value.__slots__)
+    return sys.getsizeof(value)
+
+
+class StateMap:
+    # Словникоподібна мапа з TTL та LRU; всі операції під спільним замком сховища
+    def __init__(self, store, name, ttl, maxsize):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.bytes = 0
+        self.evicted = 0
+        self.journal = None  # StateJournal з utils для мап, що переживають перезапуск
+        self._data = OrderedDict()
+
+    def _get_entry(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= now:
+            self._remove(key)
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        entry = self._data.pop(key)
+        self.bytes -= entry.size
+        self.store.bytes -= entry.size
+        return entry
+
+    def _evict_oldest(self):
+        self._remove(next(iter(self._data)))
+        self.evicted += 1
+
+    def get(self, key, default=None):
+        with self.store.lock:
+            entry = self._get_entry(key, time.monotonic())
+            if entry is not None:
+                return entry.value
+        # Поки стан після перезапуску ще завантажується, відсутній ключ шукається на диску
+        if self.journal is not None and self.journal.loading:
+            return self.journal.fetch(self, key, default)
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is None:
+            ttl = math.inf  # Запис живе, доки його не видалять явно
+        self._store(key, value, ttl)
+        if self.journal is not None:
+            self.journal.record(self.name, key, value, time.time() + ttl)
+
+    def restore(self, key, value, expires_at):
+        # Запис із диска: expires_at — Unix-час; наявний у пам'яті новіший запис не перезаписується
+        self.restore_many([(key, value, expires_at)])
+
+    def restore_many(self, records):
+        offset = time.monotonic() - time.time()
+        with self.store.lock:
+            for key, value, expires_at in records:
+                if expires_at + offset <= time.monotonic() or key in self._data:
+                    continue
+                size = ENTRY_OVERHEAD + sys.getsizeof(key) + estimate_size(value)
+                self._data[key] = _Entry(value, expires_at + offset, size)
+                self.bytes += size
+                self.store.bytes += size
+            while self.maxsize is not None and len(self._data) > self.maxsize:
+                self._evict_oldest()
+            self.store.enforce_budget()
+
+    def _store(self, key, value, ttl):
+        size = ENTRY_OVERHEAD + sys.getsizeof(key) + estimate_size(value)
+        with self.store.lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = _Entry(value, time.monotonic() + ttl, size)
+            self.bytes += size
+            self.store.bytes += size
+            while self.maxsize is not None and len(self._data) > self.maxsize:
+                self._evict_oldest()
+            self.store.enforce_budget()
+
+    def pop(self, key, default=None):
+        if self.journal is not None:
+            if self.journal.loading and key not in self:
+                self.journal.fetch(self, key)
+            self.journal.record(self.name, key, None, 0)
+        with self.store.lock:
+            if key not in self._data:
+                return default
+            entry = self._remove(key)
+            return entry.value if entry.expires_at > time.monotonic() else default
+
+    def items(self):
+        # Знімок живих записів: ітерувати можна без замка, навіть якщо мапу змінюють інші потоки
+        now = time.monotonic()
+        with self.store.lock:
+            return [(key, entry.value) for key, entry in self._data.items() if entry.expires_at > now]
+
+    def sweep(self, now):
+        expired = [key for key, entry in self._data.items() if entry.expires_at <= now]
+        for key in expired:
+            self._remove(key)
+        return len(expired)
+
+    def __getitem__(self, key):
+        with self.store.lock:
+            entry = self._get_entry(key, time.monotonic())
+            if entry is None:
+                raise KeyError(key)
+            return entry.value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if self.journal is not None:
+            self.journal.record(self.name, key, None, 0)
+        with self.store.lock:
+            if key not in self._data:
+                raise KeyError(key)
+            self._remove(key)
+
+    def __contains__(self, key):
+        with self.store.lock:
+            return self._get_entry(key, time.monotonic()) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+
+class StateStore:
+    def __init__(self, memory_budget, sweep_interval):
+        self.memory_budget = memory_budget
+        self.sweep_interval = sweep_interval
+        self.bytes = 0
+        self.lock = threading.RLock()
+        self.maps = {}
+        self._thread = None
+
+    def create_map(self, name, ttl, maxsize):
+        with self.lock:
+            state_map = self.maps[name] = StateMap(self, name, ttl, maxsize)
+        return state_map
+
+    def enforce_budget(self):
+        # Викликається під замком після кожного запису
+        while self.bytes > self.memory_budget:
+            evictable = [state_map for state_map in self.maps.values() if state_map.maxsize is not None and state_map._data]
+            if not evictable:
+                break
+            max(evictable, key=lambda state_map: state_map.bytes)._evict_oldest()
+
+    def sweep(self):
+        now = time.monotonic()
+        with self.lock:
+            return sum(state_map.sweep(now) for state_map in self.maps.values())
+
+    def _run(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            self.sweep()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'bytes': self.bytes,
+                'budget': self.memory_budget,
+                'maps': {name: {'entries': len(state_map), 'bytes': state_map.bytes, 'evicted': state_map.evicted}
+                         for name, state_map in self.maps.items()}
+            }
+
+
+state_store = StateStore(state_memory_budget, state_sweep_interval)
@@ -1,11 +1,19 @@
 import sqlite3
+import hashlib
 import json
+import atexit
 import re
-from collections import defaultdict
+import socket
+from urllib.parse import unquote_to_bytes
+import threading
+import traceback
+from collections import deque, OrderedDict
 import time
 from dotenv import load_dotenv
 import os
 import logging
+from state_store import state_store, MutedUser
+from scheduler import scheduler
 from colorama import init, Fore, Style
 
 # Ініціалізація colorama
@@ -33,37 +41,440 @@ if not PERSPECTIVE_API_KEY:
     print(f"{Fore.RED}Помилка:{Style.RESET_ALL} Perspective API ключ не знайдено у .env файлі.")
     PERSPECTIVE_API_KEY = ""
 
-user_messages = defaultdict(list)
-user_last_messages = {}
-user_last_reports = {}
-muted_users = {}  # Додано для відстеження всіх мутів: {user_id: {'chat_id': chat_id, 'until_date': timestamp}}
+# Обмежені мапи зі state_store: записи живуть не довше за ttl і витісняються за LRU при нестачі пам'яті
+user_last_reports = state_store.create_map('user_last_reports', ttl=600, maxsize=100000)  # Найдовший інтервал між зверненнями
+muted_users = state_store.create_map('muted_users', ttl=86400, maxsize=None)  # {user_id: MutedUser}, не витісняється
 curse_words_in_memory = []
 
+FLOOD_LIMITS_FILE = "flood_limits.json"  # Ліміти флуду для окремих чатів: {chat_id: {"messages": n, "seconds": s}}
+flood_time_limit = 10  # Типові ліміти: не більше flood_max_messages повідомлень за flood_time_limit секунд
+flood_max_messages = 3
+flood_sweep_interval = 60  # Як часто прибирати вікна користувачів, що замовкли
+recent_messages_window = 120  # Повідомлення порушника за цей час видаляються разом із порушенням, секунди
+recent_messages_per_user = 20  # Скільки останніх id повідомлень пам'ятати для пари (чат, користувач)
+recent_messages = state_store.create_map('recent_messages', ttl=recent_messages_window, maxsize=100000)  # {(chat_id, user_id): deque[(час, message_id)]}
+
+CURSE_WORDS_FILE = "curse_words.json"
+curse_words_reload_interval = 1.0  # Як часто (у секундах) перевіряти mtime файлу зі словами
+
+DB_FILE = "violations.db"
+_db_local = threading.local()
+
+# Підготовлені запити: однаковий текст SQL дозволяє sqlite3 брати скомпільований statement з кешу з'єднання
+SQL_LOAD_VIOLATIONS = "SELECT user_id, count FROM violations"
+SQL_STORE_VIOLATIONS = ("INSERT INTO violations (user_id, count) VALUES (?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET count = excluded.count")
+SQL_RESET_VIOLATIONS = "DELETE FROM violations WHERE user_id = ?"
+SQL_LOAD_TEXT_SCORES = "SELECT spam, toxicity, scored_at FROM text_scores WHERE text_hash = ? AND scored_at > ?"
+SQL_STORE_TEXT_SCORES = ("INSERT INTO text_scores (text_hash, spam, toxicity, scored_at, text) VALUES (?, ?, ?, ?, ?) "
+                         "ON CONFLICT(text_hash) DO UPDATE SET spam = excluded.spam, toxicity = excluded.toxicity, "
+                         "scored_at = excluded.scored_at, text = excluded.text")
+SQL_PURGE_TEXT_SCORES = "DELETE FROM text_scores WHERE scored_at <= ?"
+SQL_CLEAR_SCORED_TEXTS = "UPDATE text_scores SET text = NULL WHERE text IS NOT NULL"
+SQL_LOAD_STATE = "SELECT map, key, chat_id, at, expires_at FROM moderation_state WHERE expires_at > ?"
+SQL_FETCH_STATE = "SELECT chat_id, at, expires_at FROM moderation_state WHERE map = ? AND key = ? AND expires_at > ?"
+SQL_STORE_STATE = ("INSERT INTO moderation_state (map, key, chat_id, at, expires_at) VALUES (?, ?, ?, ?, ?) "
+                   "ON CONFLICT(map, key) DO UPDATE SET chat_id = excluded.chat_id, at = excluded.at, "
+                   "expires_at = excluded.expires_at")
+SQL_DELETE_STATE = "DELETE FROM moderation_state WHERE map = ? AND key = ?"
+SQL_PURGE_STATE = "DELETE FROM moderation_state WHERE expires_at <= ?"
+
+violations_flush_interval = 0.25  # Максимальна затримка запису змін на диск, секунди
+violations_flush_batch = 200  # Кількість змін, після якої запис запускається негайно
+
+text_scores_ttl = 7 * 24 * 3600  # Скільки зберігати оцінки Perspective для тексту, секунди
+text_scores_cache_size = 50000
+persist_text_scores = os.getenv('PERSIST_TEXT_SCORES', '1') != '0'
+# Зберігати сам текст — корпус для навчання prefilter.py. Лише за явною згодою (STORE_SCORED_TEXTS=1):
+# це повідомлення користувачів; живуть вони стільки ж, скільки оцінки, а після вимкнення стираються
+store_scored_texts = os.getenv('STORE_SCORED_TEXTS', '0') == '1'
+text_scores_flush_interval = 1.0  # Максимальна затримка запису нових оцінок на диск, секунди
+text_scores_flush_batch = 200
+text_scores_purge_interval = 3600  # Як часто видаляти з диска оцінки й тексти, старші за text_scores_ttl, секунди
+
+state_flush_interval = 0.5  # Максимальна затримка запису змін стану модерації на диск, секунди
+state_flush_batch = 500
+
+def get_db_connection():
+    # Одне довгоживуче з'єднання на потік замість connect/close на кожен запит
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, timeout=5, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+    return conn
+
 class DBConnection:
     def __enter__(self):
-        self.conn = sqlite3.connect("violations.db")
+        self.conn = get_db_connection()
         self.cursor = self.conn.cursor()
         return self.cursor
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type is not None:
             print(f"{Fore.RED}Помилка при виконанні запиту:{Style.RESET_ALL} {exc_val}")
-        self.conn.commit()
-        self.conn.close()
+            self.conn.rollback()
+        else:
+            self.conn.commit()
+        self.cursor.close()
+
+class TTLCache:
+    # Потокобезпечний LRU-кеш із часом життя записів та лічильниками влучань/промахів
+    def __init__(self, ttl, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+_invisible_chars = dict.fromkeys(map(ord, '\u200b\u200c\u200d\u2060\ufeff'))
+
+def normalize_text(text):
+    # Регістр, невидимі символи та пробіли не змінюють суть тексту, тож не мають створювати новий запис у кеші
+    return ' '.join(text.translate(_invisible_chars).casefold().split())
+
+def text_hash(text):
+    return hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=16).digest()
+
+# Сирі оцінки SPAM/TOXICITY за хешем нормалізованого тексту: LRU у пам'яті та, за бажанням, таблиця в SQLite.
+# Зберігаються саме оцінки, а не вердикт, тож зміна порогів не робить кеш недійсним.
+# Нові оцінки потрапляють на диск пакетами з окремого потоку, як і лічильники порушень
+class TextScoreCache:
+    def __init__(self, ttl, maxsize, persist, flush_interval, flush_batch):
+        self.ttl = ttl
+        self.persist = persist
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.memory = TTLCache(ttl, maxsize)
+        self.stored_hits = 0
+        self._dirty = {}  # {хеш тексту: рядок для запису}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def peek(self, text):
+        # Лише пам'ять: для циклу подій, де читання з диска має йти в окремому потоці
+        return self.memory.get(text_hash(text))
+
+    def get(self, text):
+        key = text_hash(text)
+        scores = self.memory.get(key)
+        if scores is not None or not self.persist:
+            return scores
+        try:
+            with DBConnection() as cursor:
+                cursor.execute(SQL_LOAD_TEXT_SCORES, (key, time.time() - self.ttl))
+                row = cursor.fetchone()
+        except sqlite3.Error as e:
+            print(f"{Fore.RED}Помилка читання кешу оцінок:{Style.RESET_ALL} {e}")
+            return None
+        if row is None:
+            return None
+        spam_score, toxicity_score, scored_at = row
+        scores = (spam_score, toxicity_score)
+        self.memory.set(key, scores, scored_at + self.ttl - time.time())
+        self.stored_hits += 1
+        return scores
+
+    def set(self, text, spam_score, toxicity_score):
+        key = text_hash(text)
+        self.memory.set(key, (spam_score, toxicity_score))
+        if not self.persist:
+            return
+        with self._lock:
+            self._dirty[key] = (key, spam_score, toxicity_score, time.time(), text if store_scored_texts else None)
+            if len(self._dirty) >= self.flush_batch:
+                self._wakeup.set()
+
+    def start(self):
+        if self.persist and self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                changes = self._dirty
+                self._dirty = {}
+            try:
+                with DBConnection() as cursor:
+                    cursor.executemany(SQL_STORE_TEXT_SCORES, list(changes.values()))
+            except sqlite3.Error as e:
+                print(f"{Fore.RED}Помилка запису кешу оцінок:{Style.RESET_ALL} {e}")
+                with self._lock:
+                    for key, row in changes.items():
+                        self._dirty.setdefault(key, row)
+                return 0
+            return len(changes)
+
+    def purge(self):
+        try:
+            with DBConnection() as cursor:
+                cursor.execute(SQL_PURGE_TEXT_SCORES, (time.time() - self.ttl,))
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"{Fore.RED}Помилка очищення кешу оцінок:{Style.RESET_ALL} {e}")
+            return 0
+
+    def _run(self):
+        purged_at = time.monotonic()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            # Бот може працювати тижнями, тож строк зберігання тримається не лише під час старту
+            if time.monotonic() - purged_at >= text_scores_purge_interval:
+                purged_at = time.monotonic()
+                self.purge()
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats['stored_hits'] = self.stored_hits
+        with self._lock:
+            stats['pending_writes'] = len(self._dirty)
+        return stats
+
+text_score_cache = TextScoreCache(text_scores_ttl, text_scores_cache_size, persist_text_scores,
+                                  text_scores_flush_interval, text_scores_flush_batch)
+
+# Відро токенів: rate токенів за секунду, але не більше capacity про запас
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        # 0 — токени видано; інакше скільки секунд чекати до наступної спроби
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def refund(self, tokens=1):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+# Пул потоків із чергою на кожен ключ (чат): повідомлення одного чату обробляються строго по черзі,
+# різні чати — паралельно, а загальна глибина черги обмежена
+class KeyedWorkerPool:
+    def __init__(self, workers=8, max_pending=1000):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.processed = 0
+        self._queues = {}  # {key: deque[(enqueued_at, func, args)]}, ключ присутній, поки в нього є робота
+        self._ready = deque()
+        self._pending = 0
+        self._busy = 0
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._threads = []
+
+    def start(self):
+        for _ in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, func, *args):
+        with self._not_full:
+            while self._pending >= self.max_pending:
+                self._not_full.wait()
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+                self._ready.append(key)
+                self._has_work.notify()
+            queue.append((time.monotonic(), func, args))
+            self._pending += 1
+
+    def _work(self):
+        while True:
+            with self._has_work:
+                while not self._ready:
+                    self._has_work.wait()
+                key = self._ready.popleft()
+                _, func, args = self._queues[key].popleft()
+                self._pending -= 1
+                self._busy += 1
+                self._not_full.notify()
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    self.processed += 1
+                    if self._queues[key]:
+                        # Ключ повертається в кінець черги, щоб один активний чат не монополізував потоки
+                        self._ready.append(key)
+                        self._has_work.notify()
+                    else:
+                        del self._queues[key]
+
+    def stats(self, top=5):
+        now = time.monotonic()
+        with self._lock:
+            lags = [(key, now - queue[0][0]) for key, queue in self._queues.items() if queue]
+            stats = {
+                'pending': self._pending,
+                'busy': self._busy,
+                'workers': self.workers,
+                'utilization': self._busy / self.workers if self.workers else 0.0,
+                'active_chats': len(self._queues),
+                'processed': self.processed
+            }
+        lags.sort(key=lambda item: item[1], reverse=True)
+        stats['lagging_chats'] = lags[:top]
+        return stats
+
+def _fully_unescape(value):
+    while True:
+        unescaped = unquote_to_bytes(value)
+        if unescaped == value:
+            return value
+        value = unescaped
+
+def _escape_url_part(value):
+    return ''.join(f"%{ord(ch):02X}" if ord(ch) <= 32 or ord(ch) >= 127 or ch in '#%' else ch for ch in value)
+
+def _canonical_host(host):
+    # host — байти UTF-8, прочитані як latin-1: малими стають лише ASCII-літери, інакше str.lower()
+    # змінив би й байти багатобайтових символів (0xD0 → 0xF0) і хеш вийшов би для іншої адреси
+    host = re.sub(r'\.{2,}', '.', host.strip('.')).encode('latin-1').lower().decode('latin-1')
+    if re.fullmatch(r'[0-9a-fx.]+', host) and not host.endswith('.'):
+        try:
+            # inet_aton розуміє десяткову, шістнадцяткову, вісімкову та скорочену форми IPv4
+            return socket.inet_ntoa(socket.inet_aton(host))
+        except OSError:
+            pass
+    return host
+
+def _canonical_path(path):
+    segments = []
+    for segment in path.split('/'):
+        if segment in ('', '.'):
+            continue
+        if segment == '..':
+            if segments:
+                segments.pop()
+            continue
+        segments.append(segment)
+    trailing = path.endswith(('/', '/.', '/..')) and segments
+    return '/' + '/'.join(segments) + ('/' if trailing else '')
+
+def canonicalize_url(url):
+    # Канонізація за правилами Safe Browsing: однакові посилання в різному записі мають один ключ у кешах
+    url = re.sub(r'[\t\r\n]', '', url.strip()).split('#', 1)[0]
+    if '://' not in url:
+        url = 'http://' + url
+    url = _fully_unescape(url.encode('utf-8')).decode('latin-1')
+    scheme, rest = url.split('://', 1)
+    authority_end = len(rest)
+    for separator in ('/', '?'):
+        position = rest.find(separator)
+        if position != -1:
+            authority_end = min(authority_end, position)
+    authority, rest = rest[:authority_end], rest[authority_end:]
+    host = authority.rsplit('@', 1)[-1].split(':', 1)[0]
+    path, has_query, query = rest.partition('?')
+    canonical = f"{scheme.lower()}://{_escape_url_part(_canonical_host(host))}{_escape_url_part(_canonical_path(path))}"
+    if has_query:
+        canonical += '?' + _escape_url_part(query)
+    return canonical
+
+chat_title_ttl = 3600
+chat_title_cache = TTLCache(chat_title_ttl, maxsize=10000)
 
 def get_chat_title(bot, chat_id):
+    title = chat_title_cache.get(chat_id)
+    if title is not None:
+        return title
     try:
         chat = bot.getChat(chat_id)
-        return chat.get('title', f"Чат {chat_id}")
+        title = chat.get('title', f"Чат {chat_id}")
+        chat_title_cache.set(chat_id, title)
+        return title
     except Exception as e:
         print(f"Помилка отримання назви чату: {e}")
         return f"Чат {chat_id}"
 
-def check_duplicate_messages(user_id, text):
-    if user_id in user_last_messages and user_last_messages[user_id] == text:
-        return True
-    user_last_messages[user_id] = text
-    return False
+def remember_chat_title(chat):
+    # Назва групи приходить разом з кожним повідомленням, тож кеш наповнюється без запиту getChat
+    title = chat.get('title')
+    if title:
+        chat_title_cache.set(chat['id'], title)
+
+def invalidate_chat_title(chat_id):
+    chat_title_cache.invalidate(chat_id)
+
+member_status_ttl = 60
+chat_admins_ttl = 300
+member_status_cache = TTLCache(member_status_ttl, maxsize=50000)  # {(chat_id, user_id): ChatMember}
+chat_admins_cache = TTLCache(chat_admins_ttl, maxsize=10000)  # {chat_id: {user_id: ChatMember}}
 
 def get_username(msg):
     user = msg.get('from', {})
@@ -71,18 +482,118 @@ def get_username(msg):
     first_name = user.get('first_name', '')
     return username if username else first_name if first_name else 'користувач'
 
-def check_spam(user_id, time_limit=10, max_messages=5):
-    current_time = time.time()
-    user_messages[user_id].append(current_time)
-    user_messages[user_id] = [msg_time for msg_time in user_messages[user_id] if current_time - msg_time <= time_limit]
-    return len(user_messages[user_id]) > max_messages
+# Ковзне вікно на пару (чат, користувач): кільцевий буфер з max_messages + 1 останніх міток часу.
+# Флуд — коли найстаріша з них не старша за time_limit, тож кожна перевірка коштує O(1)
+class FloodDetector:
+    def __init__(self, time_limit, max_messages, limits_file, sweep_interval):
+        self.default_limits = (time_limit, max_messages)
+        self.limits_file = limits_file
+        self.sweep_interval = sweep_interval
+        self.limits = {}  # {chat_id: (time_limit, max_messages)}
+        self._windows = {}  # {(chat_id, user_id): deque міток часу}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def load(self):
+        try:
+            with open(self.limits_file, 'r', encoding='utf-8') as file:
+                stored = json.load(file)
+            self.limits = {int(chat_id): (limits['seconds'], limits['messages']) for chat_id, limits in stored.items()}
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"{Fore.RED}Помилка читання лімітів флуду:{Style.RESET_ALL} {e}")
+
+    def get_limits(self, chat_id):
+        return self.limits.get(chat_id, self.default_limits)
+
+    def set_limits(self, chat_id, time_limit, max_messages):
+        with self._lock:
+            self.limits[chat_id] = (time_limit, max_messages)
+            stored = {str(chat): {'seconds': seconds, 'messages': messages}
+                      for chat, (seconds, messages) in self.limits.items()}
+        temp_path = self.limits_file + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(stored, file, indent=4)
+        os.replace(temp_path, self.limits_file)
+
+    def check(self, chat_id, user_id):
+        time_limit, max_messages = self.get_limits(chat_id)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get((chat_id, user_id))
+            if window is None or window.maxlen != max_messages + 1:
+                window = self._windows[(chat_id, user_id)] = deque(window or (), maxlen=max_messages + 1)
+            window.append(now)
+            flooded = len(window) == window.maxlen and now - window[0] <= time_limit
+            if now >= self._next_sweep:
+                self._sweep(now)
+        return flooded
+
+    def _sweep(self, now):
+        # Раз на sweep_interval: вікно, остання мітка якого старша за найдовший ліміт, уже нічого не вирішує
+        longest = max([self.default_limits[0]] + [seconds for seconds, _ in self.limits.values()])
+        idle = [key for key, window in self._windows.items() if now - window[-1] > longest]
+        for key in idle:
+            del self._windows[key]
+        self._next_sweep = now + self.sweep_interval
+
+    def __len__(self):
+        return len(self._windows)
+
+flood_detector = FloodDetector(flood_time_limit, flood_max_messages, FLOOD_LIMITS_FILE, flood_sweep_interval)
+
+def check_spam(chat_id, user_id):
+    return flood_detector.check(chat_id, user_id)
+
+def remember_message(chat_id, user_id, message_id):
+    key = (chat_id, user_id)
+    ring = recent_messages.get(key)
+    if ring is None:
+        ring = deque(maxlen=recent_messages_per_user)
+    ring.append((time.monotonic(), message_id))
+    recent_messages[key] = ring  # Повторний запис продовжує час життя кільця
+
+def take_recent_messages(chat_id, user_id, window=recent_messages_window):
+    # Забирає id недавніх повідомлень користувача в чаті; кільце очищується
+    ring = recent_messages.pop((chat_id, user_id))
+    if ring is None:
+        return []
+    cutoff = time.monotonic() - window
+    return [message_id for posted_at, message_id in ring if posted_at >= cutoff]
+
+def remember_mute(user_id, chat_id, until_date):
+    # Запис зникає разом із закінченням мута
+    muted_users.set(user_id, MutedUser(chat_id, until_date), ttl=max(until_date - time.time(), 1))
+    scheduler.schedule(('mute', user_id), until_date, expire_mute, user_id, until_date)
+
+def forget_mute(user_id):
+    # Мут знято або користувача забанено раніше строку
+    scheduler.cancel(('mute', user_id))
+    return muted_users.pop(user_id)
+
+def expire_mute(user_id, until_date):
+    # Telegram знімає обмеження сам за until_date, боту лишається забути мут
+    muted = muted_users.get(user_id)
+    if muted is None or muted.until_date != until_date:
+        return
+    muted_users.pop(user_id)
+    logging.info(
+        "Mute expired",
+        extra={
+            'chat_id': muted.chat_id,
+            'chat_title': chat_title_cache.get(muted.chat_id) or 'Unknown',
+            'user_id': user_id,
+            'username': 'Unknown',
+            'details': "Restrictions lifted by Telegram"
+        }
+    )
 
 def can_report(user_id, report_limit=120):
     current_time = time.time()
-    if user_id in user_last_reports:
-        last_report_time = user_last_reports[user_id]
-        if current_time - last_report_time < report_limit:
-            return False
+    last_report_time = user_last_reports.get(user_id)
+    if last_report_time is not None and current_time - last_report_time < report_limit:
+        return False
     user_last_reports[user_id] = current_time
     return True
 
@@ -93,50 +604,253 @@ def init_db():
                 user_id INTEGER PRIMARY KEY,
                 count INTEGER DEFAULT 0
             )''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS text_scores (
+                text_hash BLOB PRIMARY KEY,
+                spam REAL NOT NULL,
+                toxicity REAL NOT NULL,
+                scored_at REAL NOT NULL,
+                text TEXT
+            )''')
+            cursor.execute("PRAGMA table_info(text_scores)")
+            if 'text' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE text_scores ADD COLUMN text TEXT")
+            cursor.execute(SQL_PURGE_TEXT_SCORES, (time.time() - text_scores_ttl,))
+            cursor.execute('''CREATE TABLE IF NOT EXISTS moderation_state (
+                map TEXT NOT NULL,
+                key INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (map, key)
+            ) WITHOUT ROWID''')
+        violation_journal.load()
     except sqlite3.Error as e:
         print(f"{Fore.RED}Помилка при ініціалізації бази даних:{Style.RESET_ALL} {e}")
 
-def get_violations(user_id):
-    try:
+# Лічильники порушень живуть у пам'яті й читаються звідти, а на диск потрапляють пакетами
+# з окремого потоку: обробка повідомлень ніколи не чекає на fsync
+class ViolationJournal:
+    def __init__(self, flush_interval, flush_batch):
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._counts = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def load(self):
+        with DBConnection() as cursor:
+            cursor.execute(SQL_LOAD_VIOLATIONS)
+            rows = cursor.fetchall()
+        with self._lock:
+            for user_id, count in rows:
+                if user_id not in self._dirty:
+                    self._counts[user_id] = count
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _mark_dirty(self, user_id):
+        self._dirty.add(user_id)
+        if len(self._dirty) >= self.flush_batch:
+            self._wakeup.set()
+
+    def get(self, user_id):
+        return self._counts.get(user_id, 0)
+
+    def increment(self, user_id):
+        with self._lock:
+            previous = self._counts.get(user_id, 0)
+            self._counts[user_id] = previous + 1
+            self._mark_dirty(user_id)
+        return previous
+
+    def decrement(self, user_id):
+        with self._lock:
+            count = self._counts.get(user_id, 0)
+            if count <= 0:
+                return False
+            self._counts[user_id] = count - 1
+            self._mark_dirty(user_id)
+        return True
+
+    def reset(self, user_id):
+        with self._lock:
+            self._counts.pop(user_id, None)
+            self._mark_dirty(user_id)
+
+    def pending(self):
+        return len(self._dirty)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                changes = [(user_id, self._counts.get(user_id)) for user_id in self._dirty]
+                self._dirty.clear()
+            stored = [(user_id, count) for user_id, count in changes if count is not None]
+            removed = [(user_id,) for user_id, count in changes if count is None]
+            try:
+                with DBConnection() as cursor:
+                    cursor.executemany(SQL_STORE_VIOLATIONS, stored)
+                    cursor.executemany(SQL_RESET_VIOLATIONS, removed)
+            except sqlite3.Error as e:
+                print(f"{Fore.RED}Помилка при записі порушень у базу даних:{Style.RESET_ALL} {e}")
+                with self._lock:
+                    self._dirty.update(user_id for user_id, _ in changes)
+                return 0
+            return len(changes)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+violation_journal = ViolationJournal(violations_flush_interval, violations_flush_batch)
+
+# Мути й незавершені перевірки переживають перезапуск: таблиця moderation_state — знімок стану,
+# а зміни потрапляють у неї пакетами, як і лічильники порушень. Після старту знімок завантажується
+# у фоновому потоці, а поки він не дочитаний, промахи мап добирають конкретний ключ з диска.
+class StateJournal:
+    def __init__(self, flush_interval, flush_batch):
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.loading = True  # До кінця load() промахи мап перевіряються на диску
+        self._types = {}  # {назва мапи: (мапа, клас значення)}
+        self._dirty = {}  # {(назва мапи, ключ): рядок для запису або None — видалити}
+        self._touched = set()  # Ключі, змінені під час завантаження: знімок їх не перезаписує
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def track(self, state_map, value_type):
+        # Клас значення має два поля: чат і момент часу (MutedUser, PendingVerification)
+        self._types[state_map.name] = (state_map, value_type)
+        state_map.journal = self
+
+    def record(self, name, key, value, expires_at):
+        row = None if value is None else (name, key, value.chat_id, getattr(value, value.__slots__[1]), expires_at)
+        with self._lock:
+            self._dirty[(name, key)] = row
+            if self.loading:
+                self._touched.add((name, key))
+            if len(self._dirty) >= self.flush_batch:
+                self._wakeup.set()
+
+    def fetch(self, state_map, key, default=None):
+        with self._lock:
+            if (state_map.name, key) in self._touched:
+                return default
         with DBConnection() as cursor:
-            cursor.execute("SELECT count FROM violations WHERE user_id = ?", (user_id,))
+            cursor.execute(SQL_FETCH_STATE, (state_map.name, key, time.time()))
             row = cursor.fetchone()
-            return row[0] if row else 0
-    except sqlite3.Error as e:
-        print(f"{Fore.RED}Помилка при отриманні порушень для користувача {user_id}:{Style.RESET_ALL} {e}")
-        return 0
+        if row is None:
+            return default
+        chat_id, at, expires_at = row
+        state_map.restore(key, self._types[state_map.name][1](chat_id, at), expires_at)
+        return state_map.get(key, default)
+
+    def load(self):
+        # Повертає кількість відновлених записів
+        with self._lock:
+            self.loading = True
+        try:
+            with DBConnection() as cursor:
+                cursor.execute(SQL_PURGE_STATE, (time.time(),))
+                cursor.execute(SQL_LOAD_STATE, (time.time(),))
+                rows = cursor.fetchall()
+            records = {}
+            with self._lock:
+                for name, key, chat_id, at, expires_at in rows:
+                    if name in self._types and (name, key) not in self._touched:
+                        records.setdefault(name, []).append((key, self._types[name][1](chat_id, at), expires_at))
+            for name, state_records in records.items():
+                self._types[name][0].restore_many(state_records)
+            return sum(map(len, records.values()))
+        finally:
+            with self._lock:
+                self.loading = False
+                self._touched.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                changes = self._dirty
+                self._dirty = {}
+            try:
+                with DBConnection() as cursor:
+                    cursor.executemany(SQL_STORE_STATE, [row for row in changes.values() if row is not None])
+                    cursor.executemany(SQL_DELETE_STATE, [key for key, row in changes.items() if row is None])
+            except sqlite3.Error as e:
+                print(f"{Fore.RED}Помилка при записі стану модерації у базу даних:{Style.RESET_ALL} {e}")
+                with self._lock:
+                    for key, row in changes.items():
+                        self._dirty.setdefault(key, row)
+                return 0
+            return len(changes)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+state_journal = StateJournal(state_flush_interval, state_flush_batch)
+state_journal.track(muted_users, MutedUser)
+
+def restore_mutes():
+    # Після завантаження знімка: відновлені мути знову мають подію закінчення в планувальнику
+    for user_id, muted in muted_users.items():
+        scheduler.schedule(('mute', user_id), muted.until_date, expire_mute, user_id, muted.until_date)
+
+def get_violations(user_id):
+    return violation_journal.get(user_id)
 
 def update_violations(user_id):
-    try:
-        with DBConnection() as cursor:
-            cursor.execute("INSERT INTO violations (user_id, count) VALUES (?, 1) ON CONFLICT(user_id) DO UPDATE SET count = count + 1", (user_id,))
-    except sqlite3.Error as e:
-        print(f"{Fore.RED}Помилка при оновленні порушень для користувача {user_id}:{Style.RESET_ALL} {e}")
+    violation_journal.increment(user_id)
+
+def increment_violations(user_id):
+    # Атомарно збільшує лічильник і повертає кількість порушень ДО збільшення
+    return violation_journal.increment(user_id)
 
 def decrement_violations(user_id):
-    try:
-        with DBConnection() as cursor:
-            cursor.execute("""
-                UPDATE violations
-                SET count = CASE
-                    WHEN count > 0 THEN count - 1
-                    ELSE count
-                END
-                WHERE user_id = ?
-            """, (user_id,))
-            if cursor.rowcount == 0:
-                print(f"{Fore.YELLOW}Користувач з ID {user_id} не має порушень або не знайдений.{Style.RESET_ALL}")
-    except sqlite3.Error as e:
-        print(f"{Fore.RED}Помилка при зменшенні порушень для користувача {user_id}:{Style.RESET_ALL} {e}")
+    if not violation_journal.decrement(user_id):
+        print(f"{Fore.YELLOW}Користувач з ID {user_id} не має порушень або не знайдений.{Style.RESET_ALL}")
 
 def reset_violations(user_id):
-    try:
-        with DBConnection() as cursor:
-            cursor.execute("DELETE FROM violations WHERE user_id = ?", (user_id,))
-    except sqlite3.Error as e:
-        print(f"{Fore.RED}Помилка при скиданні порушень для користувача {user_id}:{Style.RESET_ALL} {e}")
+    violation_journal.reset(user_id)
 
-def add_curse_word(user, word, file_path="curse_words.json"):
+def flush_violations():
+    return violation_journal.flush()
+
+def forget_scored_texts():
+    # Викликається під час запуску бота, а не імпорту utils: prefilter.py теж імпортує utils і має бачити збережені тексти
+    if store_scored_texts:
+        return 0
+    with DBConnection() as cursor:
+        cursor.execute(SQL_CLEAR_SCORED_TEXTS)
+        return cursor.rowcount
+
+def flush_state():
+    flush_violations()
+    state_journal.flush()
+    text_score_cache.flush()
+
+def add_curse_word(user, word, file_path=CURSE_WORDS_FILE):
     try:
         curse_words = load_curse_words(file_path)
         if curse_words is None:
@@ -146,7 +860,7 @@ def add_curse_word(user, word, file_path="curse_words.json"):
         curse_words.append(word.lower())
         with open(file_path, "w", encoding="utf-8") as file:
             json.dump(curse_words, file, ensure_ascii=False, indent=4)
-        curse_words_in_memory[:] = curse_words
+        _install_curse_matcher(curse_words, _file_mtime(file_path))
         return f"Слово '{word}' було успішно додано до списку лайливих слів."
     except Exception as e:
         print(f"{Fore.RED}Помилка при додаванні слова:{Style.RESET_ALL} {e}")
@@ -172,16 +886,124 @@ def load_curse_words(file_path):
         print(f"{Fore.RED}Помилка при завантаженні лайливих слів:{Style.RESET_ALL} {e}")
         return None
 
-def check_for_curse_words(phrase, curse_words):
-    try:
-        phrase = phrase.lower().strip()
-        words_in_message = re.findall(r'\b\w+\b', phrase)
-        for word in curse_words:
-            if word in words_in_message:
+_word_pattern = re.compile(r'\w+')
+
+def tokenize(text):
+    return _word_pattern.findall(text.lower())
+
+# Скомпільований словник: окремі слова — у множині, фрази з кількох слів ("асёл прыдурак",
+# "кран-прысоска") — в автоматі Ахо-Корасік над токенами. Перевірка коштує O(токенів повідомлення).
+class CurseWordMatcher:
+    def __init__(self, curse_words):
+        self.words = frozenset(w.lower().strip() for w in curse_words if isinstance(w, str) and w.strip())
+        self.single_words = set()
+        phrases = []
+        for word in self.words:
+            tokens = tokenize(word)
+            if len(tokens) == 1:
+                self.single_words.add(tokens[0])
+            elif tokens:
+                phrases.append(tokens)
+        self._build_automaton(phrases)
+
+    def _build_automaton(self, phrases):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [False]
+        for phrase in phrases:
+            node = 0
+            for token in phrase:
+                next_node = self._goto[node].get(token)
+                if next_node is None:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(False)
+                    next_node = len(self._goto) - 1
+                    self._goto[node][token] = next_node
+                node = next_node
+            self._out[node] = True
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for token, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and token not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(token, 0)
+                self._out[child] = self._out[child] or self._out[self._fail[child]]
+
+    def __contains__(self, word):
+        return word.lower().strip() in self.words
+
+    def matches(self, phrase):
+        tokens = tokenize(phrase)
+        single_words = self.single_words
+        for token in tokens:
+            if token in single_words:
+                return True
+        if len(self._goto) == 1:
+            return False
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for token in tokens:
+            while node and token not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(token, 0)
+            if out[node]:
                 return True
         return False
+
+_curse_matcher = CurseWordMatcher([])
+_curse_matcher_mtime = None
+_curse_matcher_checked_at = None
+_curse_matcher_lock = threading.Lock()
+
+def _file_mtime(file_path):
+    try:
+        return os.stat(file_path).st_mtime_ns
+    except OSError:
+        return None
+
+def _install_curse_matcher(curse_words, mtime):
+    global _curse_matcher, _curse_matcher_mtime
+    matcher = CurseWordMatcher(curse_words)
+    with _curse_matcher_lock:
+        # Заміна посилання атомарна: потоки, що вже перевіряють повідомлення, дочитають старий словник
+        _curse_matcher = matcher
+        _curse_matcher_mtime = mtime
+        curse_words_in_memory[:] = curse_words
+    return matcher
+
+def get_curse_matcher(file_path=CURSE_WORDS_FILE):
+    global _curse_matcher_checked_at
+    now = time.monotonic()
+    if _curse_matcher_checked_at is not None and now - _curse_matcher_checked_at < curse_words_reload_interval:
+        return _curse_matcher
+    _curse_matcher_checked_at = now
+    mtime = _file_mtime(file_path)
+    if mtime is None or mtime == _curse_matcher_mtime:
+        return _curse_matcher
+    curse_words = load_curse_words(file_path)
+    if curse_words is None:
+        return _curse_matcher
+    print(f"{Fore.GREEN}Словник лайливих слів завантажено:{Style.RESET_ALL} {len(curse_words)} слів")
+    return _install_curse_matcher(curse_words, mtime)
+
+def check_for_curse_words(phrase, matcher=None):
+    try:
+        if matcher is None:
+            matcher = get_curse_matcher()
+        return matcher.matches(phrase)
     except Exception as e:
         print(f"{Fore.RED}Помилка при перевірці фрази на лайливі слова:{Style.RESET_ALL} {e}")
         return False
 
-init_db()
\ No newline at end of file
+init_db()
+violation_journal.start()
+state_journal.start()
+text_score_cache.start()
+flood_detector.load()
+state_store.start()
+atexit.register(flush_state)
\ No newline at end of file
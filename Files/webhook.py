@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import hmac
+import json
+import os
+import random
+import secrets
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from aiohttp import web
+from colorama import init, Fore, Style
+
+# Ініціалізація colorama
+init()
+
+# Отримання оновлень через вебхук замість getUpdates: Telegram сам надсилає POST на вбудований
+# HTTP-сервер, і бот не тримає довгих запитів опитування. Кожен запит перевіряється за заголовком
+# X-Telegram-Bot-Api-Secret-Token, який Telegram додає після реєстрації вебхука з secret_token.
+#
+# Локальна перевірка без Telegram (WEBHOOK_URL не задано — вебхук не реєструється):
+#   python main.py --webhook                                             — сервер на WEBHOOK_PORT
+#   python webhook.py generate updates.jsonl --count 10000                — синтетичні оновлення
+#   python webhook.py replay updates.jsonl --rate 2000 --secret <секрет>   — надіслати їх із заданим темпом
+
+webhook_url = os.getenv('WEBHOOK_URL')  # Публічна HTTPS-адреса для Telegram; без неї сервер лише слухає локально
+webhook_secret = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+webhook_host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+webhook_port = int(os.getenv('WEBHOOK_PORT', 8443))
+webhook_path = os.getenv('WEBHOOK_PATH', '/telegram')
+webhook_max_connections = 40  # Скільки одночасних з'єднань дозволити Telegram
+webhook_seen_updates = 10000  # Скільки останніх update_id пам'ятати, щоб не обробити повтор двічі
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    def __init__(self, submit, secret, path, seen_updates=webhook_seen_updates):
+        self.submit = submit  # Корутина, що передає оновлення в конвеєр обробки
+        self.secret = secret
+        self.path = path
+        self.received = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self._seen = set()
+        self._seen_order = deque()
+        self._seen_limit = seen_updates
+
+    def _is_duplicate(self, update_id):
+        # Telegram повторює доставку, якщо не дочекався відповіді
+        if update_id in self._seen:
+            return True
+        self._seen.add(update_id)
+        self._seen_order.append(update_id)
+        if len(self._seen_order) > self._seen_limit:
+            self._seen.discard(self._seen_order.popleft())
+        return False
+
+    async def handle(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            update = await request.json(loads=json.loads)
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict) or 'update_id' not in update:
+            return web.Response(status=400)
+        if self._is_duplicate(update['update_id']):
+            self.duplicates += 1
+            return web.Response()
+        self.received += 1
+        await self.submit(update)
+        return web.Response()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def start(self, host, port):
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    def stats(self):
+        return {'received': self.received, 'rejected': self.rejected, 'duplicates': self.duplicates}
+
+
+def register_webhook(bot, url, secret, allowed_updates, max_connections=webhook_max_connections):
+    # telepot.Bot.setWebhook не знає secret_token, тож запит іде напряму; списки передаються як JSON
+    return bot._api_request('setWebhook', {
+        'url': url,
+        'secret_token': secret,
+        'max_connections': max_connections,
+        'allowed_updates': json.dumps(allowed_updates)
+    })
+
+
+def sync_submitter(process_update):
+    # Синхронний конвеєр: один потік передає оновлення в пул обробників по порядку,
+    # а цикл подій не блокується, коли черга пулу заповнена
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='webhook')
+
+    async def submit(update):
+        await asyncio.get_event_loop().run_in_executor(executor, process_update, update)
+    return submit
+
+
+async def serve_webhook(bot, submit, allowed_updates, host=webhook_host, port=webhook_port, path=webhook_path,
+                        url=webhook_url, secret=webhook_secret):
+    server = WebhookServer(submit, secret, path)
+    runner = await server.start(host, port)
+    print(f"{Fore.GREEN}Вебхук слухає:{Style.RESET_ALL} http://{host}:{port}{path}")
+    try:
+        if url:
+            await asyncio.get_event_loop().run_in_executor(None, register_webhook, bot, url, secret, allowed_updates)
+            print(f"{Fore.GREEN}Вебхук зареєстровано:{Style.RESET_ALL} {url}")
+        else:
+            print(f"{Fore.YELLOW}WEBHOOK_URL не задано:{Style.RESET_ALL} вебхук не зареєстровано в Telegram, "
+                  f"секрет для локальних запитів: {secret}")
+        while True:
+            await asyncio.sleep(60)
+            stats = server.stats()
+            print(f"{Fore.CYAN}Вебхук:{Style.RESET_ALL} отримано {stats['received']} | відхилено {stats['rejected']} | "
+                  f"повторів {stats['duplicates']}")
+    finally:
+        await runner.cleanup()
+
+
+def generate_updates(path, count, chats, users):
+    texts = ["привіт усім", "хтось знає розклад на завтра?", "дякую!", "дивіться https://example.com",
+             "Заробляй від 500 доларів на день без вкладень пиши в особисті !!"]
+    with open(path, 'w', encoding='utf-8') as file:
+        for update_id in range(1, count + 1):
+            chat_id = -1000000000000 - random.randrange(chats)
+            user_id = random.randrange(1, users + 1)
+            message = {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'supergroup', 'title': f"Чат {chat_id}"},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+                'text': random.choice(texts)
+            }
+            file.write(json.dumps({'update_id': update_id, 'message': message}, ensure_ascii=False) + '\n')
+    print(f"{Fore.GREEN}Оновлення збережено:{Style.RESET_ALL} {path} | {count} оновлень у {chats} чатах")
+
+
+async def replay_updates(path, url, secret, rate, concurrency, repeat):
+    # Надсилає записані оновлення на вебхук у темпі rate запитів на секунду й міряє затримку відповіді
+    with open(path, encoding='utf-8') as file:
+        updates = [json.loads(line) for line in file if line.strip()]
+    latencies = []
+    statuses = {}
+    slots = asyncio.Semaphore(concurrency)
+
+    async def post(session, update):
+        started = time.perf_counter()
+        try:
+            async with session.post(url, json=update, headers={SECRET_HEADER: secret}) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+        except aiohttp.ClientError as e:
+            statuses[type(e).__name__] = statuses.get(type(e).__name__, 0) + 1
+        finally:
+            latencies.append(time.perf_counter() - started)
+            slots.release()
+
+    started = time.perf_counter()
+    tasks = []
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        for index in range(len(updates) * repeat):
+            # Повтори отримують нові update_id, інакше сервер відкине їх як повторну доставку
+            update = dict(updates[index % len(updates)], update_id=index + 1)
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await slots.acquire()
+            tasks.append(asyncio.ensure_future(post(session, update)))
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"{Fore.CYAN}Надіслано:{Style.RESET_ALL} {len(latencies)} за {elapsed:.2f} с ({len(latencies) / elapsed:.0f}/с)")
+    print(f"{Fore.CYAN}Відповіді:{Style.RESET_ALL} " + ", ".join(f"{status}: {count}" for status, count in statuses.items()))
+    if latencies:
+        print(f"{Fore.CYAN}Затримка:{Style.RESET_ALL} p50 {latencies[len(latencies) // 2] * 1000:.1f} мс | "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} мс | макс. {latencies[-1] * 1000:.1f} мс")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Локальна перевірка вебхука")
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate_parser = commands.add_parser('generate', help="створити файл синтетичних оновлень (JSONL)")
+    generate_parser.add_argument('updates')
+    generate_parser.add_argument('--count', type=int, default=10000)
+    generate_parser.add_argument('--chats', type=int, default=50)
+    generate_parser.add_argument('--users', type=int, default=2000)
+    replay_parser = commands.add_parser('replay', help="надіслати оновлення з файлу на вебхук")
+    replay_parser.add_argument('updates')
+    replay_parser.add_argument('--url', default=f"http://127.0.0.1:{webhook_port}{webhook_path}")
+    replay_parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', ''))
+    replay_parser.add_argument('--rate', type=float, default=1000, help="запитів на секунду")
+    replay_parser.add_argument('--concurrency', type=int, default=64)
+    replay_parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate_updates(args.updates, args.count, args.chats, args.users)
+    else:
+        asyncio.get_event_loop().run_until_complete(
+            replay_updates(args.updates, args.url, args.secret, args.rate, args.concurrency, args.repeat))
@@ -0,0 +1,35 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Files'))
+
+# utils під час імпорту створює violations.db у поточному каталозі, тож імпортуємо його в тимчасовому
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp())
+try:
+    from utils import canonicalize_url
+finally:
+    os.chdir(_cwd)
+
+
+class CanonicalizeUrlTest(unittest.TestCase):
+    def test_ascii_host_is_lowercased(self):
+        self.assertEqual(canonicalize_url('HTTP://WWW.Example.COM/Path'), 'http://www.example.com/Path')
+
+    def test_percent_encoded_non_ascii_host_keeps_its_bytes(self):
+        self.assertEqual(canonicalize_url('http://%D0%BF%D1%80%D0%B8%D0%BC%D0%B5%D1%80.%D1%80%D1%84/'),
+                         'http://%D0%BF%D1%80%D0%B8%D0%BC%D0%B5%D1%80.%D1%80%D1%84/')
+
+    def test_raw_and_percent_encoded_non_ascii_host_match(self):
+        self.assertEqual(canonicalize_url('http://пример.рф/'),
+                         canonicalize_url('http://%D0%BF%D1%80%D0%B8%D0%BC%D0%B5%D1%80.%D1%80%D1%84/'))
+
+    def test_only_ascii_letters_change_case(self):
+        self.assertEqual(canonicalize_url('http://Пример.EXAMPLE/'),
+                         'http://%D0%9F%D1%80%D0%B8%D0%BC%D0%B5%D1%80.example/')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Files'))
+
+# prefilter імпортує utils, який створює violations.db і bot_logs.log у поточному каталозі, тож імпорт іде в тимчасовому
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp())
+try:
+    from prefilter import LOG_LINE, SPAM_EVENTS, UNMUTE_EVENT
+finally:
+    os.chdir(_cwd)
+
+LOG_FORMAT = next(handler.formatter._fmt for handler in logging.getLogger().handlers
+                  if isinstance(handler, logging.FileHandler))
+
+
+def log_line(event, details, username='Тест (адмін)'):
+    # Рядок у тому самому форматі, що пише бот у bot_logs.log
+    record = logging.LogRecord('root', logging.INFO, __file__, 0, event, None, None)
+    record.__dict__.update(chat_id=-100, chat_title='Група', user_id=42, username=username, details=details)
+    return logging.Formatter(LOG_FORMAT).format(record)
+
+
+class LogLineTest(unittest.TestCase):
+    def assert_parsed(self, line, event, text):
+        match = LOG_LINE.search(line)
+        self.assertIsNotNone(match, line)
+        self.assertEqual((match['user_id'], match['event'], match['text']), ('42', event, text))
+
+    def test_mute_for_violation_events(self):
+        for event in ("Spam text: User muted", "Curse words: User muted"):
+            self.assertIn(event, SPAM_EVENTS)
+            self.assert_parsed(log_line(event, "Message: купи дешево - Timeout: 6 hours"), event, "купи дешево")
+
+    def test_suspicious_link_event(self):
+        event = "Suspicious link: User muted"
+        self.assertIn(event, SPAM_EVENTS)
+        self.assert_parsed(log_line(event, "Message: дивись evil.com - URL: http://evil.com/ - Timeout: 1 hours"),
+                           event, "дивись evil.com")
+
+    def test_command_events(self):
+        self.assert_parsed(log_line("Mute: User muted", "Message: реклама - Timeout: 12 hours"),
+                           "Mute: User muted", "реклама")
+        self.assert_parsed(log_line("Ban: User banned", "Message: реклама"), "Ban: User banned", "реклама")
+        self.assert_parsed(log_line(UNMUTE_EVENT, "Message: звичайний текст"), UNMUTE_EVENT, "звичайний текст")
+
+    def test_flood_is_not_a_text_label(self):
+        self.assertNotIn("Spam: User muted", SPAM_EVENTS)
+
+
+if __name__ == '__main__':
+    unittest.main()